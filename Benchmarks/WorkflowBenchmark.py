@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Benchmark of the overhead of steady on synthetic workflows.
+
+Each workflow shape is generated in a fresh directory and executed
+three ways:
+
+- first: nothing is cached, so every step is hashed and executed.
+- no-op: nothing changed since the last run. The first no-op run
+  after the outputs were written records their stats; the following
+  ones are the steady state.
+- partial: some inputs were modified, so part of the workflow is
+  executed again.
+
+The steps only run cp, so the times measure what steady itself spends
+checking, hashing and caching. Usage::
+
+  python WorkflowBenchmark.py [--shapes tiny-files,deep-chain] [--scale 0.5]
+                              [--repeat 3] [--jobs 4] [--json results.json]
+
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Use the steady next to this directory rather than an installed one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import hashing
+from steady import workflow as wf
+from steady.instrumentation import Instrumentation
+
+
+#############################################################################
+def _WriteFile(path, content):
+    directory = os.path.dirname(path)
+    if (not os.path.isdir(directory)):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def _WriteLargeFile(path, size, seed):
+    """Write a file of the given size whose contents depend on the seed.
+
+    """
+    block = os.urandom(hashing.ChunkSize)
+    with open(path, 'wb') as f:
+        f.write(seed.encode('utf-8'))
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+
+def _Age(paths):
+    """Move the modification time of files an hour into the past, as if
+    they had been written long before the benchmark.
+
+    """
+    past = time.time() - 3600
+    for path in paths:
+        os.utime(path, (past, past))
+
+def _Scaled(count, scale):
+    return max(1, int(count * scale))
+
+def _CopyStep(name, source, destination, hidden=[]):
+    """Get a step that copies a file and depends on hidden inputs.
+
+    """
+    cmd = ['cp', wf.infile(source), wf.outfile(destination)]
+    cmd += [wf.infile_hidden(path) for path in hidden]
+    return wf.CLIWorkflowStep(name, cmd)
+
+
+#############################################################################
+def TinyFiles(directory, scale):
+    """Many independent steps, each copying a small file.
+
+    Partial invalidation modifies 10% of the inputs.
+
+    """
+    count = _Scaled(2000, scale)
+    inputs = [os.path.join(directory, 'in', '%05d.txt' % i) for i in range(count)]
+    for i, path in enumerate(inputs):
+        _WriteFile(path, b'tiny input %d\n' % i)
+    _Age(inputs)
+
+    steps = [_CopyStep('copy-%05d' % i, path, os.path.join(directory, 'out', '%05d.txt' % i))
+             for i, path in enumerate(inputs)]
+    os.makedirs(os.path.join(directory, 'out'))
+
+    def Invalidate():
+        for path in inputs[::10]:
+            _WriteFile(path, b'modified\n')
+
+    return steps, Invalidate
+
+def HugeFiles(directory, scale):
+    """A few steps, each depending on a large file that is hashed with
+    memory maps.
+
+    Partial invalidation modifies the end of one of the files.
+
+    """
+    size = _Scaled(128 * 1024 * 1024, scale)
+    stamp = os.path.join(directory, 'stamp.txt')
+    _WriteFile(stamp, b'stamp\n')
+    inputs = [os.path.join(directory, 'huge-%d.raw' % i) for i in range(4)]
+    for i, path in enumerate(inputs):
+        _WriteLargeFile(path, size, 'huge %d' % i)
+    _Age(inputs + [stamp])
+
+    steps = [_CopyStep('huge-%d' % i, stamp, os.path.join(directory, 'out-%d.txt' % i), [path])
+             for i, path in enumerate(inputs)]
+
+    def Invalidate():
+        with open(inputs[0], 'r+b') as f:
+            f.seek(-16, os.SEEK_END)
+            f.write(b'modified at end\n')
+
+    return steps, Invalidate
+
+def DeepChain(directory, scale):
+    """A linear chain of steps, each copying the output of the previous one
+    and depending on a parameter file of its own.
+
+    Partial invalidation modifies the parameter of the middle step,
+    whose output is unchanged, so the rest of the chain stays
+    up-to-date.
+
+    """
+    count = _Scaled(1000, scale)
+    files = [os.path.join(directory, 'chain', '%05d.txt' % i) for i in range(count + 1)]
+    parameters = [os.path.join(directory, 'parameters', '%05d.txt' % i) for i in range(count)]
+    _WriteFile(files[0], b'head of the chain\n')
+    for i, path in enumerate(parameters):
+        _WriteFile(path, b'parameter %d\n' % i)
+    _Age(files[:1] + parameters)
+
+    steps = [_CopyStep('link-%05d' % i, files[i], files[i + 1], [parameters[i]])
+             for i in range(count)]
+
+    def Invalidate():
+        _WriteFile(parameters[count // 2], b'modified\n')
+
+    return steps, Invalidate
+
+def WideFanOut(directory, scale):
+    """Many steps copying the same source file.
+
+    Partial invalidation modifies the source, so every step executes
+    again while the source is hashed once.
+
+    """
+    count = _Scaled(2000, scale)
+    source = os.path.join(directory, 'source.txt')
+    _WriteFile(source, b'shared source\n')
+    _Age([source])
+
+    os.makedirs(os.path.join(directory, 'out'))
+    steps = [_CopyStep('fan-%05d' % i, source, os.path.join(directory, 'out', '%05d.txt' % i))
+             for i in range(count)]
+
+    def Invalidate():
+        _WriteFile(source, b'modified shared source\n')
+
+    return steps, Invalidate
+
+def LargeDirectory(directory, scale):
+    """A few steps depending on a directory with many files.
+
+    Partial invalidation modifies one file in the directory.
+
+    """
+    count = _Scaled(10000, scale)
+    data = os.path.join(directory, 'data')
+    files = [os.path.join(data, '%03d' % (i % 100), '%05d.txt' % i) for i in range(count)]
+    for i, path in enumerate(files):
+        _WriteFile(path, b'file %d\n' % i)
+    stamp = os.path.join(directory, 'stamp.txt')
+    _WriteFile(stamp, b'stamp\n')
+    _Age(files + [stamp])
+
+    steps = [_CopyStep('scan-%d' % i, stamp, os.path.join(directory, 'out-%d.txt' % i), [data])
+             for i in range(4)]
+
+    def Invalidate():
+        _WriteFile(files[len(files) // 2], b'modified\n')
+
+    return steps, Invalidate
+
+"""Workflow shapes by name."""
+Shapes = {
+    'tiny-files': TinyFiles,
+    'huge-files': HugeFiles,
+    'deep-chain': DeepChain,
+    'wide-fan-out': WideFanOut,
+    'large-directory': LargeDirectory,
+}
+
+
+#############################################################################
+def _TimeRun(workflow, jobs, hashJobs):
+    """Execute a workflow quietly and measure it.
+
+    """
+    instrumentation = Instrumentation()
+    workflow.SetInstrumentation(instrumentation)
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.time()
+            success = workflow.Execute(jobs=jobs, hashJobs=hashJobs)
+            elapsed = time.time() - start
+
+    if (not success):
+        raise RuntimeError('The benchmark workflow failed')
+
+    records = instrumentation.Records
+    return {
+        'time': elapsed,
+        'executed': sum(1 for r in records if r.Status == 'executed'),
+        'bytesHashed': sum(r.BytesHashed for r in records),
+        'filesHashed': sum(r.FilesHashed for r in records),
+    }
+
+def _Best(runs):
+    return min(runs, key=lambda run: run['time'])
+
+def RunShape(name, directory, scale, repeat, jobs, hashJobs):
+    """Generate and benchmark a workflow shape.
+
+    Returns a dictionary of measurements for each phase.
+
+    """
+    phases = {'first': [], 'no-op (first)': [], 'no-op': [], 'partial': []}
+    for i in range(repeat):
+        shapeDirectory = os.path.join(directory, '%s-%d' % (name, i))
+        os.makedirs(shapeDirectory)
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                wf.Workflow.SetCacheDirectory(os.path.join(shapeDirectory, 'cache'))
+
+        steps, invalidate = Shapes[name](shapeDirectory, scale)
+        workflow = wf.Workflow(steps)
+
+        phases['first'].append(_TimeRun(workflow, jobs, hashJobs))
+
+        # Let the outputs age past the window in which their stats are
+        # not trusted
+        time.sleep(hashing.RacyStatWindow)
+        phases['no-op (first)'].append(_TimeRun(workflow, jobs, hashJobs))
+        phases['no-op'].append(_TimeRun(workflow, jobs, hashJobs))
+
+        invalidate()
+        phases['partial'].append(_TimeRun(workflow, jobs, hashJobs))
+
+        shutil.rmtree(shapeDirectory)
+
+    return dict((phase, _Best(runs)) for phase, runs in phases.items())
+
+def _FormatBytes(count):
+    for unit in ['B', 'KiB', 'MiB']:
+        if (count < 1024):
+            return '%d %s' % (count, unit)
+        count //= 1024
+
+    return '%d GiB' % count
+
+
+#############################################################################
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the overhead of steady.')
+    parser.add_argument('--shapes', default=','.join(sorted(Shapes)),
+                        help='Comma-separated workflow shapes among %s.' % ', '.join(sorted(Shapes)))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Factor applied to the number of steps and file sizes.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times each shape is run. The best time is reported.')
+    parser.add_argument('--jobs', type=int, default=1, help='Steps executed in parallel.')
+    parser.add_argument('--hash-jobs', type=int, default=1, help='Files hashed in parallel.')
+    parser.add_argument('--directory', default=None,
+                        help='Directory where the workflows are generated. Defaults to a temporary directory.')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.shapes.split(',') if name.strip()]
+    for name in names:
+        if (name not in Shapes):
+            parser.error('Unknown shape "%s".' % name)
+
+    directory = tempfile.mkdtemp(prefix='steady-benchmark-', dir=args.directory)
+    results = {}
+    try:
+        sys.stdout.write('%-16s %-14s %10s %9s %12s %8s\n' %
+                         ('shape', 'phase', 'time (s)', 'executed', 'hashed', 'files'))
+        for name in names:
+            results[name] = RunShape(name, directory, args.scale, args.repeat,
+                                     args.jobs, args.hash_jobs)
+            for phase in ['first', 'no-op (first)', 'no-op', 'partial']:
+                result = results[name][phase]
+                sys.stdout.write('%-16s %-14s %10.3f %9d %12s %8d\n' %
+                                 (name, phase, result['time'], result['executed'],
+                                  _FormatBytes(result['bytesHashed']), result['filesHashed']))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+
+    if (args.json is not None):
+        with open(args.json, 'w') as f:
+            json.dump({'scale': args.scale, 'jobs': args.jobs, 'hashJobs': args.hash_jobs,
+                       'python': sys.version, 'results': results},
+                      f, indent=2, sort_keys=True)
+
+
+#############################################################################
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,12 @@ setup(name='steady',
       url='http://github.com/KitwareMedical/steady',
       packages=packages,
       install_requires=requires,
+      python_requires='>=3.7',
+      entry_points={
+          'console_scripts': [
+              'steady-cache-gc = steady.cachegc:main',
+          ],
+      },
       license='Apache 2.0',
       zip_safe=True,
       classifiers=(
@@ -52,7 +58,7 @@ setup(name='steady',
           'Natural Language :: English',
           'License :: OSI Approved :: Apache Software License',
           'Programming Language :: Python',
-          'Programming Language :: Python :: 2.6',
-          'Programming Language :: Python :: 2.7',
+          'Programming Language :: Python :: 3',
+          'Programming Language :: Python :: 3 :: Only',
       ),
       )
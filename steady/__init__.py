@@ -93,7 +93,7 @@ Let's see what happens the first time ``Execute`` is called on
 the workflow::
 
   >>> workflow.Execute(verbose=True)
-  Workflow step "CopyStep" needs to be executed.
+  Workflow step "CopyStep" needs to be executed: output "copiedFile" is missing.
   Executing CLIWorkflowStep "CopyStep"
   Command: "/bin/cp" "/etc/mtab" "copiedFile"
   '/bin/cp' -> 'copiedFile'
@@ -109,7 +109,7 @@ Now, let's remove the output file and run the workflow again.
 
   >>> os.remove('copiedFile')
   >>> workflow.Execute(verbose=True)
-  Workflow step "CopyStep" needs to be executed.
+  Workflow step "CopyStep" needs to be executed: output "copiedFile" is missing.
   Executing CLIWorkflowStep "CopyStep"
   Command: "/bin/cp" "/etc/mtab" "copiedFile"
 
@@ -120,22 +120,327 @@ contents::
   >>> with open('copiedFile', 'w') as f:
   ...     f.write('changed content')
   >>> workflow.Execute(verbose=True)
-  Workflow step "CopyStep" needs to be executed.
+  Workflow step "CopyStep" needs to be executed: "copiedFile" changed.
   Executing CLIWorkflowStep "CopyStep"
   Command: "/bin/cp" "/etc/mtab" "copiedFile"
 
 Again, ``steady`` notes the output file has been changed since the
 last execution and re-runs the step.
 
+Planning a run
+--------------
+
+``Workflow.Plan`` finds the steps that need to be executed without
+executing them, and tells why::
+
+  for planned in workflow.Plan():
+      print(planned.Step.Name, planned.Reason)
+
+When a step needs to be executed, the steps that depend on it are
+planned too, without hashing their files, since the files they read
+are about to be rewritten. They may still turn out to be up-to-date
+when the workflow is executed, if the step rewrites identical
+outputs. ``Execute(dryRun=True)`` prints the same plan.
+
+Processing many data sets
+-------------------------
+
+When the same chain of tools is applied to many data sets, the steps
+can be created from a ``CLIWorkflowStepTemplate``. The name and the
+command of the template are patterns formatted with the fields of
+each data set::
+
+  register = wf.CLIWorkflowStepTemplate(
+      'Register-{subject}',
+      ['/usr/bin/register', wf.infile('{subject}/image.nrrd'),
+       wf.outfile('{subject}/registered.nrrd')])
+
+  workflow.AddSteps(register.Expand([{'subject': s} for s in subjects]))
+
+The workflow indexes its steps by name and by the files they read and
+write, so that ``Workflow.GetStep``, ``Workflow.GetProducers`` and
+``Workflow.GetConsumers`` do not need to scan all steps.
+
+Executables
+-----------
+
+The executable of a step may be given as a path or as a bare name,
+such as ``python``, which is looked up in the ``PATH`` like the shell
+does. Each executable is hashed at most once per run, and its hash is
+cached across runs and shared by all steps that use it, so large
+executables are only hashed again when they change.
+
+Executables may also change behavior when a shared library they load
+is upgraded. To take this into account, the shared libraries found by
+``ldd`` can be made part of the fingerprint of each executable::
+
+  workflow.SetTrackSharedLibraries(True)
+
+Parallel execution
+------------------
+
+``steady`` infers the dependencies between workflow steps from their
+input and output files: a step that reads a file written by a step
+added before it waits for that step to finish. Steps that do not
+depend on each other can be run concurrently by passing the maximum
+number of steps to run at the same time::
+
+  workflow.Execute(jobs=8)
+
+To refresh only some outputs, give the names of their steps or their
+paths as targets. Only these steps and the steps they depend on are
+checked and executed::
+
+  workflow.Execute(targets=['results/summary.csv'])
+
+If a step fails, only the steps that depend on it are skipped. The
+other steps still run, and ``Execute`` returns False.
+
+The files of each step can also be hashed concurrently on a thread
+pool shared by all steps. Its size should match what the storage can
+sustain, e.g., one or two threads on a spinning disk::
+
+  workflow.Execute(jobs=8, hashJobs=4)
+
+When steps use very different amounts of cores or memory, a plain
+number of jobs either oversubscribes the machine or leaves it idle.
+Steps can instead declare the resources they use, including named
+resources such as a scratch disk, and the workflow only executes
+steps at the same time when their resources fit within the limits of
+the node::
+
+  step.SetResources(cores=8, memory=30 * 2**30, tokens={'scratch-disk-io': 1})
+  workflow.SetResourceLimits(cores=32, memory=120 * 2**30, tokens={'scratch-disk-io': 2})
+  workflow.Execute(jobs=None)
+
+With ``pinCores=True``, each executing step is also pinned to its own
+CPUs. The nice level and CPU affinity of a single step can be set with
+``CLIWorkflowStep.SetProcessPriority``.
+
+Watching for changes
+--------------------
+
+When editing parameters or scripts interactively, ``Watch`` executes
+the workflow and then waits for the files it reads to change. Each
+time they do, it executes only the steps affected by the change::
+
+  workflow.Watch(jobs=4)
+
+Files are watched with inotify on Linux and polled elsewhere. The
+hashes computed stay in memory, so unchanged files are not read
+again. Watching stops on Ctrl-C, or when the ``threading.Event``
+passed as ``stopEvent`` is set.
+
+Running steps on several machines
+---------------------------------
+
+The commands of the steps can be dispatched to workers running on
+other machines that see the data at the same paths, e.g., on a shared
+file system. Start a worker on each machine::
+
+  STEADY_WORKER_SECRET=... python -m steady.distributed --host 0.0.0.0 --slots 16
+
+and give the workers to the workflow::
+
+  from steady.distributed import WorkerPool
+
+  workflow.SetWorkerPool(WorkerPool(['node1:7777', 'node2:7777']))
+  workflow.Execute(jobs=None)
+
+The workflow needs the same secret in STEADY_WORKER_SECRET, and proves
+it knows it by answering a random challenge of each worker, so the
+secret itself is never sent. Workers refuse to start without a secret.
+
+The workers report the exit status, the hashes and the stat
+identities of the outputs of each command. Checking whether steps are
+up-to-date and caching still happen in the process running the
+workflow. Workers run any command they are sent, so only expose them
+on trusted networks.
+
+Batching invocations of a tool
+------------------------------
+
+Tools that accept several inputs and outputs in one invocation can
+process many stale steps at once, saving the startup of a process and
+the initialization of the tool for each step. A step declares how its
+arguments combine with those of other steps::
+
+  step = wf.CLIWorkflowStep('Convert-001', ['convert', wf.infile('001.dcm'), wf.outfile('001.nrrd')])
+  step.SetBatching(maxSize=100)
+
+By default, the arguments of the steps are concatenated, e.g.,
+``convert 001.dcm 001.nrrd 002.dcm 002.nrrd``. Pass a ``combine``
+function to build the combined arguments differently. Stale steps with
+the same executable, combine function and ``key`` wait until nothing
+else can run and are then executed in a few combined invocations, at
+most one per job. Each step is still checked and cached on its own. If
+a combined invocation fails, all its steps fail. With log capture, the
+log of a batch is named after its first step.
+
+Calling Python functions
+------------------------
+
+A step running a Python script pays for the startup of the
+interpreter and for the imports of the script, which take seconds for
+packages like numpy or SimpleITK. A ``PythonWorkflowStep`` calls a
+Python function in a pool of worker processes that stay up, so these
+costs are paid once per worker::
+
+  import filters
+
+  step = wf.PythonWorkflowStep('Smooth', filters.smooth,
+                               [wf.infile('image.nrrd'), wf.outfile('smoothed.nrrd'), 2.0])
+
+The function is called with the arguments, files being passed as their
+path, and the step fails if it raises an exception. The other arguments
+must be plain values, such as numbers, strings, and lists, tuples,
+dictionaries and sets of them, whose serialization is the same in
+every run. The function must
+be defined at the top level of a module. The step is up-to-date under
+the same conditions as a ``CLIWorkflowStep``, with the source of the
+function in place of the executable, so editing the function causes
+the step to be executed again. Functions it calls are not tracked.
+
+By default, a worker process per CPU is started when the first
+``PythonWorkflowStep`` executes. Another ``concurrent.futures``
+executor can be set with ``Workflow.SetProcessPool``.
+
+Capturing the output of steps
+-----------------------------
+
+When steps run in parallel, the output of their commands interleaves
+on the console, and commands that print a lot of progress slow down
+terminals and CI log collectors. A ``LogCapture`` writes the standard
+output and error of each command to a log file of its step instead::
+
+  from steady.logs import LogCapture
+
+  workflow.SetLogCapture(LogCapture('/my/logs', maxSize=10 * 2**20, tailLines=20))
+
+The console then only shows which steps execute and, for a step that
+fails, the last ``tailLines`` lines of its log. A log larger than
+``maxSize`` bytes keeps the beginning and the end of the output.
+
+Using steady from asyncio
+-------------------------
+
+``Workflow.ExecuteAsync`` is a coroutine that takes the same arguments
+as ``Execute``. It launches the commands as asyncio subprocesses and
+runs the staleness checks in the event loop's executor, so it does not
+block other tasks running in the loop::
+
+  success = await workflow.ExecuteAsync(jobs=4)
+
 Cache files
 -----------
 
-``steady`` stores a set of cache files for each workflow step in a
-cache directory. By default, the cache directory is '/tmp', but you
-can change it globally with ``Workflow.SetCacheDirectory``::
+``steady`` stores the cached hashes for all workflow steps in a
+single log file, ``steady-cache.log``, in a cache directory. By
+default, the cache directory is '/tmp', where each user gets their own
+``steady-cache-<uid>.log`` since users cannot replace each other's
+files in directories with the sticky bit set. You can change the
+cache directory globally with ``Workflow.SetCacheDirectory``::
 
   Workflow.SetCacheDirectory('/my/cache/directory')
 
+A workflow can also be given its own cache directory, which takes
+precedence over the global one::
+
+  workflow = Workflow(steps, cacheDirectory='/my/project/cache')
+
+Several workflows and processes, including processes on different
+machines sharing a file system, can use the same cache directory at
+the same time. Writes to the cache are serialized with a lock file,
+while reading needs no lock.
+
+The cache is read once each time a workflow is executed, and new
+entries are appended to it in batches. Earlier versions of ``steady``
+stored one ``.sha256`` file per step and per file instead. These can
+be imported into the cache, so that upgrading does not force the
+steps to be re-executed::
+
+  workflow.MigrateCache(removeOld=True)
+
+Along with each SHA256, ``steady`` records the size, modification
+time, inode and device of the file. When these are unchanged on the
+next run, the file is assumed to be unchanged and is not hashed
+again, which makes checking an up-to-date workflow cheap even when
+the files are large. If you do not trust file modification times,
+e.g., because tools restore them after writing, you can ask
+``steady`` to always recompute the SHA256 of every file::
+
+  Workflow.SetParanoid(True)
+
+Files are hashed with SHA256 unless another algorithm is set on the
+workflow or on a step. BLAKE2b is faster to compute. The sampled
+algorithm only reads the size of each input file and a few blocks at
+its start, its end and in between, which makes hashing large inputs
+that are never modified in place, e.g., acquired images, almost free::
+
+  workflow.SetHashAlgorithm('blake2b')
+  step.SetHashAlgorithm('sampled')
+
+Files written by steps are hashed with SHA256 when the sampled
+algorithm is used. The algorithm is recorded with each cached hash,
+so changing it causes the affected steps to be executed again.
+
+Entries for steps and files that are gone stay in the cache until
+they are collected. ``CollectGarbage`` removes the entries not used
+for some days, and the least recently used entries beyond a number of
+entries or a size, then compacts the cache::
+
+  workflow.CollectGarbage(maxAge=30, maxSize=100 * 2**20)
+
+If no other workflow uses the cache directory, the entries of steps
+and files that are not in the workflow can be removed as well by
+passing ``removeUnreferenced=True``. The same cleanup, without the
+workflow, is available from the command line::
+
+  steady-cache-gc /my/cache/directory --max-age 30 --max-size 100M --remove-legacy
+
+``--remove-legacy`` removes the ``.sha256`` files of earlier versions.
+
+Restoring outputs instead of re-executing
+-----------------------------------------
+
+When switching back and forth between inputs or executables, e.g.,
+when checking out an older version of a configuration file, steps
+would re-execute to produce outputs that were computed before. An
+``ArtifactStore`` keeps the outputs of each executed step under their
+SHA256 and restores them when the same executable, inputs and
+arguments are seen again::
+
+  from steady.store import ArtifactStore
+
+  workflow.SetArtifactStore(ArtifactStore('/my/store', maxSize=50 * 2**30))
+
+Files are cloned with reflinks where the file system supports them,
+and copied otherwise. Pass ``hardlinks=True`` to restore outputs as
+hard links to read-only stored files when reflinks are not available.
+When the store grows beyond ``maxSize`` bytes, the least recently used
+files are evicted at the end of each run.
+
+Measuring a workflow run
+------------------------
+
+To find out where the time of a run goes, set an ``Instrumentation``
+on the workflow. For each step, it records the time spent checking
+whether the step is up-to-date, the bytes hashed and the time spent
+hashing them, and, for executed steps, the wall time, CPU time and
+peak memory use of the command::
+
+  from steady.instrumentation import Instrumentation
+
+  instrumentation = Instrumentation()
+  workflow.SetInstrumentation(instrumentation)
+  workflow.Execute()
+  instrumentation.WriteJSON('run.json')
+  instrumentation.WriteChromeTrace('run-trace.json')
+
+The trace can be opened in chrome://tracing or Perfetto. Functions
+added with ``AddStartHook`` and ``AddFinishHook`` are called as steps
+start and finish, e.g., to report progress.
+
 License
 -------
 
@@ -153,6 +458,12 @@ Additional examples
 
 Some additional examples are located in the Examples directory.
 
+The Benchmarks directory contains a benchmark of the time ``steady``
+itself spends checking, hashing and caching on synthetic workflows
+of various shapes::
+
+  python Benchmarks/WorkflowBenchmark.py --scale 0.5 --json results.json
+
 Acknowledgements
 ----------------
 
@@ -161,15 +472,29 @@ Acknowledgements
 FAQ
 ---
 
-**Q**: If I change an argument that is not an input or an output, the
-workflow step is not rerun. Why not?
+**Q**: If I change an argument that is not an input or an output, is
+the workflow step rerun?
+
+**A**: Yes. The SHA256 of the arguments of each step is cached along
+with the SHA256 of its files, so only the steps whose arguments changed
+are rerun. There is no need to clear the cache of the whole workflow.
+Caches written by versions of ``steady`` that did not record the
+arguments are upgraded on the next run without rerunning the steps.
+
+**Q**: My executable reads an environment variable. Can a change in its
+value rerun the step?
+
+**A**: Yes, if you list the variables that matter for the step::
+
+  step.SetTrackedEnvironment(['LC_ALL', 'MYTOOL_CONFIG'])
 
-**A**: No hashing and caching of command-line arguments is done. It
-could be, but it isn't.
+Other environment variables are ignored, so that unrelated changes to
+the environment do not rerun anything.
 
 """
 
 import steady.workflow
-from steady.workflow import Workflow, WorkflowStep, CLIWorkflowStep
+from steady.workflow import Workflow, WorkflowStep, CLIWorkflowStep, CLIWorkflowStepTemplate, \
+     PythonWorkflowStep
 
 __version__ = '0.5.0'
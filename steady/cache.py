@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Storage of cached hashes for workflow steps.
+
+All entries of a cache directory are kept in a single append-only log
+file. The log is read once into an in-memory index when the cache is
+opened, and new entries are appended to it in batches when the cache
+is flushed. Each line of the log is a JSON record for one (step, path)
+pair; later records override earlier ones.
+
+Several processes, possibly on different machines, may share a cache
+directory. Writers append to the log and rewrite it while holding an
+exclusive flock on a lock file next to it, and a rewrite replaces the
+log with a rename. Readers do not lock: they only consume complete
+lines, and pick up the records appended by other processes since they
+last read the log with Refresh().
+
+Users cannot replace the files of other users in a directory with the
+sticky bit set, such as /tmp, so there the log and lock files of each
+user have their own names. Elsewhere, the log and lock files are shared
+and created with the permissions allowed by the umask of the process,
+so set a umask such as 002 to share a cache directory with a group.
+
+Each entry also has the time it was last used, so that entries that
+are no longer used can be collected. To keep no-op runs from writing
+to the log, the time of an entry is only updated when it is more than
+TouchInterval seconds old. Since records are only appended, the log is
+rewritten with the live entries when garbage is collected.
+
+The cache can be cleaned up from the command line with the
+steady-cache-gc script, see steady.cachegc.
+
+"""
+
+import contextlib
+import json
+import os
+import re
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""Name of the log file in the cache directory."""
+LogFileName = 'steady-cache.log'
+
+"""Name of the file locked by writers in the cache directory."""
+LockFileName = 'steady-cache.lock'
+
+"""Minimum number of seconds between two updates of the time an entry was
+last used."""
+TouchInterval = 12 * 3600
+
+
+#############################################################################
+class HashCache(object):
+    """Cache of file hashes for workflow steps stored in a single log file.
+
+    :param directory: Directory where the log file is stored.
+
+    """
+    def __init__(self, directory):
+        self.Directory = directory
+        self._LogFileName = os.path.join(directory, _GetFileName(directory, LogFileName))
+        self._LockFileName = os.path.join(directory, _GetFileName(directory, LockFileName))
+        self._Entries = {}
+        self._Times = {}
+        self._Used = set()
+        self._Pending = []
+        self._Lock = threading.Lock()
+
+        # Position up to which the log was read, and identity of the
+        # log file that was read
+        self._Offset = 0
+        self._FileIdentity = None
+        self._ReadLog()
+
+    def Refresh(self):
+        """Read the records appended to the log by other processes since it
+        was last read.
+
+        This is cheap when the log did not change.
+
+        """
+        with self._Lock:
+            self._ReadLog()
+
+    def Get(self, stepName, path):
+        """Get the cached entry for a path in a workflow step.
+
+        Returns a dictionary with at least a 'sha256' key, or None if
+        there is no entry.
+
+        """
+        key = (stepName, path)
+        with self._Lock:
+            entry = self._Entries.get(key)
+            if (entry is not None):
+                self._Used.add(key)
+            return entry
+
+    def Set(self, stepName, path, entry):
+        """Set the cached entry for a path in a workflow step.
+
+        The entry is written to the log on the next call to Flush().
+
+        """
+        now = time.time()
+        with self._Lock:
+            self._Entries[(stepName, path)] = entry
+            self._Times[(stepName, path)] = now
+            record = dict(entry)
+            record['step'] = stepName
+            record['path'] = path
+            record['time'] = now
+            self._Pending.append(record)
+
+    def Remove(self, stepName, path):
+        """Remove the cached entry for a path in a workflow step.
+
+        Returns True if there was an entry to remove.
+
+        """
+        with self._Lock:
+            if (self._Entries.pop((stepName, path), None) is None):
+                return False
+            self._Times.pop((stepName, path), None)
+            self._Pending.append({'step': stepName, 'path': path, 'removed': True})
+            return True
+
+    def Flush(self):
+        """Append all pending entries to the log in a single write.
+
+        """
+        with self._Lock:
+            self._TouchUsed()
+            if (len(self._Pending) == 0):
+                return
+
+            with self._Locked():
+                self._AppendPending()
+
+    def Keys(self):
+        """Get the (step name, path) pairs of all entries.
+
+        """
+        with self._Lock:
+            return list(self._Entries)
+
+    def CollectGarbage(self, keep=None, maxAge=None, maxEntries=None, maxSize=None):
+        """Remove entries that are not needed anymore and rewrite the log with
+        the remaining entries.
+
+        :param keep: Function called with the step name and path of
+        each entry, returning False if the entry should be removed.
+        :param maxAge: Remove entries not used for this many seconds.
+        :param maxEntries: Remove the least recently used entries until
+        at most this many remain.
+        :param maxSize: Remove the least recently used entries until
+        the log is at most this many bytes.
+
+        Returns the number of entries removed.
+
+        """
+        now = time.time()
+        with self._Lock, self._Locked():
+            # Bring the index up-to-date with the log before rewriting it
+            self._TouchUsed()
+            self._AppendPending()
+            self._ReadLog()
+
+            removed = []
+            for key in list(self._Entries):
+                if ((keep is not None and not keep(key[0], key[1])) or
+                    (maxAge is not None and now - self._Times[key] > maxAge)):
+                    removed.append(key)
+            for key in removed:
+                del self._Entries[key]
+                del self._Times[key]
+
+            lines = dict((key, self._FormatRecord(key)) for key in self._Entries)
+            size = sum(len(line) for line in lines.values())
+
+            # Evict the least recently used entries
+            for key in sorted(self._Entries, key=lambda key: self._Times[key]):
+                if ((maxEntries is None or len(self._Entries) <= maxEntries) and
+                    (maxSize is None or size <= maxSize)):
+                    break
+                size -= len(lines.pop(key))
+                del self._Entries[key]
+                del self._Times[key]
+                removed.append(key)
+
+            self._Used.difference_update(removed)
+            self._Rewrite([lines[key] for key in self._Entries])
+
+            return len(removed)
+
+    def Compact(self):
+        """Rewrite the log with only the live entries, dropping overridden
+        and removed records.
+
+        """
+        self.CollectGarbage()
+
+    def _TouchUsed(self):
+        """Queue records updating the time of entries used since the last
+        flush, if it is older than TouchInterval.
+
+        """
+        now = time.time()
+        for key in self._Used:
+            if (key in self._Entries and now - self._Times[key] > TouchInterval):
+                self._Times[key] = now
+                self._Pending.append({'step': key[0], 'path': key[1], 'touched': now})
+        self._Used = set()
+
+    def _FormatRecord(self, key):
+        record = dict(self._Entries[key])
+        record['step'] = key[0]
+        record['path'] = key[1]
+        record['time'] = self._Times[key]
+        return json.dumps(record, sort_keys=True) + '\n'
+
+    @contextlib.contextmanager
+    def _Locked(self):
+        """Hold the exclusive lock of the cache directory.
+
+        """
+        if (not os.path.isdir(self.Directory)):
+            os.makedirs(self.Directory)
+
+        fd = os.open(self._LockFileName, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if (fcntl is not None):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def _AppendPending(self):
+        """Append the pending records to the log in a single write. The lock
+        of the cache directory must be held.
+
+        """
+        if (len(self._Pending) == 0):
+            return
+
+        lines = [json.dumps(record, sort_keys=True) + '\n' for record in self._Pending]
+        with open(self._LogFileName, 'a') as f:
+            f.write(''.join(lines))
+
+        self._Pending = []
+
+    def _Rewrite(self, lines):
+        """Replace the log with the given lines, through a temporary file
+        and a rename. The lock of the cache directory must be held.
+
+        """
+        fd, tempFileName = tempfile.mkstemp(dir=self.Directory,
+                                            prefix='.tmp-' + os.path.basename(self._LogFileName))
+        try:
+            # Keep the permissions of the log, which mkstemp() would
+            # restrict to the current user
+            try:
+                os.fchmod(fd, stat.S_IMODE(os.stat(self._LogFileName).st_mode))
+            except FileNotFoundError:
+                pass
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+                st = os.fstat(f.fileno())
+            os.replace(tempFileName, self._LogFileName)
+        except:
+            os.remove(tempFileName)
+            raise
+
+        self._Pending = []
+        self._Offset = st.st_size
+        self._FileIdentity = (st.st_ino, st.st_dev)
+
+    def _ReadLog(self):
+        """Read the records added to the log since it was last read into the
+        in-memory index.
+
+        If the log was replaced, e.g., by another process collecting
+        garbage, it is read again from the start and the pending
+        records are applied on top of it.
+
+        """
+        try:
+            st = os.stat(self._LogFileName)
+        except OSError:
+            return
+
+        identity = (st.st_ino, st.st_dev)
+        if (identity == self._FileIdentity and st.st_size == self._Offset):
+            return
+
+        try:
+            f = open(self._LogFileName, 'rb')
+        except IOError:
+            return
+
+        with f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_ino, st.st_dev)
+            replaced = (identity != self._FileIdentity or st.st_size < self._Offset)
+            if (replaced):
+                self._Entries = {}
+                self._Times = {}
+                self._Offset = 0
+                self._FileIdentity = identity
+
+            f.seek(self._Offset)
+            data = f.read()
+
+        # A writer may be in the middle of appending, so only consume
+        # complete lines
+        end = data.rfind(b'\n') + 1
+        self._Offset += end
+
+        # Records written before times were recorded are taken to be
+        # as old as the log
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # Skip malformed records
+                continue
+            self._ApplyRecord(record, st.st_mtime)
+
+        if (replaced):
+            for record in self._Pending:
+                self._ApplyRecord(dict(record), time.time())
+
+    def _ApplyRecord(self, record, defaultTime):
+        """Apply a record of the log to the in-memory index.
+
+        """
+        try:
+            key = (record.pop('step'), record.pop('path'))
+        except (KeyError, AttributeError, TypeError):
+            return
+
+        if (record.get('removed')):
+            self._Entries.pop(key, None)
+            self._Times.pop(key, None)
+        elif ('touched' in record):
+            if (key in self._Entries):
+                self._Times[key] = record['touched']
+        else:
+            self._Times[key] = record.pop('time', defaultTime)
+            self._Entries[key] = record
+
+
+#############################################################################
+def _GetFileName(directory, fileName):
+    """Get the name of a file of the cache in a directory, which is
+    specific to the current user if the directory has the sticky bit
+    set.
+
+    """
+    try:
+        sticky = os.stat(directory).st_mode & stat.S_ISVTX
+    except OSError:
+        sticky = False
+    if (not sticky or not hasattr(os, 'getuid')):
+        return fileName
+
+    base, extension = os.path.splitext(fileName)
+    return '%s-%d%s' % (base, os.getuid(), extension)
+
+def LegacySHA256FileName(directory, stepName, path):
+    """Get the name of the per-file SHA256 cache file used by earlier
+    versions of steady for a path in a workflow step.
+
+    """
+    return os.path.join(directory, stepName + '-' + path.replace('/', '_') + '.sha256')
+
+def ReadLegacySHA256File(fileName):
+    """Read a per-file SHA256 cache file used by earlier versions of
+    steady.
+
+    Returns an entry for a HashCache.
+
+    """
+    with open(fileName, 'r') as f:
+        lines = f.readlines()
+
+    entry = {'sha256': '', 'stat': None}
+    if (len(lines) > 0):
+        entry['sha256'] = lines[0].strip()
+
+    if (len(lines) > 1):
+        try:
+            entry['stat'] = [int(x) for x in lines[1].split()]
+        except ValueError:
+            entry['stat'] = None
+
+    return entry
+
+def IsLegacySHA256File(fileName):
+    """Returns True if a file looks like a per-file SHA256 cache file
+    written by earlier versions of steady.
+
+    """
+    if (not fileName.endswith('.sha256')):
+        return False
+
+    try:
+        with open(fileName, 'r') as f:
+            content = f.read(256)
+    except (IOError, UnicodeDecodeError):
+        return False
+
+    return re.match(r'^[0-9a-f]{64}\n?(\d+ \d+ \d+ \d+\n?)?$', content) is not None
+
+def RemoveLegacySHA256Files(directory, verbose=False):
+    """Remove the per-file SHA256 cache files written by earlier versions
+    of steady from a directory.
+
+    Only files whose name and contents match the format of these files
+    are removed, so other files in the directory are left alone.
+
+    Returns the number of removed files.
+
+    """
+    count = 0
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0
+
+    for entry in entries:
+        if (entry.is_file(follow_symlinks=False) and IsLegacySHA256File(entry.path)):
+            if (verbose):
+                sys.stdout.write('Removing %s.\n' % entry.path)
+            try:
+                os.remove(entry.path)
+                count += 1
+            except OSError:
+                pass
+
+    return count
+
+def MigrateSHA256Files(cache, stepFiles, removeOld=False, verbose=False):
+    """Import per-file SHA256 cache files from earlier versions of steady
+    into a HashCache.
+
+    Since the old file names cannot be mapped back to paths
+    unambiguously, the (step, path) pairs to import must be given.
+
+    :param cache: HashCache to import the entries into.
+    :param stepFiles: Iterable of (step name, list of paths) pairs.
+    :param removeOld: If True, delete the imported SHA256 files.
+    :param verbose: If True, report each imported file.
+
+    Returns the number of imported entries.
+
+    """
+    stepFiles = list(stepFiles)
+
+    count = 0
+    for stepName, paths in stepFiles:
+        for path in paths:
+            fileName = LegacySHA256FileName(cache.Directory, stepName, path)
+            if (not os.path.isfile(fileName)):
+                continue
+
+            try:
+                entry = ReadLegacySHA256File(fileName)
+            except IOError:
+                sys.stdout.write('Could not read SHA256 file "%s".\n' % fileName)
+                continue
+
+            if (verbose):
+                sys.stdout.write('Importing %s.\n' % fileName)
+
+            cache.Set(stepName, path, entry)
+            count += 1
+
+    cache.Flush()
+
+    if (removeOld):
+        for stepName, paths in stepFiles:
+            for path in paths:
+                fileName = LegacySHA256FileName(cache.Directory, stepName, path)
+                if (os.path.isfile(fileName)):
+                    os.remove(fileName)
+
+    return count
+
+
+#############################################################################
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Command line cleanup of a steady cache directory.
+
+Entries of the cache that were not used for a while, or beyond a count
+or a size, are removed and the log is compacted::
+
+  steady-cache-gc /my/cache/directory --max-age 30 --max-size 100M
+
+or, without installing the script::
+
+  python -m steady.cachegc /my/cache/directory --max-age 30 --max-size 100M
+
+"""
+
+import argparse
+import os
+import sys
+
+from steady import cache
+
+
+#############################################################################
+def _ParseSize(value):
+    """Parse a size in bytes with an optional K, M, G or T suffix.
+
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if (value and value[-1] in units):
+        return int(float(value[:-1]) * units[value[-1]])
+
+    return int(value)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Collect garbage in a steady cache directory.')
+    parser.add_argument('directory', help='Cache directory.')
+    parser.add_argument('--max-age', type=float, default=None,
+                        help='Remove entries not used for this many days.')
+    parser.add_argument('--max-entries', type=int, default=None,
+                        help='Keep at most this many entries, removing the least recently used.')
+    parser.add_argument('--max-size', type=_ParseSize, default=None,
+                        help='Keep the cache below this size, e.g., 100M, removing the least recently used entries.')
+    parser.add_argument('--remove-legacy', action='store_true',
+                        help='Remove the .sha256 files written by earlier versions of steady.')
+    parser.add_argument('--verbose', action='store_true', help='Report each removed file.')
+    args = parser.parse_args(argv)
+
+    # Do not create a cache for a mistyped directory
+    if (not os.path.isdir(args.directory)):
+        parser.error('cache directory "%s" does not exist' % args.directory)
+
+    maxAge = None
+    if (args.max_age is not None):
+        maxAge = args.max_age * 24 * 3600
+
+    hashCache = cache.HashCache(args.directory)
+    count = hashCache.CollectGarbage(maxAge=maxAge, maxEntries=args.max_entries,
+                                     maxSize=args.max_size)
+    sys.stdout.write('Removed %d cache entries, %d remain.\n' % (count, len(hashCache.Keys())))
+
+    if (args.remove_legacy):
+        count = cache.RemoveLegacySHA256Files(args.directory, args.verbose)
+        sys.stdout.write('Removed %d legacy SHA256 files.\n' % count)
+
+
+#############################################################################
+if __name__ == '__main__':
+    main()
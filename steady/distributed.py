@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Execution of workflow steps on worker processes on other machines.
+
+A Worker runs on each machine and executes the commands sent to it.
+The process running the Workflow acts as the coordinator: with a
+WorkerPool set on the Workflow, the commands of the CLIWorkflowSteps
+that need to be executed are dispatched to the workers instead of
+being run locally. The workers and the coordinator must see the data
+at the same paths, e.g., on a shared file system.
+
+Workers hash the outputs of the commands they run, where the outputs
+are likely still in the page cache, and report the hashes with the
+exit status. The coordinator checks staleness and records the cache
+entries as usual, so caching stays correct.
+
+The protocol is one JSON object per line over TCP. A connection
+starts with a 'challenge' message from the worker carrying a random
+nonce. The coordinator answers with a 'hello' message carrying the
+HMAC-SHA256 of the nonce keyed with the shared secret, so the secret
+is never sent and answers cannot be replayed on other connections.
+The worker then replies with a 'welcome' message giving the number of
+steps it runs at the same time. The coordinator then sends 'execute'
+messages, one at a time on each connection, and the worker replies to
+each with a 'result' message.
+
+Workers execute whatever command they are sent, so they require a
+secret, listen on localhost by default, and should only be exposed on
+trusted networks. The messages after the handshake are neither
+encrypted nor signed. Start a worker with::
+
+  STEADY_WORKER_SECRET=... python -m steady.distributed --host 0.0.0.0 --slots 16
+
+"""
+
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+
+from steady import hashing
+from steady import logs
+from steady import workflow
+
+"""Port workers listen on by default."""
+DefaultPort = 7777
+
+"""Environment variable holding the secret shared by the coordinator and
+the workers, used when no secret is given."""
+SecretVariable = 'STEADY_WORKER_SECRET'
+
+"""Resource usage of a command run by a worker, with the fields of the
+result of os.wait4() that steady uses."""
+ResourceUsage = collections.namedtuple('ResourceUsage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+
+
+#############################################################################
+class WorkerError(IOError):
+    """Raised when a worker cannot be reached or rejects a request.
+
+    """
+    pass
+
+
+#############################################################################
+class Worker(object):
+    """Server that executes the commands of workflow steps sent by a
+    coordinator.
+
+    :param host: Address to listen on.
+    :param port: Port to listen on. Use 0 to pick a free port, which
+    is then available in Address.
+    :param slots: Number of steps the coordinator may run on this
+    worker at the same time. Defaults to the number of CPUs.
+    :param secret: Secret the coordinator must prove it knows.
+    Defaults to the value of the STEADY_WORKER_SECRET environment
+    variable. Raises ValueError if there is none.
+
+    """
+    def __init__(self, host='127.0.0.1', port=DefaultPort, slots=None, secret=None):
+        if (slots is None):
+            slots = os.cpu_count() or 1
+        secret = _GetSecret(secret)
+
+        self.Slots = slots
+        self._Secret = secret
+        self._Server = _Server((host, port), _WorkerHandler)
+        self._Server.Worker = self
+        self.Address = self._Server.server_address[:2]
+
+    def Serve(self):
+        """Handle connections until Shutdown() is called.
+
+        """
+        sys.stdout.write('Worker listening on %s:%d with %d slots.\n' %
+                         (self.Address[0], self.Address[1], self.Slots))
+        sys.stdout.flush()
+        self._Server.serve_forever()
+
+    def Shutdown(self):
+        """Stop serving and close the listening socket.
+
+        """
+        self._Server.shutdown()
+        self._Server.server_close()
+
+    def Execute(self, request):
+        """Run the command of a step and hash its outputs.
+
+        Returns the 'result' message for the coordinator.
+
+        """
+        cwd = request.get('cwd')
+
+        # Run with the values of the tracked environment variables seen
+        # by the coordinator
+        env = None
+        if (request.get('environment')):
+            env = dict(os.environ)
+            for name, value in request['environment'].items():
+                if (value is None):
+                    env.pop(name, None)
+                else:
+                    env[name] = value
+
+        def started(pid):
+            workflow._SetProcessPriority(pid, request.get('nice'), request.get('affinity'),
+                                         request['step'])
+
+        try:
+            if (request.get('log') is not None):
+                with logs.StepLog(request['log']['fileName'], request['log'].get('maxSize')) as log:
+                    returnCode, wallTime, usage = workflow._RunProcess(request['args'], started,
+                                                                       cwd, env, log)
+            else:
+                returnCode, wallTime, usage = workflow._RunProcess(request['args'], started, cwd, env)
+        except (OSError, ValueError) as e:
+            return {'type': 'result', 'error': str(e)}
+
+        result = {'type': 'result', 'returnCode': returnCode, 'wallTime': wallTime, 'hashes': {}}
+        if (usage is not None):
+            result['usage'] = [usage.ru_utime, usage.ru_stime, usage.ru_maxrss]
+
+        if (returnCode == 0):
+            for path in request.get('outputs', []):
+                result['hashes'].update(_HashOutput(path, cwd, request.get('algorithm', 'sha256')))
+
+        return result
+
+    def _CheckResponse(self, nonce, response):
+        """Returns True if a response to a challenge proves that the
+        coordinator knows the secret.
+
+        """
+        return hmac.compare_digest(str(response or ''), _ComputeResponse(self._Secret, nonce))
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    """Handles one connection from a coordinator.
+
+    """
+    def handle(self):
+        worker = self.server.Worker
+        nonce = os.urandom(32).hex()
+        _Send(self.wfile, {'type': 'challenge', 'nonce': nonce})
+        hello = _Receive(self.rfile)
+        if (hello is None or hello.get('type') != 'hello'):
+            return
+        if (not worker._CheckResponse(nonce, hello.get('response'))):
+            _Send(self.wfile, {'type': 'error', 'error': 'Invalid secret'})
+            return
+        _Send(self.wfile, {'type': 'welcome', 'slots': worker.Slots})
+
+        while True:
+            request = _Receive(self.rfile)
+            if (request is None):
+                return
+            if (request.get('type') != 'execute'):
+                _Send(self.wfile, {'type': 'error', 'error': 'Unknown request'})
+                continue
+            _Send(self.wfile, worker.Execute(request))
+
+def _HashOutput(path, cwd, algorithm):
+    """Hash the files of an output of a step.
+
+    Returns a dictionary mapping the path of each file, as the
+    coordinator sees it, to a list of its digest and of its stat
+    identity. Files that change while they are hashed are left out.
+
+    """
+    fullPath = path
+    if (cwd is not None):
+        fullPath = os.path.join(cwd, path)
+
+    files = []
+    if (os.path.isdir(fullPath)):
+        for relativePath, (filePath, statIdentity) in hashing.ScanDirectory(fullPath).items():
+            files.append((os.path.join(path, *relativePath.split('/')), filePath))
+    elif (os.path.isfile(fullPath)):
+        files.append((path, fullPath))
+
+    hashes = {}
+    for coordinatorPath, filePath in files:
+        statIdentity = hashing.StatIdentity(filePath)
+        digest = hashing.ComputeDigest(filePath, algorithm)
+        if (statIdentity is not None and statIdentity == hashing.StatIdentity(filePath)):
+            hashes[coordinatorPath] = [digest, list(statIdentity)]
+
+    return hashes
+
+
+#############################################################################
+class WorkerPool(object):
+    """Connections from the coordinator to a set of workers.
+
+    Each worker gets as many connections as it has slots, and each
+    connection runs one step at a time.
+
+    :param addresses: List of 'host:port' strings or (host, port)
+    tuples of the workers.
+    :param secret: Secret shared with the workers. Defaults to the
+    value of the STEADY_WORKER_SECRET environment variable. Raises
+    ValueError if there is none.
+
+    """
+    def __init__(self, addresses, secret=None):
+        secret = _GetSecret(secret)
+
+        self.Addresses = [_ParseAddress(address) for address in addresses]
+        self.Slots = 0
+        self._Secret = secret
+        self._Idle = queue.Queue()
+        self._Connections = []
+        self._Lock = threading.Lock()
+
+    def Open(self):
+        """Connect to the workers.
+
+        Workers that cannot be reached are reported and skipped. Raises
+        WorkerError if no worker can be reached.
+
+        """
+        self.Close()
+
+        for address in self.Addresses:
+            try:
+                connection = _Connection(address, self._Secret)
+            except (OSError, WorkerError) as e:
+                sys.stdout.write('Could not connect to worker %s:%d: %s\n' %
+                                 (address[0], address[1], e))
+                continue
+
+            connections = [connection]
+            try:
+                for i in range(1, connection.Slots):
+                    connections.append(_Connection(address, self._Secret))
+            except (OSError, WorkerError) as e:
+                sys.stdout.write('Could only open %d connections to worker %s:%d: %s\n' %
+                                 (len(connections), address[0], address[1], e))
+
+            for connection in connections:
+                self._Connections.append(connection)
+                self._Idle.put(connection)
+
+        self.Slots = len(self._Connections)
+        if (self.Slots == 0):
+            raise WorkerError('No workers available')
+
+    def Close(self):
+        """Close the connections to the workers.
+
+        """
+        with self._Lock:
+            for connection in self._Connections:
+                connection.Close()
+            self._Connections = []
+            self.Slots = 0
+            self._Idle = queue.Queue()
+
+    def Execute(self, step, args):
+        """Run the command of a CLIWorkflowStep on an idle worker.
+
+        Waits for a worker to be available. Returns a tuple of the
+        return code, the wall time, the ResourceUsage of the command
+        or None, and a dictionary mapping the paths of the output
+        files to a tuple of their digest and of their stat identity as
+        seen by the worker.
+
+        """
+        request = {
+            'type': 'execute',
+            'step': step.Name,
+            'args': args,
+            'cwd': os.getcwd(),
+            'outputs': step.OutputFiles,
+            'environment': step._GetTrackedEnvironment(),
+            'algorithm': step._GetHashAlgorithm(),
+            'nice': step.Nice,
+            'affinity': step.Affinity,
+        }
+
+        # The worker writes the log of the command where the coordinator
+        # expects it
+        logCapture = step._GetLogCapture()
+        if (logCapture is not None):
+            request['log'] = {'fileName': os.path.abspath(logCapture.GetLogFileName(step.Name)),
+                              'maxSize': logCapture.MaxSize}
+
+        connection = self._Acquire()
+        try:
+            result = connection.Request(request)
+        except (OSError, ValueError, WorkerError) as e:
+            # Do not use this connection again
+            self._Drop(connection)
+            raise WorkerError('Lost connection to worker %s:%d: %s' %
+                              (connection.Address[0], connection.Address[1], e))
+        self._Idle.put(connection)
+
+        if ('error' in result):
+            raise WorkerError(result['error'])
+
+        usage = None
+        if (result.get('usage') is not None):
+            usage = ResourceUsage(*result['usage'])
+
+        hashes = dict((path, (digest, tuple(statIdentity)))
+                      for path, (digest, statIdentity) in result['hashes'].items())
+
+        return (result['returnCode'], result['wallTime'], usage, hashes)
+
+    def _Acquire(self):
+        while True:
+            with self._Lock:
+                if (len(self._Connections) == 0):
+                    raise WorkerError('No workers available')
+            try:
+                # Wake up now and then in case all workers were lost
+                return self._Idle.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+    def _Drop(self, connection):
+        connection.Close()
+        with self._Lock:
+            if (connection in self._Connections):
+                self._Connections.remove(connection)
+
+class _Connection(object):
+    """Connection to a worker.
+
+    """
+    def __init__(self, address, secret):
+        self.Address = address
+        self._Socket = socket.create_connection(address)
+        self._Socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._File = self._Socket.makefile('rwb')
+
+        challenge = _Receive(self._File)
+        if (challenge is None or challenge.get('type') != 'challenge'):
+            self.Close()
+            raise WorkerError('Unexpected greeting')
+
+        welcome = self.Request({'type': 'hello',
+                                'response': _ComputeResponse(secret, challenge.get('nonce', ''))})
+        if (welcome.get('type') != 'welcome'):
+            self.Close()
+            raise WorkerError(welcome.get('error', 'Unexpected reply'))
+        self.Slots = max(1, int(welcome.get('slots', 1)))
+
+    def Request(self, message):
+        _Send(self._File, message)
+        reply = _Receive(self._File)
+        if (reply is None):
+            raise WorkerError('Connection closed')
+
+        return reply
+
+    def Close(self):
+        try:
+            self._File.close()
+            self._Socket.close()
+        except OSError:
+            pass
+
+
+#############################################################################
+def _GetSecret(secret):
+    """Get the secret shared by the coordinator and the workers, from the
+    environment if it is not given.
+
+    """
+    if (secret is None):
+        secret = os.environ.get(SecretVariable)
+    if (not secret):
+        raise ValueError('A secret shared by the coordinator and the workers is required. '
+                         'Set it in %s.' % SecretVariable)
+
+    return secret
+
+def _ComputeResponse(secret, nonce):
+    """Compute the response to the challenge of a worker.
+
+    """
+    return hmac.new(secret.encode('utf-8'), ('steady-worker:' + nonce).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+def _ParseAddress(address):
+    if (isinstance(address, tuple)):
+        return address
+
+    host, separator, port = address.rpartition(':')
+    if (not separator):
+        return (address, DefaultPort)
+
+    return (host, int(port))
+
+def _Send(f, message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+def _Receive(f):
+    """Read one message, or return None at the end of the stream.
+
+    """
+    line = f.readline()
+    if (not line):
+        return None
+
+    return json.loads(line.decode('utf-8'))
+
+
+#############################################################################
+def main():
+    parser = argparse.ArgumentParser(description='Run a steady worker.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on. Use 0.0.0.0 to accept remote coordinators.')
+    parser.add_argument('--port', type=int, default=DefaultPort, help='Port to listen on.')
+    parser.add_argument('--slots', type=int, default=None,
+                        help='Number of steps run at the same time. Defaults to the number of CPUs.')
+    args = parser.parse_args()
+
+    try:
+        worker = Worker(args.host, args.port, args.slots)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        worker.Serve()
+    except KeyboardInterrupt:
+        pass
+
+
+#############################################################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Hashing of files and directories with bounded memory use.
+
+Files are read in binary mode in fixed-size chunks. Large regular
+files are memory-mapped and fed to the hash directly from the page
+cache, so no copy of the file contents is made in the Python heap.
+
+Directories are hashed as a tree of per-file hashes, so that only the
+files that changed since the tree was last computed need to be read.
+
+Files are hashed with SHA256 by default. BLAKE2b is faster on most
+processors, and the sampled algorithm only reads the size and a few
+blocks of a file, which is meant for large inputs that are never
+modified in place. Digests from algorithms other than SHA256 are
+prefixed with the name of the algorithm, e.g., 'blake2b:...', so
+digests computed with different algorithms never compare equal.
+
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import threading
+import time
+
+"""Size of the chunks fed to the hash."""
+ChunkSize = 1024 * 1024
+
+"""Regular files at least this large are memory-mapped."""
+MMapThreshold = 64 * 1024 * 1024
+
+"""Files modified less than this many seconds before their stat is
+recorded may be modified again without a visible change in mtime, so
+their stat is not trusted."""
+RacyStatWindow = 2.0
+
+"""Names of the supported hash algorithms."""
+Algorithms = ('sha256', 'blake2b', 'sampled')
+
+"""Size of the blocks read by the sampled algorithm."""
+SampleSize = 64 * 1024
+
+"""Number of blocks read between the first and last blocks of a file by
+the sampled algorithm."""
+SampleCount = 16
+
+
+def UpdateHashFromFile(m, path):
+    """Feed the contents of a file to a hash object.
+
+    :param m: Hash object from hashlib.
+    :param path: Path of the file to read.
+
+    Returns the number of bytes hashed.
+
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if (size >= MMapThreshold):
+            try:
+                return _UpdateHashFromMMap(m, f, size)
+            except (ValueError, OSError):
+                # Fall back to reading if the file cannot be mapped
+                f.seek(0)
+
+        return _UpdateHashFromReads(m, f)
+
+def _UpdateHashFromMMap(m, f, size):
+    """Feed a file to a hash object through a read-only memory map.
+
+    """
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if (hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL')):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        view = memoryview(mapped)
+        try:
+            length = len(view)
+            for offset in range(0, length, ChunkSize):
+                m.update(view[offset:offset + ChunkSize])
+        finally:
+            view.release()
+    finally:
+        mapped.close()
+
+    return length
+
+def _UpdateHashFromReads(m, f):
+    """Feed a file to a hash object by reading it into a reused buffer.
+
+    """
+    buf = bytearray(ChunkSize)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        n = f.readinto(buf)
+        if (not n):
+            break
+        m.update(view[:n])
+        total += n
+
+    return total
+
+def _UpdateHashFromSamples(m, path):
+    """Feed the size of a file and blocks at its start, its end and evenly
+    spaced in between to a hash object.
+
+    Small files are read completely.
+
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        m.update(struct.pack('<Q', size))
+        if (size <= (SampleCount + 2) * SampleSize):
+            _UpdateHashFromReads(m, f)
+            return
+
+        last = size - SampleSize
+        for i in range(SampleCount + 2):
+            f.seek(last * i // (SampleCount + 1))
+            m.update(f.read(SampleSize))
+
+def ComputeSHA256(path):
+    """Compute the SHA256 for a given path.
+
+    :param path: This parameter may be a directory or file. If it
+    is a directory, the SHA256 is the root of the hash tree of the
+    files in the directory hierarchy starting at this path (see
+    ComputeTreeSHA256). If it is a file, it is the SHA256 of the
+    contents of the file.
+
+    """
+    return ComputeDigest(path, 'sha256')
+
+def ComputeDigest(path, algorithm='sha256'):
+    """Compute the digest of a path with one of the Algorithms.
+
+    Like ComputeSHA256, directories are hashed as a tree of the files
+    in them. Returns a digest formatted by FormatDigest.
+
+    """
+    if os.path.isdir(path):
+        return ComputeTreeSHA256(path, algorithm=algorithm)[0]
+
+    if (algorithm == 'sampled'):
+        m = hashlib.blake2b(digest_size=32)
+        if os.path.isfile(path):
+            _UpdateHashFromSamples(m, path)
+    else:
+        m = _NewHash(algorithm)
+        if os.path.isfile(path):
+            UpdateHashFromFile(m, path)
+
+    return FormatDigest(algorithm, m.hexdigest())
+
+def _NewHash(algorithm):
+    if (algorithm == 'sha256'):
+        return hashlib.sha256()
+    elif (algorithm == 'blake2b'):
+        return hashlib.blake2b(digest_size=32)
+
+    raise ValueError('Unknown hash algorithm "%s".' % algorithm)
+
+def FormatDigest(algorithm, hexdigest):
+    """Format a digest so that it identifies its algorithm. SHA256 digests
+    are left as they are, for compatibility with existing caches.
+
+    """
+    if (algorithm == 'sha256'):
+        return hexdigest
+
+    return algorithm + ':' + hexdigest
+
+def DigestAlgorithm(digest):
+    """Get the algorithm of a digest formatted by FormatDigest.
+
+    """
+    if (':' in digest):
+        return digest.split(':', 1)[0]
+
+    return 'sha256'
+
+def CheckAlgorithm(algorithm):
+    """Raise ValueError if an algorithm is not one of the Algorithms.
+
+    """
+    if (algorithm not in Algorithms):
+        raise ValueError('Unknown hash algorithm "%s". Use one of %s.' %
+                         (algorithm, ', '.join(Algorithms)))
+
+def ScanDirectory(path):
+    """Find the regular files in a directory hierarchy.
+
+    The hierarchy is enumerated with os.scandir. Symbolic links to
+    files are followed, symbolic links to directories are not.
+
+    Returns a dictionary mapping the '/'-separated path of each file
+    relative to the directory to a tuple of the full path and the
+    stat identity of the file.
+
+    """
+    files = {}
+    stack = [(path, '')]
+    while (len(stack) > 0):
+        directory, prefix = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+
+        for entry in entries:
+            try:
+                if (entry.is_dir(follow_symlinks=False)):
+                    stack.append((entry.path, prefix + entry.name + '/'))
+                elif (entry.is_file()):
+                    files[prefix + entry.name] = (entry.path, _StatToIdentity(entry.stat()))
+            except OSError:
+                # The entry disappeared or is a broken link
+                continue
+
+    return files
+
+def ComputeTreeSHA256(path, previousTree=None, hashFile=None, algorithm='sha256'):
+    """Compute the hash tree of a directory hierarchy.
+
+    The tree maps the relative path of each file to its SHA256 and
+    its stat identity. The root hash combines the relative paths and
+    hashes of all files, so renaming a file changes the root hash.
+
+    :param path: Directory to hash.
+    :param previousTree: Tree computed earlier for the same
+    directory. Files whose stat identity is unchanged since then are
+    not hashed again.
+    :param hashFile: Function called with the path and stat identity
+    of a file to compute its digest. Defaults to ComputeDigest.
+    :param algorithm: Algorithm of the digests of the files. The root
+    is always combined with SHA256, but formatted as a digest of this
+    algorithm.
+
+    Returns a tuple of the root digest and the tree.
+
+    """
+    if (previousTree is None):
+        previousTree = {}
+    if (hashFile is None):
+        hashFile = lambda filePath, statIdentity: ComputeDigest(filePath, algorithm)
+
+    tree = {}
+    for relativePath, (filePath, statIdentity) in ScanDirectory(path).items():
+        previous = previousTree.get(relativePath)
+        if (previous is not None and previous[1] is not None and
+            tuple(previous[1]) == statIdentity):
+            tree[relativePath] = previous
+            continue
+
+        digest = hashFile(filePath, statIdentity)
+
+        # Only record the stat if it can be trusted next time
+        recordedStat = None
+        if (IsCacheableStat(statIdentity) and statIdentity == StatIdentity(filePath)):
+            recordedStat = list(statIdentity)
+        tree[relativePath] = [digest, recordedStat]
+
+    return (FormatDigest(algorithm, TreeSHA256(tree)), tree)
+
+def TreeSHA256(tree):
+    """Compute the root SHA256 of a hash tree from ComputeTreeSHA256.
+
+    """
+    m = hashlib.sha256()
+    for relativePath in sorted(tree):
+        m.update(relativePath.encode('utf-8', 'surrogateescape'))
+        m.update(b'\0')
+        m.update(tree[relativePath][0].encode('ascii'))
+        m.update(b'\n')
+
+    return m.hexdigest()
+
+#############################################################################
+def StatIdentity(path):
+    """Get the (size, mtime_ns, inode, device) tuple for a regular file, or
+    None if the path is not a regular file.
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if (not stat.S_ISREG(st.st_mode)):
+        return None
+
+    return _StatToIdentity(st)
+
+def _StatToIdentity(st):
+    """Get the stat identity tuple from the result of a stat call.
+
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+def IsCacheableStat(statIdentity):
+    """Returns True if a stat identity can be recorded in the cache and
+    trusted later on.
+
+    """
+    if (statIdentity is None):
+        return False
+
+    mtime = statIdentity[1] / 1e9
+    return time.time() - mtime > RacyStatWindow
+
+
+#############################################################################
+def ResolveExecutable(executable):
+    """Find the path of an executable.
+
+    Names without a directory part are looked up in the PATH like the
+    shell does. Returns None if the executable is not found.
+
+    """
+    if (os.path.dirname(executable)):
+        return executable
+
+    return shutil.which(executable)
+
+def SharedLibraries(path):
+    """List the shared libraries loaded by an executable.
+
+    The libraries are found with ldd, which may run the executable's
+    dynamic loader, so this should only be used on trusted
+    executables. Returns an empty list if the libraries cannot be
+    determined, e.g., for scripts or on platforms without ldd.
+
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['ldd', path], stderr=devnull,
+                                             universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    libraries = set()
+    for line in output.splitlines():
+        parts = line.split()
+        if ('=>' in parts):
+            index = parts.index('=>')
+            if (index + 1 < len(parts) and parts[index + 1].startswith('/')):
+                libraries.add(parts[index + 1])
+        elif (len(parts) > 0 and parts[0].startswith('/')):
+            libraries.add(parts[0])
+
+    return sorted(libraries)
+
+
+#############################################################################
+class HashMemo(object):
+    """Memo of file hashes computed during one run of a workflow.
+
+    The hash of each path is stored along with the stat identity of
+    the file when it was hashed, so a file that changes during the run
+    is hashed again. Paths written by a workflow step should be
+    invalidated explicitly, since a rewrite may leave the stat identity
+    unchanged.
+
+    """
+    def __init__(self):
+        # Map paths to their stat identity and a dictionary of their
+        # digests by algorithm
+        self._Hashes = {}
+        self._Lock = threading.Lock()
+
+    def Get(self, path, statIdentity, algorithm='sha256'):
+        """Get the memoized hash of a file, or None if it is not known for
+        the given stat identity and algorithm.
+
+        """
+        if (statIdentity is None):
+            return None
+
+        with self._Lock:
+            memoized = self._Hashes.get(path)
+
+        if (memoized is None or memoized[0] != statIdentity):
+            return None
+
+        return memoized[1].get(algorithm)
+
+    def Set(self, path, statIdentity, digest, algorithm='sha256'):
+        """Memoize the hash of a file with the given stat identity.
+
+        """
+        if (statIdentity is None):
+            return
+
+        with self._Lock:
+            memoized = self._Hashes.get(path)
+            if (memoized is None or memoized[0] != statIdentity):
+                memoized = (statIdentity, {})
+                self._Hashes[path] = memoized
+            memoized[1][algorithm] = digest
+
+    def Invalidate(self, paths):
+        """Forget the memoized hashes of the given paths.
+
+        """
+        with self._Lock:
+            for path in paths:
+                self._Hashes.pop(path, None)
+
+    def InvalidateTree(self, directory):
+        """Forget the memoized hashes of all files under a directory.
+
+        """
+        prefix = os.path.join(directory, '')
+        with self._Lock:
+            for path in [path for path in self._Hashes if path.startswith(prefix)]:
+                del self._Hashes[path]
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Measurements of where the time of a workflow run goes.
+
+An Instrumentation object set on a Workflow records, for each step
+that is checked during a run, the time spent checking whether it is
+up-to-date, the number of bytes hashed and the time spent hashing
+them, and, if the step is executed, the wall time of its command and
+the CPU time and peak memory use of the child process. The records
+can be exported as JSON or in the Chrome trace event format, which
+can be loaded in chrome://tracing or Perfetto.
+
+Records are kept per step object, so steps with the same name do not
+mix their measurements. In the trace, each step is shown on the track
+of the thread that started checking it. Steps checked at the same time
+from one thread, as with Workflow.ExecuteAsync() where all steps are
+checked from the thread of the event loop, are spread on several
+tracks of that thread so that they do not overlap.
+
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+#############################################################################
+class StepRecord(object):
+    """Measurements for one step in one run of a workflow.
+
+    Times are in seconds, and start times are relative to the creation
+    of the Instrumentation. MaxRSS is in bytes. The measurements of the
+    child process are None if the step was not executed or if they are
+    not available. Thread is the number of the track of the step in the
+    trace.
+
+    """
+    def __init__(self, name, start, thread):
+        self.Name = name
+        self.Thread = thread
+        self.CheckStart = start
+        self.CheckTime = 0.0
+        self.BytesHashed = 0
+        self.FilesHashed = 0
+        self.HashTime = 0.0
+        self.ExecuteStart = None
+        self.WallTime = None
+        self.UserTime = None
+        self.SystemTime = None
+        self.MaxRSS = None
+        self.ReturnCode = None
+        self.Status = None
+
+    def ToDict(self):
+        """Get the measurements as a dictionary.
+
+        """
+        return {
+            'name': self.Name,
+            'status': self.Status,
+            'checkStart': self.CheckStart,
+            'checkTime': self.CheckTime,
+            'bytesHashed': self.BytesHashed,
+            'filesHashed': self.FilesHashed,
+            'hashTime': self.HashTime,
+            'executeStart': self.ExecuteStart,
+            'wallTime': self.WallTime,
+            'userTime': self.UserTime,
+            'systemTime': self.SystemTime,
+            'maxRSS': self.MaxRSS,
+            'returnCode': self.ReturnCode,
+        }
+
+
+#############################################################################
+class Instrumentation(object):
+    """Collects StepRecords during workflow runs and calls hooks when steps
+    start and finish.
+
+    """
+    def __init__(self):
+        self.Records = []
+        self._Origin = time.time()
+        self._Current = {}
+        self._StartHooks = []
+        self._FinishHooks = []
+        self._Tracks = {}
+        self._BusyTracks = {}
+        self._Lock = threading.Lock()
+
+    def AddStartHook(self, hook):
+        """Add a function called with the step when a step starts to be
+        checked.
+
+        """
+        self._StartHooks.append(hook)
+
+    def AddFinishHook(self, hook):
+        """Add a function called with the step and its StepRecord when a
+        step is finished, whether it was up-to-date, executed or failed.
+
+        """
+        self._FinishHooks.append(hook)
+
+    def Now(self):
+        """Get the time in seconds since the creation of this object.
+
+        """
+        return time.time() - self._Origin
+
+    def StartStep(self, step):
+        """Start the record of a step.
+
+        """
+        thread = threading.current_thread().ident
+        with self._Lock:
+            # Use the first track of the thread that is not used by a
+            # step being checked or executed, and number the tracks in
+            # the order they are seen
+            lane = 0
+            while ((thread, lane) in self._BusyTracks.values()):
+                lane += 1
+            track = self._Tracks.setdefault((thread, lane), len(self._Tracks) + 1)
+            record = StepRecord(step.Name, self.Now(), track)
+            self._Current[id(step)] = record
+            self._BusyTracks[id(step)] = (thread, lane)
+            self.Records.append(record)
+
+        for hook in self._StartHooks:
+            hook(step)
+
+        return record
+
+    def FinishStep(self, step, status):
+        """Finish the record of a step.
+
+        :param status: One of 'up-to-date', 'executed', 'dry-run' or
+        'failed'.
+
+        """
+        with self._Lock:
+            record = self._Current.pop(id(step), None)
+            self._BusyTracks.pop(id(step), None)
+        if (record is None):
+            return
+
+        record.Status = status
+        if (record.ExecuteStart is None):
+            record.CheckTime = self.Now() - record.CheckStart
+
+        for hook in self._FinishHooks:
+            hook(step, record)
+
+    def StartExecution(self, step):
+        """Mark the end of the check of a step and the start of its
+        execution.
+
+        """
+        record = self.GetRecord(step)
+        if (record is not None):
+            record.ExecuteStart = self.Now()
+            record.CheckTime = record.ExecuteStart - record.CheckStart
+
+    def FinishProcess(self, step, wallTime, returnCode, usage=None):
+        """Record the measurements of the child process of a step.
+
+        :param wallTime: Wall time of the process in seconds.
+        :param returnCode: Return code of the process.
+        :param usage: Resource usage of the child process as returned
+        by os.wait4(), if available.
+
+        """
+        record = self.GetRecord(step)
+        if (record is None):
+            return
+
+        record.WallTime = wallTime
+        record.ReturnCode = returnCode
+        if (usage is not None):
+            record.UserTime = usage.ru_utime
+            record.SystemTime = usage.ru_stime
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            record.MaxRSS = usage.ru_maxrss
+            if (not sys.platform.startswith('darwin')):
+                record.MaxRSS *= 1024
+
+    def GetRecord(self, step):
+        """Get the record of a step that is being checked or executed, or
+        None.
+
+        """
+        with self._Lock:
+            return self._Current.get(id(step))
+
+    def AddHash(self, step, byteCount, seconds):
+        """Account for a file hashed for a step.
+
+        """
+        with self._Lock:
+            record = self._Current.get(id(step))
+            if (record is not None):
+                record.BytesHashed += byteCount
+                record.FilesHashed += 1
+                record.HashTime += seconds
+
+    def ToJSON(self):
+        """Get the records and their totals as a JSON string.
+
+        """
+        totals = {
+            'checkTime': sum(r.CheckTime for r in self.Records),
+            'bytesHashed': sum(r.BytesHashed for r in self.Records),
+            'hashTime': sum(r.HashTime for r in self.Records),
+            'wallTime': sum(r.WallTime or 0.0 for r in self.Records),
+            'userTime': sum(r.UserTime or 0.0 for r in self.Records),
+            'systemTime': sum(r.SystemTime or 0.0 for r in self.Records),
+        }
+        return json.dumps({'steps': [r.ToDict() for r in self.Records], 'totals': totals},
+                          indent=2, sort_keys=True)
+
+    def WriteJSON(self, fileName):
+        """Write the records and their totals to a JSON file.
+
+        """
+        with open(fileName, 'w') as f:
+            f.write(self.ToJSON())
+
+    def ToChromeTrace(self):
+        """Get the records in the Chrome trace event format.
+
+        Each step gets a 'check' event and, if it was executed, an
+        'execute' event on its track.
+
+        """
+        pid = os.getpid()
+        events = []
+        for record in self.Records:
+            events.append({
+                'name': record.Name,
+                'cat': 'check',
+                'ph': 'X',
+                'ts': record.CheckStart * 1e6,
+                'dur': record.CheckTime * 1e6,
+                'pid': pid,
+                'tid': record.Thread,
+                'args': {
+                    'bytesHashed': record.BytesHashed,
+                    'filesHashed': record.FilesHashed,
+                    'hashTime': record.HashTime,
+                    'status': record.Status,
+                },
+            })
+            if (record.ExecuteStart is not None and record.WallTime is not None):
+                events.append({
+                    'name': record.Name,
+                    'cat': 'execute',
+                    'ph': 'X',
+                    'ts': record.ExecuteStart * 1e6,
+                    'dur': record.WallTime * 1e6,
+                    'pid': pid,
+                    'tid': record.Thread,
+                    'args': {
+                        'userTime': record.UserTime,
+                        'systemTime': record.SystemTime,
+                        'maxRSS': record.MaxRSS,
+                        'returnCode': record.ReturnCode,
+                    },
+                })
+
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+    def WriteChromeTrace(self, fileName):
+        """Write the records to a file in the Chrome trace event format.
+
+        """
+        with open(fileName, 'w') as f:
+            f.write(self.ToChromeTrace())
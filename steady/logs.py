@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Capture of the output of workflow step commands in log files.
+
+When a LogCapture is set on a workflow, the standard output and error
+of each executed command are written to a log file of its step instead
+of the console, so that the output of steps running in parallel does
+not interleave. The console only shows which steps execute and, when
+a step fails, the last lines of its log.
+
+A log can be capped in size. The beginning of the output is kept up
+to the cap, and the end of the output is appended after a note of how
+much was dropped, so that the messages explaining a failure are kept.
+
+"""
+
+import hashlib
+import io
+import os
+import re
+import sys
+
+"""Size of the reads from the pipes of the commands."""
+ReadSize = 64 * 1024
+
+"""Maximum number of bytes kept from the end of a capped log."""
+TailSize = 64 * 1024
+
+
+#############################################################################
+class LogCapture(object):
+    """Writes the output of the commands of workflow steps to one log file
+    per step.
+
+    :param directory: Directory of the log files. It is created if
+    needed.
+    :param maxSize: Maximum size in bytes of each log file, or None
+    for no limit.
+    :param tailLines: Number of lines from the end of the log of a
+    failed step that are shown on the console.
+
+    """
+    def __init__(self, directory, maxSize=None, tailLines=20):
+        self.Directory = directory
+        self.MaxSize = maxSize
+        self.TailLines = tailLines
+
+    def GetLogFileName(self, stepName):
+        """Get the path of the log file of a step.
+
+        The characters of the name that are not safe in file names are
+        replaced, and a short hash of the name is appended so that
+        names that only differ by those characters, e.g., "a/b" and
+        "a_b", do not share a log.
+
+        """
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', stepName)
+        suffix = hashlib.sha256(stepName.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.Directory, '%s-%s.log' % (name, suffix))
+
+    def Open(self, stepName):
+        """Start the log of a step, replacing its log from an earlier
+        execution.
+
+        """
+        return StepLog(self.GetLogFileName(stepName), self.MaxSize)
+
+    def ReportFailure(self, stepName):
+        """Show the end of the log of a failed step on the console.
+
+        """
+        fileName = self.GetLogFileName(stepName)
+        lines = ReadTail(fileName, self.TailLines)
+        if (len(lines) == 0):
+            sys.stdout.write('The log of "%s" is empty: %s\n' % (stepName, fileName))
+            return
+
+        sys.stdout.write('Last lines of the log of "%s" (%s):\n' % (stepName, fileName))
+        for line in lines:
+            sys.stdout.write('  | %s\n' % line)
+        sys.stdout.flush()
+
+
+#############################################################################
+class StepLog(object):
+    """Log file of one execution of a step.
+
+    Data is written through a buffered file. Once the log reaches its
+    maximum size, the rest of the output is read and dropped except
+    for its last TailSize bytes, which are written when the log is
+    closed.
+
+    """
+    def __init__(self, fileName, maxSize=None):
+        self.FileName = fileName
+        self.MaxSize = maxSize
+        self._Written = 0
+        self._Dropped = 0
+        self._Tail = bytearray()
+
+        directory = os.path.dirname(os.path.abspath(fileName))
+        if (not os.path.isdir(directory)):
+            os.makedirs(directory, exist_ok=True)
+        self._File = open(fileName, 'wb')
+
+        self._HeadSize = None
+        if (maxSize is not None):
+            self._HeadSize = max(0, maxSize - min(TailSize, maxSize // 2))
+
+    def Write(self, data):
+        """Append output of the command to the log.
+
+        """
+        if (self._HeadSize is not None and self._Written + len(data) > self._HeadSize):
+            room = max(0, self._HeadSize - self._Written)
+            if (room > 0):
+                self._File.write(data[:room])
+                self._Written += room
+                data = data[room:]
+
+            self._Tail += data
+            excess = len(self._Tail) - (self.MaxSize - self._HeadSize)
+            if (excess > 0):
+                del self._Tail[:excess]
+                self._Dropped += excess
+            return
+
+        self._File.write(data)
+        self._Written += len(data)
+
+    def ReadFrom(self, pipe):
+        """Copy the output of a command from a pipe to the log until the
+        command closes it.
+
+        The reads are as large as what is available in the pipe, up to
+        ReadSize, so the command is never held up by a full pipe.
+
+        """
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, ReadSize)
+            if (not data):
+                break
+            self.Write(data)
+
+    def Close(self):
+        """Write the end of a capped log and close the file.
+
+        """
+        if (self._Dropped > 0):
+            self._File.write(b'\n[steady: %d bytes of output were dropped]\n' % self._Dropped)
+        self._File.write(bytes(self._Tail))
+        self._Tail = bytearray()
+        self._File.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Close()
+
+
+#############################################################################
+class TextStream(io.TextIOBase):
+    """Text file object writing to a StepLog, to redirect sys.stdout and
+    sys.stderr of Python code to it.
+
+    """
+    def __init__(self, log):
+        super(TextStream, self).__init__()
+        self._Log = log
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._Log.Write(text.encode('utf-8', 'replace'))
+        return len(text)
+
+
+#############################################################################
+def ReadTail(fileName, lineCount):
+    """Get the last lines of a text file, or an empty list if it cannot be
+    read.
+
+    """
+    if (lineCount <= 0):
+        return []
+
+    try:
+        with open(fileName, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - TailSize))
+            data = f.read()
+    except (IOError, OSError):
+        return []
+
+    lines = data.decode('utf-8', 'replace').splitlines()
+    return lines[-lineCount:]
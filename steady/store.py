@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Content-addressable store of workflow step outputs.
+
+After a workflow step executes, its output files are copied into the
+store under their SHA256, and a record maps the signature of the step
+(the hashes of its executable and inputs, and its arguments) to the
+hashes of its outputs. When a step with the same signature needs to
+be executed again, its outputs are restored from the store instead.
+
+Files are placed with reflinks where the file system supports them,
+so that storing and restoring does not copy data. Otherwise, files
+are copied, or hard-linked if the store allows it.
+
+"""
+
+import errno
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+from steady import hashing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""ioctl request to clone a file on Linux (FICLONE)."""
+_FICLONE = 0x40049409
+
+
+#############################################################################
+class ArtifactStore(object):
+    """Local content-addressable store of workflow step outputs.
+
+    :param directory: Directory of the store. It should be on the same
+    file system as the outputs for reflinks and hard links to work.
+    :param maxSize: Maximum total size in bytes of the stored files.
+    When exceeded, the least recently used files are evicted. None
+    means no limit.
+    :param hardlinks: If True, outputs are restored as hard links to
+    the stored files when reflinks are not supported. Stored files are
+    then made read-only, and workflow steps remove outputs linked to
+    the store before executing so that the stored files are not
+    overwritten in place.
+
+    """
+    def __init__(self, directory, maxSize=None, hardlinks=False):
+        self.Directory = directory
+        self.MaxSize = maxSize
+        self.Hardlinks = hardlinks
+        self._ObjectsDirectory = os.path.join(directory, 'objects')
+        self._SignaturesDirectory = os.path.join(directory, 'signatures')
+
+    def Lookup(self, signature):
+        """Get the outputs recorded for a step signature.
+
+        Returns a list of dictionaries with the 'path' and 'sha256' of
+        each output, and its 'tree' if it is a directory, or None if
+        the signature is not in the store.
+
+        """
+        try:
+            with open(self._SignatureFileName(signature), 'r') as f:
+                return json.load(f)['outputs']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def Save(self, signature, outputs):
+        """Store the outputs of a step under its signature.
+
+        :param signature: Signature of the step.
+        :param outputs: List of dictionaries with the 'path' and
+        'sha256' of each output, and its 'tree' if it is a directory,
+        as computed right after the step executed.
+
+        """
+        for output in outputs:
+            if ('tree' in output):
+                for relativePath, (digest, statIdentity) in output['tree'].items():
+                    self._SaveObject(os.path.join(output['path'], *relativePath.split('/')), digest)
+            else:
+                self._SaveObject(output['path'], output['sha256'])
+
+        fileName = self._SignatureFileName(signature)
+        _WriteAtomically(fileName, json.dumps({'outputs': outputs}, sort_keys=True))
+
+    def Restore(self, outputs):
+        """Restore outputs looked up in the store.
+
+        Returns False if any of the stored files is missing, e.g.,
+        because it was evicted, in which case nothing is restored.
+
+        """
+        objects = []
+        for output in outputs:
+            if ('tree' in output):
+                for digest, statIdentity in output['tree'].values():
+                    objects.append(digest)
+            else:
+                objects.append(output['sha256'])
+
+        for digest in objects:
+            if (not os.path.isfile(self._ObjectFileName(digest))):
+                return False
+
+        for output in outputs:
+            path = output['path']
+            _RemovePath(path)
+            if ('tree' in output):
+                os.makedirs(path)
+                for relativePath, (digest, statIdentity) in output['tree'].items():
+                    self._RestoreObject(digest, os.path.join(path, *relativePath.split('/')))
+            else:
+                self._RestoreObject(output['sha256'], path)
+
+        return True
+
+    def IsLinked(self, path, digest=None, algorithm='sha256'):
+        """Returns True if a file is a hard link to a file in the store.
+
+        The file must be the stored object of its digest, so that other
+        hard links of the user are not mistaken for links to the store.
+
+        :param digest: Digest recorded for the file. If None, the
+        digest is computed with the algorithm, which is only done for
+        files with several links.
+
+        """
+        if (not self.Hardlinks):
+            return False
+
+        try:
+            st = os.stat(path)
+            if (not stat.S_ISREG(st.st_mode) or st.st_nlink < 2):
+                return False
+            if (digest is None):
+                digest = hashing.ComputeDigest(path, algorithm)
+            objectStat = os.stat(self._ObjectFileName(digest))
+        except OSError:
+            return False
+
+        return (st.st_ino, st.st_dev) == (objectStat.st_ino, objectStat.st_dev)
+
+    def Evict(self):
+        """Remove the least recently used files until the total size of the
+        store is below MaxSize.
+
+        Returns the number of bytes removed.
+
+        """
+        if (self.MaxSize is None):
+            return 0
+
+        objects = []
+        total = 0
+        for root, dirs, files in os.walk(self._ObjectsDirectory):
+            for fileName in files:
+                if (fileName.startswith('.tmp-')):
+                    continue
+                filePath = os.path.join(root, fileName)
+                try:
+                    st = os.stat(filePath)
+                except OSError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, filePath))
+                total += st.st_size
+
+        removed = 0
+        for mtime, size, filePath in sorted(objects):
+            if (total - removed <= self.MaxSize):
+                break
+            try:
+                os.remove(filePath)
+                removed += size
+            except OSError:
+                pass
+
+        return removed
+
+    def _SaveObject(self, path, digest):
+        """Copy a file into the store unless a file with the same SHA256 is
+        already stored.
+
+        """
+        objectFileName = self._ObjectFileName(digest)
+        if (os.path.isfile(objectFileName)):
+            _Touch(objectFileName)
+            return
+
+        directory = os.path.dirname(objectFileName)
+        if (not os.path.isdir(directory)):
+            os.makedirs(directory)
+
+        fd, tempFileName = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        os.close(fd)
+        try:
+            _CloneOrCopy(path, tempFileName)
+            if (self.Hardlinks):
+                os.chmod(tempFileName, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tempFileName, objectFileName)
+        except:
+            os.remove(tempFileName)
+            raise
+
+    def _RestoreObject(self, digest, path):
+        """Place a stored file at a path.
+
+        """
+        objectFileName = self._ObjectFileName(digest)
+        _Touch(objectFileName)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if (not os.path.isdir(directory)):
+            os.makedirs(directory)
+
+        try:
+            _Reflink(objectFileName, path)
+            return
+        except OSError:
+            _RemovePath(path)
+
+        if (self.Hardlinks):
+            try:
+                os.link(objectFileName, path)
+                return
+            except OSError:
+                pass
+
+        shutil.copyfile(objectFileName, path)
+
+    def _ObjectFileName(self, digest):
+        # Digests other than SHA256 are prefixed with their algorithm and
+        # a colon, which is not allowed in file names everywhere
+        digest = digest.replace(':', '-')
+        return os.path.join(self._ObjectsDirectory, digest[:2], digest)
+
+    def _SignatureFileName(self, signature):
+        return os.path.join(self._SignaturesDirectory, signature[:2], signature + '.json')
+
+
+#############################################################################
+def _Reflink(source, destination):
+    """Clone a file with the FICLONE ioctl. Raises OSError if the file system
+    does not support it.
+
+    """
+    if (fcntl is None or not sys.platform.startswith('linux')):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+def _CloneOrCopy(source, destination):
+    """Clone a file if possible, or copy it otherwise.
+
+    """
+    try:
+        _Reflink(source, destination)
+    except (OSError, IOError):
+        shutil.copyfile(source, destination)
+
+def _RemovePath(path):
+    """Remove a file or directory hierarchy if it exists.
+
+    """
+    if (os.path.isdir(path) and not os.path.islink(path)):
+        shutil.rmtree(path)
+    elif (os.path.lexists(path)):
+        os.remove(path)
+
+def _Touch(path):
+    """Mark a stored file as recently used.
+
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def _WriteAtomically(fileName, content):
+    """Write a file through a temporary file and a rename.
+
+    """
+    directory = os.path.dirname(fileName)
+    if (not os.path.isdir(directory)):
+        os.makedirs(directory)
+
+    fd, tempFileName = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tempFileName, fileName)
+    except:
+        os.remove(tempFileName)
+        raise
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Notification of changes to the files a workflow reads.
+
+On Linux, changes are reported by inotify, which is used through
+ctypes so that no extra package is needed. Elsewhere, or if inotify
+cannot be set up, the files are polled instead.
+
+Watched paths are absolute and normalized. A watched directory is
+reported as changed when any file in its hierarchy changes.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from steady import hashing
+
+"""inotify event masks from <sys/inotify.h>."""
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WatchMask = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+              _IN_CREATE | _IN_DELETE)
+
+"""Header of an inotify event: watch descriptor, mask, cookie and name
+length."""
+_EventHeader = struct.Struct('iIII')
+
+"""Seconds to keep collecting events after the first one, so that a
+burst of writes is reported as one change."""
+SettleTime = 0.1
+
+
+#############################################################################
+def CreateWatcher(paths, interval=1.0):
+    """Get a watcher for a list of files and directories, using inotify if
+    available and polling otherwise.
+
+    :param interval: Seconds between two polls when polling.
+
+    """
+    if (sys.platform.startswith('linux')):
+        try:
+            return InotifyWatcher(paths)
+        except OSError as e:
+            sys.stdout.write('Could not watch files with inotify (%s), polling instead.\n' % e)
+
+    return PollingWatcher(paths, interval)
+
+
+#############################################################################
+class InotifyWatcher(object):
+    """Watches files and directory hierarchies with inotify.
+
+    Files are watched through their parent directory, so that files
+    replaced by a rename, as editors do, are still seen.
+
+    """
+    def __init__(self, paths):
+        libraryName = ctypes.util.find_library('c') or 'libc.so.6'
+        self._Libc = ctypes.CDLL(libraryName, use_errno=True)
+        if (not hasattr(self._Libc, 'inotify_init1')):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self._FD = self._Libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if (self._FD < 0):
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._Files = set()
+        self._Trees = set()
+        self._Directories = {}
+        try:
+            for path in paths:
+                if (os.path.isdir(path)):
+                    self._Trees.add(path)
+                    self._WatchTree(path)
+                else:
+                    self._Files.add(path)
+                    self._Watch(os.path.dirname(path))
+        except:
+            self.Close()
+            raise
+
+    def Wait(self, timeout):
+        """Wait for watched paths to change.
+
+        Returns the set of changed paths, which is empty if nothing
+        changed before the timeout. Once a watched path changes, events
+        are collected for SettleTime more seconds. Events about paths
+        that are not watched do not delay the return.
+
+        """
+        changed = set()
+        deadline = time.time() + timeout
+        while True:
+            wait = deadline - time.time()
+            if (wait <= 0):
+                return changed
+
+            readable, writable, exceptional = select.select([self._FD], [], [], wait)
+            if (len(readable) == 0):
+                return changed
+
+            settling = len(changed) > 0
+            changed.update(self._ReadEvents())
+            if (len(changed) > 0 and not settling):
+                deadline = time.time() + SettleTime
+
+    def Close(self):
+        """Stop watching.
+
+        """
+        if (self._FD >= 0):
+            os.close(self._FD)
+            self._FD = -1
+
+    def _Watch(self, directory):
+        """Add a watch on a directory.
+
+        """
+        wd = self._Libc.inotify_add_watch(self._FD, os.fsencode(directory), _WatchMask)
+        if (wd < 0):
+            err = ctypes.get_errno()
+            if (err == errno.ENOENT):
+                sys.stdout.write('Cannot watch missing directory "%s".\n' % directory)
+                return
+            raise OSError(err, '%s: %s' % (os.strerror(err), directory))
+
+        self._Directories[wd] = directory
+
+    def _WatchTree(self, directory):
+        """Add watches on a directory and all directories below it.
+
+        """
+        self._Watch(directory)
+        for root, dirs, files in os.walk(directory):
+            for name in dirs:
+                self._Watch(os.path.join(root, name))
+
+    def _ReadEvents(self):
+        """Read the pending events and find the watched paths they concern.
+
+        """
+        try:
+            data = os.read(self._FD, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while (offset + _EventHeader.size <= len(data)):
+            wd, mask, cookie, length = _EventHeader.unpack_from(data, offset)
+            offset += _EventHeader.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if (mask & _IN_Q_OVERFLOW):
+                # Events were lost, so anything may have changed
+                changed.update(self._Files)
+                changed.update(self._Trees)
+                continue
+
+            directory = self._Directories.get(wd)
+            if (directory is None):
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            if (path in self._Files):
+                changed.add(path)
+
+            tree = self._FindTree(directory)
+            if (tree is not None):
+                changed.add(tree)
+                if (mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO)):
+                    self._WatchTree(path)
+
+        return changed
+
+    def _FindTree(self, directory):
+        """Get the watched directory hierarchy a directory belongs to, or
+        None.
+
+        """
+        while True:
+            if (directory in self._Trees):
+                return directory
+            parent = os.path.dirname(directory)
+            if (parent == directory):
+                return None
+            directory = parent
+
+
+#############################################################################
+class PollingWatcher(object):
+    """Watches files and directory hierarchies by comparing their stats
+    periodically.
+
+    """
+    def __init__(self, paths, interval=1.0):
+        self._Interval = interval
+        self._Snapshot = dict((path, _Signature(path)) for path in paths)
+
+    def Wait(self, timeout):
+        """Wait for watched paths to change.
+
+        Returns the set of changed paths, which is empty if nothing
+        changed before the timeout.
+
+        """
+        deadline = time.time() + timeout
+        while True:
+            time.sleep(max(0.0, min(self._Interval, deadline - time.time())))
+
+            changed = set()
+            for path, signature in self._Snapshot.items():
+                current = _Signature(path)
+                if (current != signature):
+                    self._Snapshot[path] = current
+                    changed.add(path)
+
+            if (len(changed) > 0 or time.time() >= deadline):
+                return changed
+
+    def Close(self):
+        pass
+
+def _Signature(path):
+    """Get what is compared to detect that a path changed.
+
+    """
+    if (os.path.isdir(path)):
+        return frozenset((relativePath, statIdentity) for relativePath, (filePath, statIdentity)
+                         in hashing.ScanDirectory(path).items())
+
+    return hashing.StatIdentity(path)
@@ -1,8 +1,27 @@
+import asyncio
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
 import glob
 import hashlib
+import heapq
+import json
+import inspect
+import math
+import multiprocessing
 import os
 import subprocess
 import sys
+import threading
+import time
+import traceback
+import types
+
+from steady import cache
+from steady import hashing
+from steady import logs
+from steady import watch
 
 ###############################################################################
 #
@@ -26,6 +45,15 @@ import sys
 ###############################################################################
 
 
+#############################################################################
+def ConcatenateArguments(argumentLists):
+    """Combine the Arguments of batched steps by concatenating them, for
+    executables that take a sequence of input and output files, e.g.,
+    'tool in1 out1 in2 out2'.
+
+    """
+    return [arg for arguments in argumentLists for arg in arguments]
+
 #############################################################################
 class WorkflowStep(object):
     """Base class for pipeline steps.
@@ -36,12 +64,62 @@ class WorkflowStep(object):
     def __init__(self, name):
         self.Name = name
 
+        # Resources used while the step executes
+        self.Cores = 1
+        self.Memory = 0
+        self.Tokens = {}
+
+        # Workflow this step belongs to, if any
+        self._Workflow = None
+
+        # CPUs assigned to the step while it executes, if the Workflow
+        # pins steps to CPUs
+        self._AssignedCPUs = None
+
+    def SetResources(self, cores=1, memory=0, tokens=None):
+        """Declare the resources the step uses while it executes.
+
+        When the Workflow has resource limits, steps only execute at
+        the same time if their resources fit within the limits.
+
+        :param cores: Number of cores used.
+        :param memory: Memory used in bytes.
+        :param tokens: Dictionary mapping names of other resources,
+        e.g., 'scratch-disk-io', to the amount used.
+
+        """
+        self.Cores = cores
+        self.Memory = memory
+        self.Tokens = dict(tokens or {})
+
+    async def ExecuteAsync(self, verbose=False):
+        """Run the pipeline step from an asyncio event loop.
+
+        By default, Execute() is called in the default executor of the
+        event loop.
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.Execute, verbose)
+
     def NeedsUpdate(self):
         """
         Indicates whether the pipeline step needs to be updated.
         """
         return False
 
+    def GetUpdateReason(self):
+        """Get why the pipeline step needs to be updated, as a short
+        sentence, or None if it is up-to-date.
+
+        By default, this is based on NeedsUpdate().
+
+        """
+        if (self.NeedsUpdate()):
+            return 'it needs to be updated'
+
+        return None
+
 #############################################################################
 class CLIWorkflowStep(WorkflowStep):
     """Workflow steps for a command-line executable invoked through a
@@ -54,6 +132,13 @@ class CLIWorkflowStep(WorkflowStep):
         self.InputFiles = inputs
         self.OutputFiles = outputs
         self.Arguments = args
+        self.Environment = []
+        self.HashAlgorithm = None
+        self.Nice = None
+        self.Affinity = None
+        self.BatchCombine = None
+        self.BatchKey = None
+        self.BatchSize = None
 
         if (len(cmd) > 0):
             self.Executable = cmd[0]
@@ -64,10 +149,10 @@ class CLIWorkflowStep(WorkflowStep):
                 return s
 
             def IsInput(item):
-                return isinstance(item, tuple) and item[0].find('in') == 0
+                return self._GetFileKind(item) in ['in', 'in_hidden']
 
             def IsOutput(item):
-                return isinstance(item, tuple) and item[0].find('out') == 0
+                return self._GetFileKind(item) in ['out', 'out_hidden']
 
             inputs = [x for x in cmd if IsInput(x)]
             self.InputFiles = [x[1] for x in inputs]
@@ -75,11 +160,10 @@ class CLIWorkflowStep(WorkflowStep):
             self.OutputFiles = [x[1] for x in outputs]
 
             def PassThroughArg(arg):
-                isTuple = isinstance(arg, tuple)
-                return not isTuple or (isTuple and arg[0] != 'in_hidden' and arg[0] != 'out_hidden')
+                return self._GetFileKind(arg) not in ['in_hidden', 'out_hidden']
 
             def ArgSelector(arg):
-                if (isinstance(arg, tuple)):
+                if (self._GetFileKind(arg) is not None):
                     return arg[1]
                 else:
                     return arg
@@ -87,6 +171,86 @@ class CLIWorkflowStep(WorkflowStep):
             passThroughArgs = filter(PassThroughArg, cmd[1:])
             self.Arguments = [ArgSelector(arg) for arg in passThroughArgs]
 
+    def _GetFileKind(self, arg):
+        """Get whether an item of the cmd is a file decorated with infile(),
+        infile_hidden(), outfile() or outfile_hidden(), as the name of
+        the decoration, or None if it is not.
+
+        Tuples spelled out with one of these names are also files.
+
+        """
+        if (isinstance(arg, FileArgument) or
+            (isinstance(arg, tuple) and len(arg) == 2 and arg[0] in FileArgument.Kinds)):
+            return arg[0]
+
+        return None
+
+    def SetHashAlgorithm(self, algorithm):
+        """Set the algorithm used to hash the files of this step, overriding
+        the one of the Workflow.
+
+        :param algorithm: 'sha256', 'blake2b', or 'sampled', which only
+        reads the size and some blocks of each input file and should
+        only be used for inputs that are never modified in place.
+        Files written by steps are hashed with SHA256 in the sampled
+        mode. None uses the algorithm of the Workflow.
+
+        Changing the algorithm causes the step to be executed again.
+
+        """
+        if (algorithm is not None):
+            hashing.CheckAlgorithm(algorithm)
+        self.HashAlgorithm = algorithm
+
+    def SetTrackedEnvironment(self, names):
+        """Set the names of the environment variables that affect the
+        command of this step.
+
+        Along with the Arguments, their values are cached, and the step
+        needs to be updated when they change.
+
+        """
+        self.Environment = sorted(names)
+
+    def SetBatching(self, combine=ConcatenateArguments, key=None, maxSize=None):
+        """Allow the Workflow to execute this step in one invocation of the
+        Executable together with other stale steps.
+
+        Steps are batched with steps that have the same Executable,
+        combine function and key, and the same tracked environment,
+        hash algorithm and process priority. Each step is still checked
+        and cached on its own. A batch fails as a whole when the
+        combined command fails.
+
+        :param combine: Function called with the list of the Arguments
+        of the steps in a batch, in the order the steps were added,
+        that returns the Arguments of the combined invocation. The
+        default concatenates them. Steps must share the same function
+        object to be batched together. None disables batching.
+        :param key: Hashable value that steps batched together must
+        share, e.g., a tuple of the options that the combined
+        invocation passes once.
+        :param maxSize: Maximum number of steps in one invocation, or
+        None for no limit.
+
+        """
+        self.BatchCombine = combine
+        self.BatchKey = key
+        self.BatchSize = maxSize
+
+    def SetProcessPriority(self, nice=None, affinity=None):
+        """Set the scheduling priority of the command of this step.
+
+        :param nice: Nice level of the command, or None to inherit
+        that of this process.
+        :param affinity: Iterable of the CPUs the command may run on,
+        or None to use the CPUs assigned by the Workflow if it pins
+        steps to CPUs, or any CPU otherwise.
+
+        """
+        self.Nice = nice
+        self.Affinity = None if affinity is None else sorted(affinity)
+
     def Execute(self, verbose=False):
         """Run the pipeline step.
 
@@ -94,6 +258,166 @@ class CLIWorkflowStep(WorkflowStep):
         including the command that is run when this step is
         executed. Otherwise, minimize output.
 
+        """
+        restored, store, signature = self._BeginExecute()
+        if (restored):
+            return True
+
+        args = self._GetCommandLine(verbose)
+        instrumentation = self._GetInstrumentation()
+        if (instrumentation is not None):
+            instrumentation.StartExecution(self)
+
+        try:
+            returnCode, wallTime, usage, outputHashes = self._RunCommand(args)
+        except Exception as e:
+            print('Failed to run command-line executable %s: %s' % (args, e))
+            return False
+
+        if (instrumentation is not None):
+            instrumentation.FinishProcess(self, wallTime, returnCode, usage)
+
+        return self._EndExecute(returnCode, store, signature, outputHashes)
+
+    def _RunCommand(self, args):
+        """Run the command of the pipeline step on a worker if the Workflow
+        has a WorkerPool, or locally otherwise.
+
+        Returns a tuple of the return code, the wall time, the resource
+        usage of the command or None, and a dictionary mapping the paths
+        of the output files to their digest and stat identity if they
+        were computed by a worker, or None.
+
+        """
+        workerPool = self._GetWorkerPool()
+        if (workerPool is not None):
+            return workerPool.Execute(self, args)
+
+        logCapture = self._GetLogCapture()
+        if (logCapture is not None):
+            with logCapture.Open(self.Name) as log:
+                returnCode, wallTime, usage = _RunProcess(args, self._SetPriority, log=log)
+        else:
+            returnCode, wallTime, usage = _RunProcess(args, self._SetPriority)
+
+        return (returnCode, wallTime, usage, None)
+
+    def _GetBatchKey(self):
+        """Get the key that steps executed in one batch share, or None if
+        this step is not batched.
+
+        """
+        if (self.BatchCombine is None):
+            return None
+
+        return (type(self), self.Executable, self.BatchCombine, self.BatchKey,
+                tuple(self.Environment), self.HashAlgorithm, self.Nice,
+                None if self.Affinity is None else tuple(self.Affinity))
+
+    async def ExecuteAsync(self, verbose=False):
+        """Run the pipeline step without blocking the asyncio event loop.
+
+        The command is launched with asyncio.create_subprocess_exec
+        and its standard output and error are forwarded to those of
+        this process, or to its log if the Workflow captures logs, as
+        they arrive. Hashing runs in the default
+        executor of the event loop. The CPU time and memory use of the
+        command are not measured by the Instrumentation in this case.
+        If the Workflow has a WorkerPool, the command is dispatched to
+        a worker from the default executor instead.
+
+        :param verbose: If True, produce verbose output while running,
+        including the command that is run when this step is
+        executed. Otherwise, minimize output.
+
+        """
+        if (self._GetWorkerPool() is not None):
+            return await super(CLIWorkflowStep, self).ExecuteAsync(verbose)
+
+        loop = asyncio.get_running_loop()
+
+        restored, store, signature = await loop.run_in_executor(None, self._BeginExecute)
+        if (restored):
+            return True
+
+        args = self._GetCommandLine(verbose)
+        instrumentation = self._GetInstrumentation()
+        if (instrumentation is not None):
+            instrumentation.StartExecution(self)
+
+        logCapture = self._GetLogCapture()
+        log = None
+        start = time.time()
+        try:
+            if (logCapture is not None):
+                log = logCapture.Open(self.Name)
+                process = await asyncio.create_subprocess_exec(
+                    *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            else:
+                process = await asyncio.create_subprocess_exec(
+                    *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except asyncio.CancelledError:
+            # A cancellation is not a failure to run the command, and is
+            # an Exception before Python 3.8
+            if (log is not None):
+                log.Close()
+            raise
+        except Exception:
+            if (log is not None):
+                log.Close()
+            print('Failed to run command-line executable %s' % args)
+            return False
+
+        self._SetPriority(process.pid)
+
+        try:
+            if (log is not None):
+                await _CaptureStream(process.stdout, log)
+            else:
+                await asyncio.gather(_ForwardStream(process.stdout, sys.stdout),
+                                     _ForwardStream(process.stderr, sys.stderr))
+            returnCode = await process.wait()
+        except asyncio.CancelledError:
+            if (process.returncode is None):
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            if (log is not None):
+                log.Close()
+
+        # The event loop reaps the child, so its resource usage is not
+        # available here
+        if (instrumentation is not None):
+            instrumentation.FinishProcess(self, time.time() - start, returnCode)
+
+        return await loop.run_in_executor(None, self._EndExecute, returnCode, store, signature)
+
+    def _BeginExecute(self):
+        """Prepare to run the pipeline step.
+
+        If the outputs can be restored from the ArtifactStore of the
+        Workflow, they are restored and the command does not need to
+        be run.
+
+        Returns a tuple (restored, store, signature) where store and
+        signature are passed on to _EndExecute.
+
+        """
+        store = self._GetArtifactStore()
+        signature = None
+        if (store is not None):
+            signature = self._ComputeSignature()
+            if (signature is not None and self._RestoreOutputs(store, signature)):
+                return (True, store, signature)
+            self._BreakStoreLinks(store)
+
+        return (False, store, signature)
+
+    def _GetCommandLine(self, verbose=False):
+        """Get the command line of the pipeline step and announce that it is
+        executed.
+
         """
         sys.stdout.write('Executing CLIWorkflowStep "%s"\n' % self.Name)
         args = [self.Executable] + self.Arguments
@@ -103,22 +427,68 @@ class CLIWorkflowStep(WorkflowStep):
             sys.stdout.write(' '.join(['"%s"' % arg for arg in args]))
             sys.stdout.write('\n')
 
-        try:
-            returnCode = subprocess.call(args)
-            if (returnCode != 0):
-                print('Process returned error code %' % returnCode)
-                return False
+        return args
 
-        except:
-            print('Failed to run command-line executable %s' % args)
+    def _SetPriority(self, pid):
+        """Apply the nice level and CPU affinity of this step to its running
+        command.
+
+        This is done from this process right after the command starts,
+        rather than in the child before exec, which is not safe when
+        steps run in threads.
+
+        """
+        affinity = self.Affinity
+        if (affinity is None):
+            affinity = self._AssignedCPUs
+
+        _SetProcessPriority(pid, self.Nice, affinity, self.Name)
+
+    def _EndExecute(self, returnCode, store, signature, outputHashes=None):
+        """Record the results of running the pipeline step.
+
+        :param outputHashes: Dictionary mapping the paths of the output
+        files to a tuple of their digest and of their stat identity, if
+        they were computed where the command ran, so they are not read
+        again.
+
+        Returns True if the command succeeded and its results were
+        recorded in the cache.
+
+        """
+        if (returnCode != 0):
+            print('Process returned error code %d' % returnCode)
+            logCapture = self._GetLogCapture()
+            if (logCapture is not None):
+                logCapture.ReportFailure(self.Name)
             return False
 
+        # The outputs were just written, so hashes computed before are
+        # stale even if the stat of the output files did not change
+        memo = self._GetMemo()
+        if (memo is not None):
+            memo.Invalidate(self.OutputFiles)
+            for outputFile in self.OutputFiles:
+                if (os.path.isdir(outputFile)):
+                    memo.InvalidateTree(outputFile)
+
+            # Use the stat identities seen where the outputs were hashed,
+            # since the attributes seen here may be stale, e.g., from the
+            # NFS attribute cache. If they differ from those seen here,
+            # the outputs are hashed again.
+            if (outputHashes is not None):
+                for path, (digest, statIdentity) in outputHashes.items():
+                    memo.Set(path, statIdentity, digest, hashing.DigestAlgorithm(digest))
+
         try:
             self._WriteSHA256Files()
         except:
             print('Failed to write SHA 256 files for input')
             return False
 
+        if (signature is not None):
+            self._SaveOutputs(store, signature)
+
         return True
 
     def NeedsUpdate(self):
@@ -128,195 +498,2540 @@ class CLIWorkflowStep(WorkflowStep):
         of the OutputFiles are missing or have changed.
 
         """
-        filesToCheck = [self.Executable]
-        filesToCheck.extend(self.InputFiles)
-        filesToCheck.extend(self.OutputFiles)
+        return self.GetUpdateReason() is not None
 
-        for inputFileName in filesToCheck:
-            sha256FileName = self._GetSHA256FileName(inputFileName)
+    def GetUpdateReason(self):
+        """Get why the pipeline step needs to be updated, as a short
+        sentence, or None if it is up-to-date (see NeedsUpdate).
 
-            # Need update if SHA256 file for an input file doesn't exist
-            if (not os.path.isfile(sha256FileName)):
-                return True
+        Files whose hash was already computed in the current run of the
+        Workflow, e.g., the outputs of a step that just executed, are
+        compared first, so that no file is hashed when one of them
+        changed.
 
-            # Need update if SHA256 file for an input file is different from
-            # a freshly computed SHA256 of the file
-            try:
-                f = open(sha256FileName, 'r')
-                oldSHA256Contents = f.readlines()
-                oldSHA256 = ''
-                if (len(oldSHA256Contents) > 0):
-                    oldSHA256 = oldSHA256Contents[0].strip()
-                newSHA256 = self._ComputeSHA256(inputFileName)
-                if (oldSHA256 != newSHA256):
-                    return True
-            except IOError as e:
-                print('I/O error({0}): {1}'.format(e.errno, e.strerror))
-            except UnicodeDecodeError as e:
-                print('UnicodeDecodeError: ', e)
-            except:
-                print("Error when comparing SHA256 files. Assuming execution of pipeline step is needed.")
-                print("Unexpected error: ", sys.exc_info()[0])
-                return True
+        """
+        hashCache = self._GetCache()
+        memo = self._GetMemo()
+
+        # Pick up the entries written by other processes sharing the
+        # cache, e.g., for this step if it was just executed elsewhere
+        hashCache.Refresh()
+
+        filesToCheck = list(self.InputFiles)
+        filesToCheck.extend(self.OutputFiles)
 
         for outputFile in self.OutputFiles:
             # Need an update if any of the outputs are missing
             if (not os.path.exists(outputFile)):
-                return True
+                return 'output "%s" is missing' % outputFile
+
+        # Need update if there is no cached fingerprint for the
+        # executable or if it changed
+        entry = hashCache.Get(self.Name, self.Executable)
+        if (entry is None):
+            return 'it was never executed'
+
+        try:
+            if (entry.get('sha256') != self._GetExecutableFingerprint()):
+                return 'executable "%s" changed' % self.Executable
+        except:
+            print("Error when fingerprinting the executable. Assuming execution of pipeline step is needed.")
+            print("Unexpected error: ", sys.exc_info()[0])
+            return 'executable "%s" could not be fingerprinted' % self.Executable
+
+        # Need update if the arguments or the tracked environment
+        # changed. Caches written by earlier versions have no entry for
+        # them, in which case the entry is added if the step is
+        # otherwise up-to-date.
+        argumentsSHA256 = self._ComputeArgumentsSHA256()
+        argumentsEntry = hashCache.Get(self.Name, _ArgumentsCacheKey)
+        if (argumentsEntry is not None and argumentsEntry.get('sha256') != argumentsSHA256):
+            return 'arguments or tracked environment changed'
+
+        # Files whose stat changed since their SHA256 was cached, mapped
+        # to their cached entries
+        filesToHash = collections.OrderedDict()
+
+        for inputFileName in filesToCheck:
+            entry = hashCache.Get(self.Name, inputFileName)
+
+            # Need update if there is no cached SHA256 for an input file
+            if (entry is None):
+                return 'no cached hash of "%s"' % inputFileName
+
+            oldStat = None
+            if (entry.get('stat') is not None):
+                oldStat = tuple(entry['stat'])
+            newStat = hashing.StatIdentity(inputFileName)
+
+            # Need update if the hash algorithm changed since the entry
+            # was cached
+            algorithm = self._GetHashAlgorithm(inputFileName)
+            if (hashing.DigestAlgorithm(entry.get('sha256', '')) != algorithm):
+                return 'hash algorithm of "%s" changed' % inputFileName
+
+            # Compare first to the hash computed earlier in this run, if
+            # any, e.g., by a step that just rewrote the file. It takes
+            # precedence over the stat fast path, since a rewritten file
+            # can keep its stat identity.
+            if (memo is not None):
+                digest = memo.Get(inputFileName, newStat, algorithm)
+                if (digest is not None):
+                    if (digest != entry.get('sha256')):
+                        return '"%s" changed' % inputFileName
+                    if (oldStat is not None and oldStat == newStat):
+                        continue
+
+            # Skip hashing if the file is unchanged since its SHA256
+            # was cached
+            if (not Workflow._Paranoid and oldStat is not None and oldStat == newStat):
+                if (memo is not None):
+                    memo.Set(inputFileName, newStat, entry.get('sha256'), algorithm)
+                continue
+
+            filesToHash[inputFileName] = entry
+
+        # Need update if the cached SHA256 for an input file is
+        # different from a freshly computed SHA256 of the file
+        with contextlib.closing(self._HashFiles(list(filesToHash), filesToHash)) as hashes:
+            for inputFileName, newEntry, error in hashes:
+                if (isinstance(error, IOError)):
+                    print('I/O error({0}): {1}'.format(error.errno, error.strerror))
+                    continue
+                elif (error is not None):
+                    print("Error when comparing SHA256 hashes. Assuming execution of pipeline step is needed.")
+                    print("Unexpected error: ", type(error))
+                    return '"%s" could not be hashed' % inputFileName
+
+                oldEntry = filesToHash[inputFileName]
+                if (oldEntry.get('sha256') != newEntry['sha256']):
+                    return '"%s" changed' % inputFileName
+
+                # Contents are unchanged, but the file was touched.
+                # Refresh the cached stats so the next check is cheap.
+                if (newEntry != oldEntry):
+                    hashCache.Set(self.Name, inputFileName, newEntry)
+
+        if (argumentsEntry is None):
+            hashCache.Set(self.Name, _ArgumentsCacheKey, {'sha256': argumentsSHA256, 'stat': None})
 
         # Everything checks out, no execution needed
-        return False
+        return None
 
     def ClearCache(self):
-        """Deletes all the cached SHA256 files for this WorkflowStep.
+        """Deletes all the cached SHA256 entries for this WorkflowStep.
 
         This essentially forces a re-run of the WorkflowStep.
 
         """
-        filesToCheck = [self.Executable]
+        hashCache = self._GetCache()
+
+        filesToCheck = [self.Executable, _ArgumentsCacheKey]
         filesToCheck.extend(self.InputFiles)
         filesToCheck.extend(self.OutputFiles)
 
         for inputFileName in filesToCheck:
-            sha256FileName = self._GetSHA256FileName(inputFileName)
-            sys.stdout.write('Removing %s.\n' % sha256FileName)
-            os.remove(sha256FileName)
+            if (hashCache.Remove(self.Name, inputFileName)):
+                sys.stdout.write('Removing cached SHA256 for "%s".\n' % inputFileName)
+
+        hashCache.Flush()
 
-    def _GetSHA256FileName(self, fileName):
-        """Get the file name for the cached SHA256 entry.
+    def _GetCache(self):
+        """Get the HashCache holding the cached SHA256 entries of this
+        WorkflowStep.
 
         """
-        fileName = os.path.join(Workflow._CacheDirectory,
-                                self.Name + '-' + fileName.replace('/', '_') + '.sha256')
+        if (self._Workflow is not None):
+            return self._Workflow._GetCache()
 
-        # Create the path if needed
-        directory = os.path.dirname(fileName)
-        if (not os.path.exists(directory)):
-            os.makedirs(directory)
+        return Workflow._GetDefaultCache()
 
-        return fileName
+    def _GetArtifactStore(self):
+        """Get the ArtifactStore of the Workflow this step belongs to, or None
+        if outputs are not stored.
 
-    def _ComputeSHA256(self, path):
-        """Compute the SHA256 for a given path.
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._ArtifactStore
 
-        :param path: This parameter may be a directory or file. If it
-        is a directory, the SHA256 is of all the content in the files
-        in the directory hierarchy starting at this path. If it is a
-        file, it is the SHA256 of the contents of the file.
+        return None
 
-        """
+    def _ComputeArgumentsSHA256(self):
+        """Compute the SHA256 of the Arguments of this step and of the values
+        of its tracked environment variables.
 
-        m = hashlib.sha256()
-        if os.path.isfile(path):
-            f = open(path, 'r').read()
-            m.update(f)
-        elif os.path.isdir(path):
-            # Compute SHA256 over all files in the directory
-            for root, dirs, files in os.walk(path):
-                files = sorted(files)
-                for fileName in files:
-                    filePath = os.path.join(root, fileName)
-                    f = open(filePath, 'r').read()
-                    m.update(f)
+        """
+        description = {
+            'arguments': self._DescribeArguments(),
+            'environment': self._GetTrackedEnvironment(),
+        }
+        m = hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8'))
 
         return m.hexdigest()
 
-    def _WriteSHA256Files(self):
-        """Writes out SHA256 cache files for the Executable, InputFiles, and OutputFiles.
+    def _DescribeArguments(self):
+        """Get the Arguments of this step as they are hashed. These are the
+        strings passed on the command line.
 
         """
-        filesToCheck = [self.Executable]
-        filesToCheck.extend(self.InputFiles)
-        filesToCheck.extend(self.OutputFiles)
+        return [str(arg) for arg in self.Arguments]
 
-        for inputFileName in filesToCheck:
-            # Save SHA256 file
-            sha256FileName = self._GetSHA256FileName(inputFileName)
+    def _GetTrackedEnvironment(self):
+        """Get the values of the tracked environment variables. Variables
+        that are not set have a value of None.
+
+        """
+        return dict((name, os.environ.get(name)) for name in self.Environment)
+
+    def _ComputeSignature(self, entries=None):
+        """Compute the signature of this step from the fingerprint of its
+        Executable, the SHA256 of its InputFiles, its Arguments, its
+        tracked environment and its OutputFiles.
+
+        :param entries: Dictionary of the cache entries of the
+        Executable and InputFiles. If None, they are computed.
+
+        Returns None if any of the files could not be hashed.
+
+        """
+        paths = [self.Executable] + self.InputFiles
+        if (entries is None):
+            entries = {}
+            with contextlib.closing(self._HashFiles(self.InputFiles)) as hashes:
+                for path, entry, error in hashes:
+                    if (error is not None):
+                        return None
+                    entries[path] = entry
 
             try:
-                sha256Value = self._ComputeSHA256(inputFileName)
+                entries[self.Executable] = {'sha256': self._GetExecutableFingerprint()}
             except:
-                sys.stdout.write('Could not compute SHA256 for file "%s"\n' % inputFileName)
-                sys.stdout.write('%s\n' % sys.exc_info()[0])
+                return None
+
+        if (any(entries.get(path) is None for path in paths)):
+            return None
+
+        description = {
+            'executable': entries[self.Executable]['sha256'],
+            'inputs': [[path, entries[path]['sha256']] for path in self.InputFiles],
+            'arguments': self._DescribeArguments(),
+            'environment': self._GetTrackedEnvironment(),
+            'outputs': self.OutputFiles,
+        }
+        m = hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8'))
+
+        return m.hexdigest()
+
+    def _RestoreOutputs(self, store, signature):
+        """Restore the outputs of this step from an ArtifactStore if it
+        holds outputs for the signature.
+
+        Returns True if the outputs were restored.
+
+        """
+        outputs = store.Lookup(signature)
+        if (outputs is None or
+            sorted(output['path'] for output in outputs) != sorted(self.OutputFiles)):
+            return False
+
+        try:
+            if (not store.Restore(outputs)):
+                return False
+        except (IOError, OSError) as e:
+            sys.stdout.write('Could not restore outputs of "%s": %s\n' % (self.Name, e))
+            return False
+
+        sys.stdout.write('Restored outputs of CLIWorkflowStep "%s" from the artifact store\n' % self.Name)
+
+        memo = self._GetMemo()
+        if (memo is not None):
+            memo.Invalidate(self.OutputFiles)
+            for outputFile in self.OutputFiles:
+                if (os.path.isdir(outputFile)):
+                    memo.InvalidateTree(outputFile)
+
+        self._WriteSHA256Files()
+
+        return True
+
+    def _SaveOutputs(self, store, signature):
+        """Save the outputs of this step in an ArtifactStore, provided the
+        inputs did not change while the step executed.
+
+        """
+        hashCache = self._GetCache()
+
+        entries = {}
+        for path in [self.Executable] + self.InputFiles + self.OutputFiles:
+            entries[path] = hashCache.Get(self.Name, path)
+
+        if (self._ComputeSignature(entries) != signature):
+            return
+
+        outputs = []
+        for path in self.OutputFiles:
+            output = {'path': path, 'sha256': entries[path]['sha256']}
+            if ('tree' in entries[path]):
+                output['tree'] = entries[path]['tree']
+            elif (not os.path.isfile(path)):
+                # Outputs that were not produced cannot be stored
+                return
+            outputs.append(output)
+
+        try:
+            store.Save(signature, outputs)
+        except (IOError, OSError) as e:
+            sys.stdout.write('Could not store outputs of "%s": %s\n' % (self.Name, e))
+
+    def _BreakStoreLinks(self, store):
+        """Remove outputs that are hard links to files in an ArtifactStore so
+        that executing this step does not overwrite the stored files.
+
+        The digests cached for the outputs give the stored files they
+        are compared with.
+
+        """
+        hashCache = self._GetCache()
+        algorithm = self._GetHashAlgorithm()
+        for outputFile in self.OutputFiles:
+            entry = hashCache.Get(self.Name, outputFile) or {}
+            if (os.path.isdir(outputFile)):
+                tree = entry.get('tree', {})
+                for root, dirs, files in os.walk(outputFile):
+                    for fileName in files:
+                        filePath = os.path.join(root, fileName)
+                        relativePath = os.path.relpath(filePath, outputFile).replace(os.sep, '/')
+                        digest = tree.get(relativePath, (None, None))[0]
+                        if (store.IsLinked(filePath, digest, algorithm)):
+                            os.remove(filePath)
+            elif (store.IsLinked(outputFile, entry.get('sha256'), algorithm)):
+                os.remove(outputFile)
+
+    def _GetExecutableFingerprint(self):
+        """Get the fingerprint of the Executable.
+
+        The Executable is looked up in the PATH. Its fingerprint is
+        its SHA256, combined with the SHA256 of the shared libraries
+        it loads if the Workflow tracks shared libraries. It is
+        computed at most once per run of the Workflow.
+
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._FingerprintExecutable(self.Executable)
+
+        return _FingerprintExecutable(self.Executable, Workflow._GetDefaultCache(), False)
+
+    def _GetWorkerPool(self):
+        """Get the WorkerPool of the Workflow this step belongs to, or None
+        if commands run locally.
+
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._WorkerPool
+
+        return None
+
+    def _GetInstrumentation(self):
+        """Get the Instrumentation of the Workflow this step belongs to, or
+        None if the run is not instrumented.
+
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._Instrumentation
 
+        return None
+
+    def _GetLogCapture(self):
+        """Get the LogCapture of the Workflow this step belongs to, or None
+        if the output of commands goes to the console.
+
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._LogCapture
+
+        return None
+
+    def _GetMemo(self):
+        """Get the HashMemo of the current run of the Workflow, or None if
+        this WorkflowStep is not being run by a Workflow.
+
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._Memo
+
+        return None
+
+    def _HashFiles(self, paths, oldEntries={}):
+        """Compute cache entries for several paths, concurrently if the
+        Workflow running this step has a hashing thread pool.
+
+        :param paths: Paths of the files or directories to hash.
+        :param oldEntries: Cached entries of the paths, if any, used to
+        avoid hashing the unchanged files in directories again.
+
+        Returns a generator of (path, entry, error) tuples in the order
+        the hashes complete. The entry is None and error is the
+        exception raised if the path could not be hashed. Hashes that
+        have not started yet are cancelled when the generator is
+        closed.
+
+        """
+        paths = list(collections.OrderedDict.fromkeys(paths))
+
+        def Hash(path):
             try:
-                shaFile = open(sha256FileName, 'w')
-                shaFile.write(sha256Value)
-                shaFile.write('\n')
-            except:
-                sys.stdout.write('Could not write SHA256 file "%s".\n' % sha256FileName)
+                return (path, self._Fingerprint(path, oldEntries.get(path)), None)
+            except Exception as e:
+                return (path, None, e)
 
-#############################################################################
-class Workflow:
-    """Workflow that defines a set of steps that should be taken to
-    execute a workflow.
+        pool = None
+        if (self._Workflow is not None):
+            pool = self._Workflow._HashPool
 
-    """
-    def __init__(self, steps=[]):
-        self._Steps = steps
+        if (pool is None or len(paths) < 2):
+            for path in paths:
+                yield Hash(path)
+            return
 
-    def AddStep(self, step):
-        """Add a workflow step to the pipeline.
+        futures = [pool.submit(Hash, path) for path in paths]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _Fingerprint(self, path, oldEntry=None):
+        """Compute the cache entry for a path.
+
+        The entry holds the digest of the path, computed with the
+        hash algorithm of this step and kept under the 'sha256' key for
+        compatibility, and, if it can be
+        trusted on later checks, its stat identity. For a directory,
+        the entry also holds the hash tree of the files in it. Files
+        in the directory whose stat is unchanged since the tree in
+        oldEntry was computed are not hashed again.
 
         """
-        self._Steps.append(step)
+        algorithm = self._GetHashAlgorithm(path)
+        if (os.path.isdir(path)):
+            # Reuse the digests of unchanged files if they were computed
+            # with the same algorithm
+            previousTree = None
+            if (oldEntry is not None and not Workflow._Paranoid and
+                hashing.DigestAlgorithm(oldEntry.get('sha256', '')) == algorithm):
+                previousTree = oldEntry.get('tree')
+            sha256Value, tree = hashing.ComputeTreeSHA256(
+                path, previousTree,
+                lambda filePath, statIdentity: self._HashFile(filePath, statIdentity, algorithm),
+                algorithm)
+            return {'sha256': sha256Value, 'stat': None, 'tree': tree}
+
+        statBefore = hashing.StatIdentity(path)
+        sha256Value = self._HashFile(path, statBefore, algorithm)
+
+        # Only record the stat if the file did not change while it was
+        # being hashed
+        statIdentity = None
+        if (hashing.IsCacheableStat(statBefore) and
+            statBefore == hashing.StatIdentity(path)):
+            statIdentity = list(statBefore)
+
+        return {'sha256': sha256Value, 'stat': statIdentity}
+
+    def _HashFile(self, path, statIdentity, algorithm='sha256'):
+        """Get the digest of a file, reusing the hash computed earlier in the
+        current run of the Workflow if the file has not changed since.
+
+        :param path: Path of the file to hash.
+        :param statIdentity: Stat identity of the file before hashing.
+        :param algorithm: Hash algorithm, one of hashing.Algorithms.
+
+        """
+        memo = self._GetMemo()
+        if (memo is not None):
+            sha256Value = memo.Get(path, statIdentity, algorithm)
+            if (sha256Value is not None):
+                return sha256Value
 
-    def Execute(self, dryRun=False, verbose=False):
-        """Execute each WorkflowStep in the order it was added to the Workflow
-        if needed.
+        start = time.time()
+        sha256Value = self._ComputeDigest(path, algorithm)
 
-        :parameter dryRun: If set to True, does not actually execute the WorkflowStep.
-        :parameter verbose: If set to True, tells the WorkflowStep to execute verbosely.
+        instrumentation = self._GetInstrumentation()
+        if (instrumentation is not None):
+            byteCount = 0
+            if (statIdentity is not None):
+                byteCount = statIdentity[0]
+            instrumentation.AddHash(self, byteCount, time.time() - start)
+
+        if (memo is not None and statIdentity is not None and
+            statIdentity == hashing.StatIdentity(path)):
+            memo.Set(path, statIdentity, sha256Value, algorithm)
+
+        return sha256Value
+
+    def _ComputeDigest(self, path, algorithm='sha256'):
+        """Compute the digest for a given path.
+
+        :param path: This parameter may be a directory or file. If it
+        is a directory, the digest is the root of the hash tree of the
+        files in the directory hierarchy starting at this path. If it
+        is a file, it is the digest of the contents of the file.
+        :param algorithm: Hash algorithm, one of hashing.Algorithms.
 
         """
-        for s in self._Steps:
-            if (s.NeedsUpdate()):
-                sys.stdout.write('Workflow step "%s" needs to be executed.\n' % s.Name)
-                success = True
-                if (not dryRun):
-                    success = s.Execute(verbose)
-                if (not success):
-                  break
-            else:
-                sys.stdout.write('Workflow step "%s" is up-to-date.\n' % s.Name)
+        return hashing.ComputeDigest(path, algorithm)
 
-    def ClearCache(self):
-        """Clear the cache for all steps in the Workflow.
+    def _GetHashAlgorithm(self, path=None):
+        """Get the hash algorithm used for a file of this step.
 
-        Note that this will force re-execution of all steps in the
-        Workflow.
+        The algorithm set on the step takes precedence over the one set
+        on its Workflow. Files written by steps are never sampled, since
+        they are rewritten in place and may be stored in an
+        ArtifactStore; SHA256 is used for them instead.
+
+        :param path: Path of the file, or None for the outputs.
 
         """
-        sys.stdout.write('Clearing cache\n')
+        algorithm = self.HashAlgorithm
+        if (algorithm is None and self._Workflow is not None):
+            algorithm = self._Workflow._HashAlgorithm
+        if (algorithm is None):
+            algorithm = 'sha256'
 
-        # Remove all SHA256 files from cache directory
-        for step in self._Steps:
-            step.ClearCache()
+        if (algorithm == 'sampled' and
+            (path is None or path in self.OutputFiles or
+             (self._Workflow is not None and len(self._Workflow.GetProducers(path)) > 0))):
+            algorithm = 'sha256'
 
-    """Location where temporary files are stored."""
-    _CacheDirectory = '/tmp'
+        return algorithm
 
-    @staticmethod
-    def SetCacheDirectory(directory):
-        """Set the directory where the cached SHA256 files are stored.
+    def _WriteSHA256Files(self):
+        """Writes out cached SHA256 entries for the Executable, InputFiles,
+        and OutputFiles.
 
         """
-        sys.stdout.write('Setting cache directory to "%s"\n' % directory)
-        Workflow._CacheDirectory = directory
+        hashCache = self._GetCache()
 
-        # Warn if directory doesn't exit
-        if (not os.path.isdir(directory)):
-            sys.stdout.write('Cache directory "%s" does not exist.\n' % directory)
+        try:
+            hashCache.Set(self.Name, self.Executable,
+                          {'sha256': self._GetExecutableFingerprint(), 'stat': None})
+        except:
+            sys.stdout.write('Could not fingerprint executable "%s"\n' % self.Executable)
+            sys.stdout.write('%s\n' % sys.exc_info()[0])
 
+        hashCache.Set(self.Name, _ArgumentsCacheKey,
+                      {'sha256': self._ComputeArgumentsSHA256(), 'stat': None})
+
+        filesToCheck = list(self.InputFiles)
+        filesToCheck.extend(self.OutputFiles)
+
+        # Reuse the hash trees of directories that were cached before
+        oldEntries = {}
+        for inputFileName in filesToCheck:
+            entry = hashCache.Get(self.Name, inputFileName)
+            if (entry is not None and 'tree' in entry):
+                oldEntries[inputFileName] = entry
+
+        with contextlib.closing(self._HashFiles(filesToCheck, oldEntries)) as hashes:
+            for inputFileName, entry, error in hashes:
+                if (error is not None):
+                    sys.stdout.write('Could not compute SHA256 for file "%s"\n' % inputFileName)
+                    sys.stdout.write('%s\n' % type(error))
+                    continue
+
+                hashCache.Set(self.Name, inputFileName, entry)
+
+        try:
+            hashCache.Flush()
+        except:
+            sys.stdout.write('Could not write cache file in "%s".\n' % hashCache.Directory)
 
 #############################################################################
+class CLIWorkflowStepTemplate(object):
+    """Pattern of a CLIWorkflowStep that is applied to many data sets, e.g.,
+    to run the same chain of tools on every subject of a study.
+
+    :param name: Pattern of the names of the steps, e.g.,
+    'Register-{subject}'.
+    :param cmd: Pattern of the command in the same form as the cmd
+    parameter of CLIWorkflowStep. Strings in it, including the file
+    names decorated with infile(), outfile(), etc., are formatted with
+    the fields of each data set using str.format(), so literal braces
+    must be doubled.
+
+    """
+    def __init__(self, name, cmd):
+        self.Name = name
+        self.Command = cmd
+
+    def Instantiate(self, **fields):
+        """Create the CLIWorkflowStep for one data set.
+
+        :param fields: Values of the fields in the patterns.
+
+        """
+        def Format(arg):
+            if (isinstance(arg, FileArgument)):
+                return FileArgument(arg.Kind, Format(arg.Path))
+            elif (isinstance(arg, tuple)):
+                return tuple(Format(item) for item in arg)
+            elif (isinstance(arg, str)):
+                return arg.format(**fields)
+            return arg
+
+        return CLIWorkflowStep(self.Name.format(**fields), [Format(arg) for arg in self.Command])
+
+    def Expand(self, datasets):
+        """Create the CLIWorkflowSteps for a list of data sets.
+
+        :param datasets: Each data set is either a dictionary of the
+        values of the fields in the patterns, or a single value that is
+        used for the field named 'dataset'.
+
+        """
+        steps = []
+        for dataset in datasets:
+            if (isinstance(dataset, dict)):
+                steps.append(self.Instantiate(**dataset))
+            else:
+                steps.append(self.Instantiate(dataset=dataset))
+
+        return steps
+
+#############################################################################
+class PythonWorkflowStep(CLIWorkflowStep):
+    """Workflow step calling a Python function in a pool of worker
+    processes.
+
+    The worker processes stay up between steps, so the interpreter
+    startup and the imports done by the function are only paid once
+    per worker. The step is checked and cached like a CLIWorkflowStep,
+    with the fingerprint of the function, computed from its source or
+    its bytecode, in place of the SHA256 of the executable. Only the
+    function itself is fingerprinted, not the functions it calls.
+
+    :param name: Name of the step.
+    :param function: Function to call. It is pickled by reference, so
+    it must be defined at the top level of a module.
+    :param args: Arguments of the function. Files are decorated with
+    infile(), outfile(), etc., like the cmd of a CLIWorkflowStep, and
+    passed as their path. Other tuples are passed whole, even if they
+    look like decorated files. The other arguments must be None, bools,
+    numbers, strings, bytes or paths, or lists, tuples, dictionaries
+    and sets of them, so that they are hashed the same way in every
+    run. Raises TypeError otherwise.
+
+    """
+    def __init__(self, name, function, args=[]):
+        self.FunctionName = '%s.%s' % (function.__module__, function.__qualname__)
+        super(PythonWorkflowStep, self).__init__(name, ['<python:%s>' % self.FunctionName] + list(args))
+        self.Function = function
+        self._FunctionFingerprint = None
+
+        # Fail now rather than when the step is checked
+        self._DescribeArguments()
+
+    async def ExecuteAsync(self, verbose=False):
+        """Run the pipeline step without blocking the asyncio event loop.
+
+        The function is called in the process pool of the Workflow, and
+        the result is waited for in the default executor of the event
+        loop.
+
+        """
+        return await WorkflowStep.ExecuteAsync(self, verbose)
+
+    def Execute(self, verbose=False):
+        """Run the pipeline step.
+
+        :param verbose: If True, produce verbose output while running,
+        including the call that is made when this step is executed.
+        Otherwise, minimize output.
+
+        """
+        restored, store, signature = self._BeginExecute()
+        if (restored):
+            return True
+
+        sys.stdout.write('Executing PythonWorkflowStep "%s"\n' % self.Name)
+        if (verbose):
+            sys.stdout.write('Call: %s(%s)\n' % (self.FunctionName,
+                                                 ', '.join(repr(arg) for arg in self.Arguments)))
+
+        instrumentation = self._GetInstrumentation()
+        if (instrumentation is not None):
+            instrumentation.StartExecution(self)
+
+        logFileName = None
+        maxSize = None
+        logCapture = self._GetLogCapture()
+        if (logCapture is not None):
+            logFileName = os.path.abspath(logCapture.GetLogFileName(self.Name))
+            maxSize = logCapture.MaxSize
+
+        start = time.time()
+        error = self._CallFunction(logFileName, maxSize)
+
+        returnCode = 0
+        if (error is not None):
+            print('Python function of "%s" failed: %s' % (self.Name, error))
+            returnCode = 1
+
+        if (instrumentation is not None):
+            instrumentation.FinishProcess(self, time.time() - start, returnCode)
+
+        return self._EndExecute(returnCode, store, signature)
+
+    def _CallFunction(self, logFileName, maxSize):
+        """Call the Function in the process pool.
+
+        A worker process that dies, e.g., from a segmentation fault or
+        killed for lack of memory, breaks the pool and all the calls
+        running in it. The broken pool is then replaced, and the call
+        is made once more in the new pool, since the Function of this
+        step may not be the one that killed the worker.
+
+        Returns None if the Function succeeded, or the error.
+
+        """
+        for attempt in range(2):
+            pool = self._GetProcessPool()
+            try:
+                future = pool.submit(_CallFunction, self.Function, self.Arguments,
+                                     os.getcwd(), logFileName, maxSize)
+                return future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                self._DropProcessPool(pool)
+                error = 'A worker process died: %s' % e
+            except Exception as e:
+                # The function or its arguments could not be sent to the pool
+                return '%s: %s' % (type(e).__name__, e)
+
+        return error
+
+    def SetBatching(self, combine=ConcatenateArguments, key=None, maxSize=None):
+        """PythonWorkflowSteps cannot be batched, since the Function is called
+        once per step. Raises TypeError.
+
+        """
+        raise TypeError('PythonWorkflowStep "%s" cannot be batched: its function is called once '
+                        'per step.' % self.Name)
+
+    def _DescribeArguments(self):
+        """Get the Arguments of this step as they are hashed, in a canonical
+        form that does not depend on their repr() or on the order of
+        sets and dictionaries.
+
+        """
+        try:
+            return [_CanonicalArgument(arg) for arg in self.Arguments]
+        except TypeError as e:
+            raise TypeError('Invalid argument of PythonWorkflowStep "%s": %s' % (self.Name, e))
+
+    def _GetBatchKey(self):
+        return None
+
+    def _GetFileKind(self, arg):
+        """Only the values returned by infile(), outfile(), etc., are files,
+        since functions may take any tuple.
+
+        """
+        if (isinstance(arg, FileArgument)):
+            return arg.Kind
+
+        return None
+
+    def _GetExecutableFingerprint(self):
+        """Get the fingerprint of the Function.
+
+        """
+        if (self._FunctionFingerprint is None):
+            self._FunctionFingerprint = _FingerprintFunction(self.Function)
+
+        return self._FunctionFingerprint
+
+    def _GetProcessPool(self):
+        """Get the process pool of the Workflow this step belongs to, or the
+        default one if it does not belong to a Workflow.
+
+        """
+        if (self._Workflow is not None):
+            return self._Workflow._GetProcessPool()
+
+        return _GetDefaultProcessPool()
+
+    def _DropProcessPool(self, pool):
+        """Stop using a broken process pool, so that a new one is created for
+        the next call.
+
+        """
+        if (self._Workflow is not None):
+            self._Workflow._DropProcessPool(pool)
+        else:
+            _DropDefaultProcessPool(pool)
+
+#############################################################################
+class Workflow:
+    """Workflow that defines a set of steps that should be taken to
+    execute a workflow.
+
+    :param steps: List of WorkflowSteps.
+    :param cacheDirectory: Directory where the cache of this Workflow
+    is stored. If None, the directory set with SetCacheDirectory() is
+    used. The directory may be shared by several Workflows and
+    processes.
+
+    """
+    def __init__(self, steps=None, cacheDirectory=None):
+        if (steps is None):
+            steps = []
+        self._Steps = steps
+        self._CacheDirectoryOverride = cacheDirectory
+        self._Cache = None
+        self._Memo = None
+        self._HashPool = None
+        self._ArtifactStore = None
+        self._Instrumentation = None
+        self._LogCapture = None
+        self._ResourceLimits = None
+        self._HashAlgorithm = None
+        self._WorkerPool = None
+        self._ProcessPool = None
+        self._ProcessPoolLock = threading.Lock()
+        self._TrackSharedLibraries = False
+        self._Executables = None
+        self._ExecutablesLock = threading.Lock()
+
+        # Indexes of the steps by name and by the files they write and
+        # read, covering the first _IndexedCount steps
+        self._StepsByName = {}
+        self._Producers = {}
+        self._Consumers = {}
+        self._IndexedCount = 0
+        self._UpdateIndexes()
+
+    def AddStep(self, step):
+        """Add a workflow step to the pipeline.
+
+        """
+        self._Steps.append(step)
+        self._UpdateIndexes()
+
+    def AddSteps(self, steps):
+        """Add several workflow steps to the pipeline, e.g., the steps
+        created by CLIWorkflowStepTemplate.Expand().
+
+        """
+        self._Steps.extend(steps)
+        self._UpdateIndexes()
+
+    def GetStep(self, name):
+        """Get the workflow step with the given name, or None if there is no
+        such step.
+
+        """
+        self._UpdateIndexes()
+        return self._StepsByName.get(name)
+
+    def GetProducers(self, path):
+        """Get the workflow steps that write a file, in the order they were
+        added.
+
+        """
+        self._UpdateIndexes()
+        return list(self._Producers.get(_NormalizePath(path), []))
+
+    def GetConsumers(self, path):
+        """Get the workflow steps that read a file, in the order they were
+        added.
+
+        """
+        self._UpdateIndexes()
+        return list(self._Consumers.get(_NormalizePath(path), []))
+
+    def _UpdateIndexes(self):
+        """Index the steps added since the indexes were last updated.
+
+        Steps should not be modified once they are added, but steps
+        appended directly to _Steps are picked up here.
+
+        """
+        if (self._IndexedCount > len(self._Steps)):
+            # Steps were removed, so start over
+            self._StepsByName = {}
+            self._Producers = {}
+            self._Consumers = {}
+            self._IndexedCount = 0
+
+        for step in self._Steps[self._IndexedCount:]:
+            step._Workflow = self
+
+            if (step.Name in self._StepsByName):
+                sys.stdout.write('Warning: workflow step name "%s" is not unique.\n' % step.Name)
+            self._StepsByName[step.Name] = step
+
+            files = _StepFiles(step)
+            if (files is not None):
+                reads, writes = files
+                for path in writes:
+                    self._Producers.setdefault(path, []).append(step)
+                for path in reads:
+                    self._Consumers.setdefault(path, []).append(step)
+
+        self._IndexedCount = len(self._Steps)
+
+    def Execute(self, dryRun=False, verbose=False, jobs=1, hashJobs=1, targets=None):
+        """Execute the WorkflowSteps in the Workflow if needed.
+
+        Dependencies between steps are inferred from their input and
+        output files: a step that reads a file written by a step added
+        before it runs after that step. Steps that do not depend on
+        each other may run concurrently. If a step fails, the steps
+        that depend on it are skipped, but the other steps still run.
+
+        :parameter dryRun: If set to True, does not actually execute the
+        WorkflowSteps, but reports those that would be executed as
+        Plan() finds them.
+        :parameter verbose: If set to True, tells the WorkflowStep to execute verbosely.
+        :parameter jobs: Maximum number of WorkflowSteps to run at the
+        same time. If None, the number of CPUs is used, or the number of
+        cores in the resource limits if it is larger, or the number of
+        worker slots with a WorkerPool. With a single
+        job, steps run in the order they were added to the Workflow.
+        With resource limits (see SetResourceLimits), the steps running
+        at the same time are further limited by the resources they
+        declare.
+        :parameter hashJobs: Maximum number of files hashed at the same
+        time, shared by all steps. Use a small number on spinning disks
+        and a larger one on fast storage. If None, the number of CPUs
+        is used.
+        :parameter targets: List of names of steps and paths of output
+        files. If given, only these steps, the steps that write these
+        files, and the steps they depend on are checked and executed.
+        Names of steps take precedence over paths.
+
+        Returns True if all steps that needed to be executed succeeded.
+
+        """
+        steps = self._SelectSteps(targets)
+
+        self._BeginRun(hashJobs)
+        try:
+            jobs = self._GetJobs(jobs)
+            scheduler = _Scheduler(steps, dryRun, verbose, jobs,
+                                   self._Instrumentation, self._ResourceLimits)
+            return scheduler.Run()
+        finally:
+            self._EndRun()
+
+    def Plan(self, jobs=1, hashJobs=1, targets=None):
+        """Find the WorkflowSteps that need to be executed, without executing
+        them.
+
+        Steps are checked once the steps they depend on are known to be
+        up-to-date. When a step needs to be executed, the steps that
+        depend on it, directly or not, are planned for execution too,
+        without hashing any of their files. They may still turn out to
+        be up-to-date when the workflow is executed, if the outputs of
+        the step are unchanged.
+
+        :parameter jobs: Maximum number of WorkflowSteps checked at the
+        same time, as in Execute().
+        :parameter hashJobs: Maximum number of files hashed at the same
+        time, as in Execute().
+        :parameter targets: List of names of steps and paths of output
+        files to restrict the plan to, as in Execute().
+
+        Returns a list of PlannedSteps, with the step and the reason it
+        needs to be executed, in the order the steps were added.
+
+        """
+        steps = self._SelectSteps(targets)
+
+        self._BeginRun(hashJobs)
+        try:
+            jobs = self._GetJobs(jobs)
+            scheduler = _Scheduler(steps, True, False, jobs, self._Instrumentation, quiet=True)
+            scheduler.Run()
+            return scheduler.GetPlan()
+        finally:
+            self._EndRun()
+
+    async def ExecuteAsync(self, dryRun=False, verbose=False, jobs=1, hashJobs=1, targets=None):
+        """Execute the WorkflowSteps in the Workflow if needed, without
+        blocking the asyncio event loop.
+
+        This is the coroutine counterpart of Execute(), and takes the
+        same parameters. Staleness checks and hashing run in the
+        default executor of the event loop, and the commands of
+        CLIWorkflowSteps are launched as asyncio subprocesses whose
+        output is forwarded as it arrives. Cancelling the coroutine
+        terminates the running commands.
+
+        Returns True if all steps that needed to be executed succeeded.
+
+        """
+        steps = self._SelectSteps(targets)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._BeginRun, hashJobs)
+        try:
+            jobs = self._GetJobs(jobs)
+            scheduler = _Scheduler(steps, dryRun, verbose, jobs,
+                                   self._Instrumentation, self._ResourceLimits)
+            return await scheduler.RunAsync()
+        finally:
+            await loop.run_in_executor(None, self._EndRun)
+
+    def Watch(self, verbose=False, jobs=1, hashJobs=1, interval=1.0, stopEvent=None):
+        """Execute the Workflow, then keep executing the steps affected by
+        changes to the files it reads as soon as they change.
+
+        The files read by the steps that are not written by other
+        steps, and the executables, are watched with inotify, or polled
+        on platforms without it. When some change, only the steps that
+        read them and the steps that depend on those are checked and
+        executed. The cache and the hashes computed are kept in memory
+        between runs, so unchanged files are not hashed again.
+
+        Steps should not be added to the Workflow while it is watched.
+
+        :parameter verbose: If set to True, tells the WorkflowStep to execute verbosely.
+        :parameter jobs: Maximum number of WorkflowSteps to run at the
+        same time, as in Execute().
+        :parameter hashJobs: Maximum number of files hashed at the same
+        time, as in Execute().
+        :parameter interval: Seconds between two polls when files are
+        polled.
+        :parameter stopEvent: threading.Event that stops watching when
+        it is set. Otherwise, watching stops on KeyboardInterrupt.
+
+        """
+        self._BeginRun(hashJobs)
+        try:
+            jobs = self._GetJobs(jobs)
+            self._RunWatchedSteps(self._Steps, verbose, jobs)
+
+            sources = self._GetWatchedFiles()
+            predecessors = _FindDependencies(self._Steps)
+            successors = [[] for step in self._Steps]
+            for index, deps in enumerate(predecessors):
+                for dep in deps:
+                    successors[dep].append(index)
+
+            watcher = watch.CreateWatcher(sorted(sources), interval)
+            try:
+                sys.stdout.write('Watching %d files for changes.\n' % len(sources))
+                sys.stdout.flush()
+                while (stopEvent is None or not stopEvent.is_set()):
+                    changed = watcher.Wait(interval)
+                    if (len(changed) == 0):
+                        continue
+
+                    for path in sorted(changed):
+                        sys.stdout.write('File "%s" changed.\n' % path)
+
+                    # Select the steps downstream of the changes
+                    stack = []
+                    for path in changed:
+                        for index, spelling in sources.get(path, []):
+                            self._Memo.Invalidate([spelling])
+                            if (os.path.isdir(spelling)):
+                                self._Memo.InvalidateTree(spelling)
+                            stack.append(index)
+
+                    selected = set()
+                    while (len(stack) > 0):
+                        index = stack.pop()
+                        if (index not in selected):
+                            selected.add(index)
+                            stack.extend(successors[index])
+
+                    # Executables may have been replaced
+                    self._Executables = {}
+                    self._RunWatchedSteps([self._Steps[index] for index in sorted(selected)],
+                                          verbose, jobs)
+            finally:
+                watcher.Close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._EndRun()
+
+    def _RunWatchedSteps(self, steps, verbose, jobs):
+        """Run some steps during Watch() and save the cache.
+
+        """
+        scheduler = _Scheduler(steps, False, verbose, jobs,
+                               self._Instrumentation, self._ResourceLimits)
+        scheduler.Run()
+        self._FlushCache()
+        sys.stdout.flush()
+
+    def _GetWatchedFiles(self):
+        """Get the files watched by Watch().
+
+        Returns a dictionary mapping the normalized path of each file
+        to a list of (index of the step, path as given by the step)
+        tuples for the steps that read it.
+
+        """
+        sources = {}
+        for index, step in enumerate(self._Steps):
+            paths = list(getattr(step, 'InputFiles', []))
+            executable = getattr(step, 'Executable', None)
+            if (executable):
+                executable = hashing.ResolveExecutable(executable)
+                if (executable is not None):
+                    paths.append(executable)
+
+            for path in paths:
+                normalizedPath = _NormalizePath(path)
+                if (normalizedPath in self._Producers):
+                    # Written by the workflow itself
+                    continue
+                sources.setdefault(normalizedPath, []).append((index, path))
+
+        return sources
+
+    def _SelectSteps(self, targets):
+        """Get the steps needed to bring the targets up-to-date, in the order
+        they were added.
+
+        Raises ValueError if a target is neither the name of a step nor
+        the path of a file written by a step.
+
+        """
+        if (targets is None):
+            return self._Steps
+
+        self._UpdateIndexes()
+        indexes = dict((id(step), index) for index, step in enumerate(self._Steps))
+
+        stack = []
+        for target in targets:
+            step = self._StepsByName.get(target)
+            if (step is None):
+                producers = self._Producers.get(_NormalizePath(target))
+                if (not producers):
+                    raise ValueError('Target "%s" is neither a workflow step nor an output of one.' %
+                                     target)
+                # The last step to write the file determines its contents
+                step = producers[-1]
+            stack.append(indexes[id(step)])
+
+        predecessors = _FindDependencies(self._Steps)
+        selected = set()
+        while (len(stack) > 0):
+            index = stack.pop()
+            if (index in selected):
+                continue
+            selected.add(index)
+            stack.extend(predecessors[index])
+
+        return [self._Steps[index] for index in sorted(selected)]
+
+    def _GetJobs(self, jobs):
+        """Get the number of steps that may run at the same time.
+
+        """
+        if (jobs is None and self._WorkerPool is not None):
+            jobs = self._WorkerPool.Slots
+        if (jobs is None):
+            jobs = os.cpu_count() or 1
+            if (self._ResourceLimits is not None and self._ResourceLimits.Cores is not None):
+                jobs = max(jobs, int(self._ResourceLimits.Cores))
+
+        return max(1, jobs)
+
+    def _BeginRun(self, hashJobs):
+        """Set up the state shared by the steps during a run.
+
+        """
+        if (hashJobs is None):
+            hashJobs = os.cpu_count() or 1
+
+        if (self._WorkerPool is not None):
+            self._WorkerPool.Open()
+
+        # Load the cache once for the whole run, and share the hashes
+        # computed during the run between all steps
+        self._Cache = cache.HashCache(self.GetCacheDirectory())
+        self._Memo = hashing.HashMemo()
+        if (hashJobs > 1):
+            self._HashPool = concurrent.futures.ThreadPoolExecutor(hashJobs)
+        self._Executables = {}
+
+        self._UpdateIndexes()
+        for s in self._Steps:
+            s._Workflow = self
+
+    def _EndRun(self):
+        """Save and release the state shared by the steps during a run.
+
+        """
+        # Save refreshed entries
+        self._FlushCache()
+        self._Memo = None
+        self._Executables = None
+        if (self._HashPool is not None):
+            self._HashPool.shutdown()
+            self._HashPool = None
+        if (self._ArtifactStore is not None):
+            self._ArtifactStore.Evict()
+        if (self._WorkerPool is not None):
+            self._WorkerPool.Close()
+
+    def _FlushCache(self):
+        """Write the pending entries of the cache, warning if it cannot be
+        written since the steps have already run.
+
+        """
+        try:
+            self._Cache.Flush()
+        except (IOError, OSError) as e:
+            sys.stdout.write('Could not write cache file in "%s": %s\n' % (self._Cache.Directory, e))
+
+    def ClearCache(self):
+        """Clear the cache for all steps in the Workflow.
+
+        Note that this will force re-execution of all steps in the
+        Workflow.
+
+        """
+        sys.stdout.write('Clearing cache\n')
+
+        # Remove all SHA256 entries from the cache
+        for step in self._Steps:
+            step._Workflow = self
+            step.ClearCache()
+
+    def SetArtifactStore(self, artifactStore):
+        """Set the ArtifactStore where the outputs of the steps in this
+        Workflow are stored after they execute.
+
+        When a step needs to be executed with an executable, inputs and
+        arguments that were seen before, its outputs are restored from
+        the store instead of executing it. Set to None to disable.
+
+        """
+        self._ArtifactStore = artifactStore
+
+    def SetInstrumentation(self, instrumentation):
+        """Set the Instrumentation that records measurements of the steps in
+        this Workflow when it is executed. Set to None to disable.
+
+        """
+        self._Instrumentation = instrumentation
+
+    def SetLogCapture(self, logCapture):
+        """Set the LogCapture that writes the output of the commands of the
+        steps in this Workflow to a log file per step instead of the
+        console. When a step fails, the end of its log is shown. Set to
+        None to disable.
+
+        """
+        self._LogCapture = logCapture
+
+    def SetResourceLimits(self, cores=None, memory=None, tokens=None, pinCores=False):
+        """Set the resources available to the steps of this Workflow when
+        they execute in parallel.
+
+        Steps declare the resources they use with
+        WorkflowStep.SetResources(). A step only executes once the
+        resources it needs are available, and ready steps that fit are
+        started in the order they were added. A step that needs more
+        than the limits executes alone. Checking whether a step is
+        up-to-date does not use its resources. Set all limits to None
+        to remove the limits.
+
+        :param cores: Number of cores available, or None for no limit.
+        :param memory: Memory available in bytes, or None for no limit.
+        :param tokens: Dictionary mapping names of other resources to
+        the amount available. Resources that are not listed are not
+        limited.
+        :param pinCores: If True, each executing step is pinned to as
+        many CPUs as it uses cores, taken among the CPUs this process
+        may run on. Steps with their own affinity keep it.
+
+        """
+        if (cores is None and memory is None and not tokens and not pinCores):
+            self._ResourceLimits = None
+            return
+
+        cpus = None
+        if (pinCores):
+            try:
+                cpus = sorted(os.sched_getaffinity(0))
+            except AttributeError:
+                cpus = list(range(os.cpu_count() or 1))
+            if (cores is None or cores > len(cpus)):
+                cores = len(cpus)
+
+        self._ResourceLimits = _ResourceLimits(cores, memory, tokens, cpus)
+
+    def SetWorkerPool(self, workerPool):
+        """Set the WorkerPool (see steady.distributed) the commands of the
+        CLIWorkflowSteps in this Workflow are dispatched to.
+
+        The workers must see the files of the workflow at the same
+        paths as this process. Staleness checks, caching and the
+        ArtifactStore still run in this process. Set to None to run
+        commands locally.
+
+        """
+        self._WorkerPool = workerPool
+
+    def SetProcessPool(self, processPool):
+        """Set the executor that calls the functions of the
+        PythonWorkflowSteps in this Workflow.
+
+        By default, a concurrent.futures.ProcessPoolExecutor with a
+        worker per CPU is created when the first PythonWorkflowStep
+        executes, and kept for the lifetime of the Workflow so that the
+        modules imported by the functions stay loaded between runs.
+        Any concurrent.futures.Executor can be set instead, e.g., a
+        ThreadPoolExecutor to call the functions in this process. A
+        process pool broken by a worker process that died is replaced
+        by a default one.
+
+        """
+        with self._ProcessPoolLock:
+            self._ProcessPool = processPool
+
+    def _GetProcessPool(self):
+        """Get the executor of the PythonWorkflowSteps, creating the default
+        one if needed.
+
+        """
+        with self._ProcessPoolLock:
+            if (self._ProcessPool is None):
+                self._ProcessPool = _CreateProcessPool()
+
+            return self._ProcessPool
+
+    def _DropProcessPool(self, pool):
+        """Replace a process pool that a dead worker process broke by a new
+        default one, created when it is next needed.
+
+        Several steps may find that the pool is broken, so it is only
+        dropped if it is still the current one.
+
+        """
+        with self._ProcessPoolLock:
+            if (self._ProcessPool is pool):
+                self._ProcessPool = None
+        pool.shutdown(wait=False)
+
+    def SetHashAlgorithm(self, algorithm):
+        """Set the algorithm used to hash the files of the steps in this
+        Workflow, unless a step sets its own.
+
+        :param algorithm: 'sha256' (the default), 'blake2b', or
+        'sampled' (see CLIWorkflowStep.SetHashAlgorithm).
+
+        """
+        hashing.CheckAlgorithm(algorithm)
+        self._HashAlgorithm = algorithm
+
+    def SetTrackSharedLibraries(self, track):
+        """Set whether the shared libraries loaded by the executables of the
+        steps in this Workflow are part of their fingerprint.
+
+        When enabled, upgrading a shared library used by an executable
+        causes the steps that run it to be executed again. The
+        libraries are found with ldd once per executable and cached
+        until the executable changes.
+
+        """
+        self._TrackSharedLibraries = track
+
+    def _FingerprintExecutable(self, executable):
+        """Get the fingerprint of an executable, computing it at most once
+        per run.
+
+        The lock is only held to find or register the future of the
+        fingerprint, so that steps with different executables hash them
+        in parallel, and steps with the same executable wait for the
+        step that hashes it.
+
+        """
+        with self._ExecutablesLock:
+            executables = self._Executables
+            if (executables is None):
+                future = None
+            elif (executable in executables):
+                return executables[executable].result()
+            else:
+                future = concurrent.futures.Future()
+                executables[executable] = future
+
+        try:
+            fingerprint = _FingerprintExecutable(executable, self._GetCache(),
+                                                 self._TrackSharedLibraries)
+        except BaseException as e:
+            if (future is not None):
+                future.set_exception(e)
+            raise
+        if (future is not None):
+            future.set_result(fingerprint)
+
+        return fingerprint
+
+    def MigrateCache(self, removeOld=False, verbose=False):
+        """Import the per-file SHA256 cache files written by earlier versions
+        of steady for the steps in this Workflow into the cache.
+
+        :parameter removeOld: If set to True, delete the imported files.
+        :parameter verbose: If set to True, report each imported file.
+
+        Returns the number of imported entries.
+
+        """
+        stepFiles = []
+        for step in self._Steps:
+            if (isinstance(step, CLIWorkflowStep)):
+                stepFiles.append((step.Name, [step.Executable] + step.InputFiles + step.OutputFiles))
+
+        return cache.MigrateSHA256Files(self._GetCache(), stepFiles, removeOld, verbose)
+
+    def CollectGarbage(self, maxAge=None, maxEntries=None, maxSize=None,
+                       removeUnreferenced=False, removeLegacy=False, verbose=False):
+        """Remove cache entries that are not needed anymore and compact the
+        cache.
+
+        :parameter maxAge: Remove entries not used for this many days.
+        :parameter maxEntries: Keep at most this many entries, removing
+        the least recently used ones.
+        :parameter maxSize: Keep the cache below this many bytes,
+        removing the least recently used entries.
+        :parameter removeUnreferenced: If set to True, remove the
+        entries of steps and files that are not in this Workflow. Only
+        use this if the cache directory is not shared with other
+        workflows, which the default '/tmp' is.
+        :parameter removeLegacy: If set to True, remove the per-file
+        SHA256 files written by earlier versions of steady. Run
+        MigrateCache() first to keep their contents.
+        :parameter verbose: If set to True, report each removed file.
+
+        Returns the number of removed entries.
+
+        """
+        keep = None
+        if (removeUnreferenced):
+            referenced = set()
+            for step in self._Steps:
+                if (isinstance(step, CLIWorkflowStep)):
+                    for path in [step.Executable, _ArgumentsCacheKey] + step.InputFiles + step.OutputFiles:
+                        referenced.add((step.Name, path))
+
+            def keep(stepName, path):
+                # Executables and libraries are pruned by age and size only
+                return ((stepName, path) in referenced or
+                        stepName in [_ExecutablesCacheKey, _LibrariesCacheKey])
+
+        if (maxAge is not None):
+            maxAge = maxAge * 24 * 3600
+
+        hashCache = self._GetCache()
+        count = hashCache.CollectGarbage(keep, maxAge, maxEntries, maxSize)
+        sys.stdout.write('Removed %d cache entries.\n' % count)
+
+        if (removeLegacy):
+            legacyCount = cache.RemoveLegacySHA256Files(hashCache.Directory, verbose)
+            sys.stdout.write('Removed %d legacy SHA256 files.\n' % legacyCount)
+
+        return count
+
+    def GetCacheDirectory(self):
+        """Get the directory where the cache of this Workflow is stored.
+
+        This is the directory given when the Workflow was created, or
+        the directory set with SetCacheDirectory() otherwise.
+
+        """
+        if (self._CacheDirectoryOverride is not None):
+            return self._CacheDirectoryOverride
+
+        return Workflow._CacheDirectory
+
+    def _GetCache(self):
+        """Get the HashCache for this Workflow, loading it if needed.
+
+        """
+        directory = self.GetCacheDirectory()
+        if (self._Cache is None or self._Cache.Directory != directory):
+            self._Cache = cache.HashCache(directory)
+
+        return self._Cache
+
+    """Shared HashCache for steps that do not belong to a Workflow."""
+    _DefaultCache = None
+
+    @staticmethod
+    def _GetDefaultCache():
+        """Get the HashCache for steps that do not belong to a Workflow.
+
+        """
+        if (Workflow._DefaultCache is None or
+            Workflow._DefaultCache.Directory != Workflow._CacheDirectory):
+            Workflow._DefaultCache = cache.HashCache(Workflow._CacheDirectory)
+
+        return Workflow._DefaultCache
+
+    """Location where temporary files are stored."""
+    _CacheDirectory = '/tmp'
+
+    """If True, always hash files instead of trusting unchanged stats."""
+    _Paranoid = False
+
+    @staticmethod
+    def SetCacheDirectory(directory):
+        """Set the directory where the cached SHA256 files are stored.
+
+        This applies to all Workflows that were not given their own
+        cache directory when they were created.
+
+        """
+        sys.stdout.write('Setting cache directory to "%s"\n' % directory)
+        Workflow._CacheDirectory = directory
+
+        # Warn if directory doesn't exit
+        if (not os.path.isdir(directory)):
+            sys.stdout.write('Cache directory "%s" does not exist.\n' % directory)
+
+    @staticmethod
+    def SetParanoid(paranoid):
+        """Set whether files are always fully hashed when checking whether
+        WorkflowSteps need to be updated.
+
+        By default, a file whose size, modification time, inode and
+        device match those recorded when its SHA256 was cached is
+        assumed to be unchanged and is not hashed again. In paranoid
+        mode, the SHA256 of every file is always recomputed.
+
+        """
+        Workflow._Paranoid = paranoid
+
+
+#############################################################################
+"""Names under which the fingerprints of executables and shared libraries,
+and the lists of shared libraries of executables, are cached. They are
+shared by all steps."""
+_ExecutablesCacheKey = '<executables>'
+_LibrariesCacheKey = '<shared-libraries>'
+
+"""Path under which the SHA256 of the arguments and tracked environment of
+a step is cached in the entries of the step."""
+_ArgumentsCacheKey = '<arguments>'
+
+def _CachedFileSHA256(hashCache, path):
+    """Get the SHA256 of a file shared by many steps, such as an executable
+    or a shared library, hashing it only if its stat identity changed
+    since it was last cached.
+
+    """
+    entry = hashCache.Get(_ExecutablesCacheKey, path)
+    statIdentity = hashing.StatIdentity(path)
+    if (not Workflow._Paranoid and entry is not None and entry.get('stat') is not None and
+        tuple(entry['stat']) == statIdentity):
+        return entry['sha256']
+
+    sha256Value = hashing.ComputeSHA256(path)
+
+    recordedStat = None
+    if (hashing.IsCacheableStat(statIdentity) and statIdentity == hashing.StatIdentity(path)):
+        recordedStat = list(statIdentity)
+    hashCache.Set(_ExecutablesCacheKey, path, {'sha256': sha256Value, 'stat': recordedStat})
+
+    return sha256Value
+
+def _FingerprintExecutable(executable, hashCache, trackSharedLibraries):
+    """Compute the fingerprint of an executable.
+
+    :param executable: Name or path of the executable.
+    :param hashCache: HashCache where fingerprints are cached.
+    :param trackSharedLibraries: If True, the SHA256 of the shared
+    libraries loaded by the executable are part of the fingerprint.
+
+    """
+    path = hashing.ResolveExecutable(executable) or executable
+    sha256Value = _CachedFileSHA256(hashCache, path)
+    if (not trackSharedLibraries):
+        return sha256Value
+
+    # The list of libraries only changes with the executable
+    entry = hashCache.Get(_LibrariesCacheKey, path)
+    statIdentity = hashing.StatIdentity(path)
+    if (entry is not None and entry.get('stat') is not None and
+        tuple(entry['stat']) == statIdentity):
+        libraries = entry['libraries']
+    else:
+        libraries = hashing.SharedLibraries(path)
+        recordedStat = None
+        if (hashing.IsCacheableStat(statIdentity)):
+            recordedStat = list(statIdentity)
+        hashCache.Set(_LibrariesCacheKey, path, {'libraries': libraries, 'stat': recordedStat})
+
+    m = hashlib.sha256(sha256Value.encode('ascii'))
+    for library in libraries:
+        m.update(b'\0')
+        m.update(library.encode('utf-8', 'surrogateescape'))
+        m.update(b'\0')
+        m.update(_CachedFileSHA256(hashCache, library).encode('ascii'))
+
+    return m.hexdigest()
+
+
+def _FingerprintFunction(function):
+    """Get the fingerprint of a Python function from its source, or from
+    its bytecode and constants if the source is not available.
+
+    """
+    m = hashlib.sha256()
+    m.update(('%s.%s\n' % (function.__module__, function.__qualname__)).encode('utf-8'))
+    try:
+        m.update(inspect.getsource(function).encode('utf-8'))
+    except (IOError, OSError, TypeError):
+        _UpdateHashFromCode(m, function.__code__)
+        m.update(repr(function.__defaults__).encode('utf-8'))
+
+    return m.hexdigest()
+
+def _UpdateHashFromCode(m, code):
+    """Feed the bytecode of a code object and of the code objects nested
+    in it to a hash object.
+
+    """
+    m.update(code.co_code)
+    m.update(repr(code.co_names).encode('utf-8'))
+    for constant in code.co_consts:
+        if (isinstance(constant, types.CodeType)):
+            _UpdateHashFromCode(m, constant)
+        else:
+            m.update(repr(constant).encode('utf-8'))
+
+#############################################################################
+def _StepFiles(step):
+    """Get the normalized paths read and written by a WorkflowStep, or None
+    if the step does not declare them.
+
+    """
+    if (not hasattr(step, 'InputFiles') or not hasattr(step, 'OutputFiles')):
+        return None
+
+    reads = [_NormalizePath(path) for path in step.InputFiles]
+    if (getattr(step, 'Executable', None) and os.path.dirname(step.Executable)):
+        reads.append(_NormalizePath(step.Executable))
+    writes = [_NormalizePath(path) for path in step.OutputFiles]
+
+    return (reads, writes)
+
+def _NormalizePath(path):
+    """Normalize a path so that different spellings of the same file match.
+
+    """
+    return os.path.normpath(os.path.abspath(path))
+
+def _FindDependencies(steps):
+    """Find the steps each WorkflowStep depends on.
+
+    A step depends on the last step added before it that writes one
+    of its inputs or outputs, and on the steps added before it that
+    read one of its outputs since that write. A path is related to the
+    directories containing it and to the paths inside it, so a step
+    reading a file in a directory written by another step depends on
+    it, and vice versa. Steps that do not
+    declare their files depend on every step added before them, and
+    every step added after them depends on them.
+
+    Returns a list with the set of indices of the predecessors of
+    each step.
+
+    """
+    predecessors = []
+    lastWriter = {}
+    readers = {}
+    barrier = None
+    since = []
+
+    # Paths of lastWriter and readers, and the paths directly inside
+    # each of their parent directories, to find paths inside a directory
+    known = set()
+    children = {}
+
+    for index, step in enumerate(steps):
+        files = _StepFiles(step)
+        if (files is None):
+            # Unknown files, so wait for all previous steps
+            deps = set(since)
+            if (barrier is not None):
+                deps.add(barrier)
+            predecessors.append(deps)
+            barrier = index
+            since = []
+            lastWriter = {}
+            readers = {}
+            known = set()
+            children = {}
+            continue
+
+        since.append(index)
+
+        deps = set()
+        if (barrier is not None):
+            deps.add(barrier)
+
+        reads, writes = files
+        for path in reads:
+            for related in _RelatedPaths(path, known, children):
+                if (related in lastWriter):
+                    deps.add(lastWriter[related])
+        for path in writes:
+            for related in _RelatedPaths(path, known, children):
+                if (related in lastWriter):
+                    deps.add(lastWriter[related])
+                deps.update(readers.get(related, []))
+
+        for path in reads + writes:
+            if (path not in known):
+                known.add(path)
+                _AddChild(path, children)
+        for path in reads:
+            readers.setdefault(path, []).append(index)
+        for path in writes:
+            lastWriter[path] = index
+            readers[path] = []
+
+        deps.discard(index)
+        predecessors.append(deps)
+
+    return predecessors
+
+
+def _Parents(path):
+    """Iterate over the parent directories of a normalized path, from the
+    closest one. This is os.path.dirname() without its overhead, which
+    matters with many steps.
+
+    """
+    while True:
+        head, sep, tail = path.rpartition(os.sep)
+        if (not sep):
+            return
+        parent = head or sep
+        if (parent == path):
+            return
+        yield parent
+        path = parent
+
+def _AddChild(path, children):
+    """Link a normalized path to its parent directories in a dictionary
+    mapping each directory to the set of the paths directly inside it.
+
+    """
+    for parent in _Parents(path):
+        siblings = children.get(parent)
+        if (siblings is not None):
+            siblings.add(path)
+            return
+        children[parent] = set([path])
+        path = parent
+
+def _RelatedPaths(path, known, children):
+    """Get the known paths that are the same as a normalized path, that
+    contain it, or that are inside it.
+
+    The cost is the depth of the path plus the number of paths inside
+    it, whatever the number of known paths.
+
+    :param known: Set of the known normalized paths.
+    :param children: Dictionary mapping the directories containing
+    known paths to the paths directly inside them, as built by
+    _AddChild().
+
+    """
+    related = []
+    if (path in known):
+        related.append(path)
+
+    for parent in _Parents(path):
+        if (parent in known):
+            related.append(parent)
+
+    stack = list(children.get(path, []))
+    while (len(stack) > 0):
+        other = stack.pop()
+        if (other in known):
+            related.append(other)
+        stack.extend(children.get(other, []))
+
+    return related
+
+#############################################################################
+class _Scheduler(object):
+    """Runs WorkflowSteps that need to be updated once the steps they depend
+    on have finished, using up to a given number of threads.
+
+    """
+    def __init__(self, steps, dryRun, verbose, jobs, instrumentation=None, resourceLimits=None,
+                 quiet=False):
+        self._Steps = steps
+        self._DryRun = dryRun
+        self._Verbose = verbose
+        self._Jobs = jobs
+        self._Quiet = quiet
+        self._Instrumentation = instrumentation
+        self._Resources = None
+        if (resourceLimits is not None and jobs > 1):
+            self._Resources = _ResourcePool(resourceLimits)
+
+        self._Predecessors = _FindDependencies(steps)
+        self._Successors = [[] for step in steps]
+        for index, deps in enumerate(self._Predecessors):
+            for dep in deps:
+                self._Successors[dep].append(index)
+
+    def Run(self):
+        """Run the steps.
+
+        Returns True if no step failed.
+
+        """
+        self._Reset()
+
+        if (self._Jobs == 1):
+            # Run in insertion order in the calling thread
+            while (len(self._Ready) > 0 or len(self._Parked) > 0):
+                for batch in self._TakeBatches(len(self._Ready) == 0):
+                    self._Collect(batch, self._RunBatch(batch))
+
+                if (len(self._Ready) > 0):
+                    index = heapq.heappop(self._Ready)
+                    self._Collect(index, self._RunStep(index))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self._Jobs) as pool:
+                running = {}
+                while (len(self._Ready) > 0 or len(running) > 0 or len(self._Parked) > 0):
+                    idle = (len(self._Ready) == 0 and len(running) == 0)
+                    for batch in self._TakeBatches(idle):
+                        running[pool.submit(self._RunBatch, batch)] = batch
+
+                    while (len(self._Ready) > 0 and len(running) < self._Jobs):
+                        index = heapq.heappop(self._Ready)
+                        running[pool.submit(self._RunStep, index)] = index
+
+                    done, notDone = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self._Collect(running.pop(future), future.result())
+
+        return 'failed' not in self._Status
+
+    async def RunAsync(self):
+        """Run the steps as asyncio tasks.
+
+        Returns True if no step failed.
+
+        """
+        self._Reset()
+
+        # Signaled when resources are released
+        self._ResourcesReleased = asyncio.Condition()
+
+        running = {}
+        try:
+            while (len(self._Ready) > 0 or len(running) > 0 or len(self._Parked) > 0):
+                idle = (len(self._Ready) == 0 and len(running) == 0)
+                for batch in self._TakeBatches(idle):
+                    running[asyncio.ensure_future(self._RunBatchAsync(batch))] = batch
+
+                while (len(self._Ready) > 0 and len(running) < self._Jobs):
+                    index = heapq.heappop(self._Ready)
+                    running[asyncio.ensure_future(self._RunStepAsync(index))] = index
+
+                done, notDone = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self._Collect(running.pop(task), task.result())
+        except asyncio.CancelledError:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+
+        return 'failed' not in self._Status
+
+    def _Reset(self):
+        """Initialize the state of a run.
+
+        """
+        self._Waiting = [len(deps) for deps in self._Predecessors]
+        self._Status = [None] * len(self._Steps)
+        self._Ready = [index for index, count in enumerate(self._Waiting) if count == 0]
+        heapq.heapify(self._Ready)
+
+        # Stale steps waiting to be executed in batches, by batch key
+        self._Parked = collections.OrderedDict()
+
+        # Why each step needs to be executed, or None
+        self._Reasons = [None] * len(self._Steps)
+
+    async def _RunStepAsync(self, index):
+        """Check whether a step needs to be updated and execute it if so,
+        from an asyncio event loop.
+
+        Returns True if the step is up-to-date or executed successfully.
+
+        """
+        step = self._Steps[index]
+        loop = asyncio.get_running_loop()
+        self._StartStep(step)
+        status = 'failed'
+        try:
+            reason = await loop.run_in_executor(None, step.GetUpdateReason)
+            if (reason is None):
+                self._Report('Workflow step "%s" is up-to-date.' % step.Name)
+                status = 'up-to-date'
+                return True
+
+            self._Reasons[index] = reason
+            self._Report('Workflow step "%s" needs to be executed: %s.' % (step.Name, reason))
+            if (self._DryRun):
+                status = 'dry-run'
+                return True
+
+            if (self._IsBatched(step)):
+                status = None
+                return _Parked
+
+            if (self._Resources is not None):
+                async with self._ResourcesReleased:
+                    await self._ResourcesReleased.wait_for(
+                        lambda: self._Resources.TryAcquire(step))
+            try:
+                success = await step.ExecuteAsync(self._Verbose)
+            finally:
+                if (self._Resources is not None):
+                    self._Resources.Release(step)
+                    async with self._ResourcesReleased:
+                        self._ResourcesReleased.notify_all()
+            if (success):
+                status = 'executed'
+            return success
+        except Exception as e:
+            sys.stdout.write('Workflow step "%s" failed: %s\n' % (step.Name, e))
+            return False
+        finally:
+            if (status is not None):
+                self._FinishStep(step, status)
+
+    def _RunStep(self, index):
+        """Check whether a step needs to be updated and execute it if so.
+
+        Returns True if the step is up-to-date or executed successfully.
+
+        """
+        step = self._Steps[index]
+        self._StartStep(step)
+        status = 'failed'
+        try:
+            reason = step.GetUpdateReason()
+            if (reason is None):
+                self._Report('Workflow step "%s" is up-to-date.' % step.Name)
+                status = 'up-to-date'
+                return True
+
+            self._Reasons[index] = reason
+            self._Report('Workflow step "%s" needs to be executed: %s.' % (step.Name, reason))
+            if (self._DryRun):
+                status = 'dry-run'
+                return True
+
+            if (self._IsBatched(step)):
+                status = None
+                return _Parked
+
+            if (self._Resources is not None):
+                self._Resources.Acquire(step)
+            try:
+                success = step.Execute(self._Verbose)
+            finally:
+                if (self._Resources is not None):
+                    self._Resources.Release(step)
+            if (success):
+                status = 'executed'
+            return success
+        except Exception as e:
+            sys.stdout.write('Workflow step "%s" failed: %s\n' % (step.Name, e))
+            return False
+        finally:
+            if (status is not None):
+                self._FinishStep(step, status)
+
+    async def _RunBatchAsync(self, batch):
+        """Execute a batch of steps from an asyncio event loop.
+
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._RunBatch, batch)
+        finally:
+            if (self._Resources is not None):
+                async with self._ResourcesReleased:
+                    self._ResourcesReleased.notify_all()
+
+    def _RunBatch(self, batch):
+        """Execute a batch of stale steps in one invocation.
+
+        Returns a list of whether each step executed successfully.
+
+        """
+        steps = [self._Steps[index] for index in batch]
+        try:
+            if (self._Resources is not None):
+                self._Resources.Acquire(steps[0])
+            try:
+                results = _ExecuteBatch(steps, self._Verbose)
+            finally:
+                if (self._Resources is not None):
+                    self._Resources.Release(steps[0])
+        except Exception as e:
+            sys.stdout.write('Workflow steps "%s" failed: %s\n' %
+                             ('", "'.join(step.Name for step in steps), e))
+            results = [False] * len(steps)
+
+        for step, success in zip(steps, results):
+            self._FinishStep(step, 'executed' if success else 'failed')
+
+        return results
+
+    def _IsBatched(self, step):
+        """Returns True if a stale step should wait to be executed in a
+        batch.
+
+        """
+        getBatchKey = getattr(step, '_GetBatchKey', None)
+        return (getBatchKey is not None and getBatchKey() is not None)
+
+    def _TakeBatches(self, idle):
+        """Take the batches of parked steps that are ready to be executed.
+
+        Batches that reached their maximum size are always taken. When
+        nothing else is ready or running, no more steps can join the
+        batches, so all parked steps are taken, split in up to one
+        batch per job.
+
+        """
+        batches = []
+        for key in list(self._Parked):
+            indices = self._Parked[key]
+            indices.sort()
+            maxSize = self._Steps[indices[0]].BatchSize
+            while (maxSize is not None and len(indices) >= maxSize):
+                batches.append(indices[:maxSize])
+                del indices[:maxSize]
+
+            if (idle and len(indices) > 0):
+                count = min(self._Jobs, len(indices))
+                size = int(math.ceil(len(indices) / float(count)))
+                batches.extend(indices[i:i + size] for i in range(0, len(indices), size))
+                del indices[:]
+
+            if (len(indices) == 0):
+                del self._Parked[key]
+
+        return batches
+
+    def _Collect(self, task, result):
+        """Record the result of a step or of a batch of steps.
+
+        """
+        if (isinstance(task, list)):
+            for index, success in zip(task, result):
+                self._Finish(index, success)
+        elif (result is _Parked):
+            step = self._Steps[task]
+            self._Parked.setdefault(step._GetBatchKey(), []).append(task)
+        else:
+            self._Finish(task, result)
+
+    def GetPlan(self):
+        """Get the steps that need to be executed and why, in the order they
+        were given, as a list of PlannedSteps.
+
+        """
+        return [PlannedStep(step, reason) for step, reason in zip(self._Steps, self._Reasons)
+                if reason is not None]
+
+    def _Report(self, message):
+        """Show the status of a step unless the scheduler is quiet.
+
+        """
+        if (not self._Quiet):
+            sys.stdout.write(message + '\n')
+
+    def _StartStep(self, step):
+        """Start the instrumentation record of a step.
+
+        """
+        if (self._Instrumentation is not None):
+            self._Instrumentation.StartStep(step)
+
+    def _FinishStep(self, step, status):
+        """Finish the instrumentation record of a step.
+
+        """
+        if (self._Instrumentation is not None):
+            self._Instrumentation.FinishStep(step, status)
+
+    def _Finish(self, index, success):
+        """Record the result of a step and release the steps waiting on it.
+
+        """
+        if (not success):
+            self._Status[index] = 'failed'
+            self._SkipDescendants(index)
+            return
+
+        self._Status[index] = 'done'
+        if (self._DryRun and self._Reasons[index] is not None):
+            self._InvalidateDescendants(index)
+            return
+
+        for successor in self._Successors[index]:
+            self._Waiting[successor] -= 1
+            if (self._Waiting[successor] == 0 and self._Status[successor] is None):
+                heapq.heappush(self._Ready, successor)
+
+    def _InvalidateDescendants(self, index):
+        """Mark all steps that depend on a stale step as stale without
+        checking them, since their inputs are about to be rewritten.
+
+        This is used in dry runs, where the stale step is not executed
+        and checking its descendants would compare them to the files it
+        would overwrite.
+
+        """
+        staleName = self._Steps[index].Name
+        stack = list(self._Successors[index])
+        while (len(stack) > 0):
+            successor = stack.pop()
+            if (self._Status[successor] is not None):
+                continue
+            self._Status[successor] = 'done'
+            self._Reasons[successor] = 'it depends on "%s", which needs to be executed' % staleName
+            self._Report('Workflow step "%s" needs to be executed: %s.' %
+                         (self._Steps[successor].Name, self._Reasons[successor]))
+            stack.extend(self._Successors[successor])
+
+    def _SkipDescendants(self, index):
+        """Mark all steps that depend on a failed step as skipped.
+
+        """
+        failedName = self._Steps[index].Name
+        stack = list(self._Successors[index])
+        while (len(stack) > 0):
+            successor = stack.pop()
+            if (self._Status[successor] is not None):
+                continue
+            self._Status[successor] = 'skipped'
+            sys.stdout.write('Workflow step "%s" skipped because "%s" failed.\n' %
+                             (self._Steps[successor].Name, failedName))
+            stack.extend(self._Successors[successor])
+
+"""Result of a step that waits to be executed in a batch."""
+_Parked = object()
+
+"""A step that needs to be executed and why, as planned by Workflow.Plan()."""
+PlannedStep = collections.namedtuple('PlannedStep', ['Step', 'Reason'])
+
+#############################################################################
+class _ResourceLimits(object):
+    """Resources available to the steps of a Workflow.
+
+    """
+    def __init__(self, cores=None, memory=None, tokens=None, cpus=None):
+        self.Cores = cores
+        self.Memory = memory
+        self.Tokens = dict(tokens or {})
+        self.CPUs = cpus
+
+class _ResourcePool(object):
+    """Accounts for the resources used by the steps executing in parallel.
+
+    """
+    def __init__(self, limits):
+        self._Limits = limits
+        self._Cores = 0
+        self._Memory = 0
+        self._Tokens = collections.defaultdict(int)
+        self._Running = 0
+        self._FreeCPUs = None
+        if (limits.CPUs is not None):
+            self._FreeCPUs = list(limits.CPUs)
+        self._Condition = threading.Condition()
+
+    def Acquire(self, step):
+        """Wait until the resources of a step are available and take them.
+
+        """
+        with self._Condition:
+            self._Condition.wait_for(lambda: self._TryAcquire(step))
+
+    def TryAcquire(self, step):
+        """Take the resources of a step if they are available.
+
+        Returns True if they were taken.
+
+        """
+        with self._Condition:
+            return self._TryAcquire(step)
+
+    def Release(self, step):
+        """Give back the resources of a step.
+
+        """
+        with self._Condition:
+            self._Running -= 1
+            self._Cores -= step.Cores
+            self._Memory -= step.Memory
+            for name, amount in step.Tokens.items():
+                self._Tokens[name] -= amount
+            if (step._AssignedCPUs is not None):
+                self._FreeCPUs.extend(step._AssignedCPUs)
+                self._FreeCPUs.sort()
+                step._AssignedCPUs = None
+            self._Condition.notify_all()
+
+    def _TryAcquire(self, step):
+        if (not self._Fits(step)):
+            return False
+
+        self._Running += 1
+        self._Cores += step.Cores
+        self._Memory += step.Memory
+        for name, amount in step.Tokens.items():
+            self._Tokens[name] += amount
+        if (self._FreeCPUs is not None):
+            count = min(len(self._FreeCPUs), max(1, int(math.ceil(step.Cores))))
+            if (count > 0):
+                step._AssignedCPUs = self._FreeCPUs[:count]
+                del self._FreeCPUs[:count]
+
+        return True
+
+    def _Fits(self, step):
+        # A step that needs more than the limits runs alone
+        if (self._Running == 0):
+            return True
+
+        limits = self._Limits
+        if (limits.Cores is not None and self._Cores + step.Cores > limits.Cores):
+            return False
+        if (limits.Memory is not None and self._Memory + step.Memory > limits.Memory):
+            return False
+        for name, amount in step.Tokens.items():
+            limit = limits.Tokens.get(name)
+            if (limit is not None and self._Tokens[name] + amount > limit):
+                return False
+
+        return True
+
+#############################################################################
+def _RunProcess(args, started=None, cwd=None, env=None, log=None):
+    """Run a command and wait for it to finish.
+
+    :param started: Function called with the process id of the command
+    once it has started.
+    :param cwd: Directory to run the command in. Defaults to the
+    current directory.
+    :param env: Environment of the command. Defaults to the
+    environment of this process.
+    :param log: StepLog receiving the standard output and error of the
+    command, or None to let the command write to those of this
+    process.
+
+    Returns a tuple of the return code, the wall time in seconds, and
+    the resource usage of the child process as returned by os.wait4(),
+    or None where os.wait4() is not available.
+
+    """
+    start = time.time()
+    if (log is not None):
+        process = subprocess.Popen(args, cwd=cwd, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    else:
+        process = subprocess.Popen(args, cwd=cwd, env=env)
+    if (started is not None):
+        started(process.pid)
+
+    if (log is not None):
+        # Each step runs in a thread of its own, so the output is read
+        # here until the command exits and closes the pipe
+        with process.stdout:
+            log.ReadFrom(process.stdout)
+
+    usage = None
+    if (hasattr(os, 'wait4')):
+        pid, status, usage = os.wait4(process.pid, 0)
+        if (os.WIFSIGNALED(status)):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.wait()
+
+    return (process.returncode, time.time() - start, usage)
+
+def _ExecuteBatch(steps, verbose=False):
+    """Execute stale CLIWorkflowSteps with the same batch key in one
+    invocation of their Executable.
+
+    Steps whose outputs are restored from the ArtifactStore are left out
+    of the invocation. The combined command runs as a CLIWorkflowStep
+    of its own, so it goes to a worker or to a log file like any step,
+    and each step then records its cache entries.
+
+    Returns a list of whether each step executed successfully.
+
+    """
+    if (len(steps) == 1):
+        return [steps[0].Execute(verbose)]
+
+    results = [True] * len(steps)
+    pending = []
+    for index, step in enumerate(steps):
+        restored, store, signature = step._BeginExecute()
+        if (not restored):
+            pending.append((index, step, store, signature))
+    if (len(pending) == 0):
+        return results
+
+    first = pending[0][1]
+    combined = CLIWorkflowStep('%s+%d' % (first.Name, len(pending) - 1),
+                               executable=first.Executable,
+                               inputs=[path for i, step, st, sig in pending for path in step.InputFiles],
+                               outputs=[path for i, step, st, sig in pending for path in step.OutputFiles],
+                               args=first.BatchCombine([step.Arguments for i, step, st, sig in pending]))
+    combined.Environment = first.Environment
+    combined.HashAlgorithm = first.HashAlgorithm
+    combined.Nice = first.Nice
+    combined.Affinity = first.Affinity
+    combined._Workflow = first._Workflow
+    combined._AssignedCPUs = first._AssignedCPUs
+
+    sys.stdout.write('Executing %d CLIWorkflowSteps in one batch: "%s"\n' %
+                     (len(pending), '", "'.join(step.Name for i, step, st, sig in pending)))
+    args = [combined.Executable] + combined.Arguments
+    if (verbose):
+        sys.stdout.write('Command: ')
+        sys.stdout.write(' '.join(['"%s"' % arg for arg in args]))
+        sys.stdout.write('\n')
+
+    instrumentation = first._GetInstrumentation()
+    if (instrumentation is not None):
+        for i, step, st, sig in pending:
+            instrumentation.StartExecution(step)
+
+    try:
+        returnCode, wallTime, usage, outputHashes = combined._RunCommand(args)
+    except Exception as e:
+        print('Failed to run command-line executable %s: %s' % (args, e))
+        returnCode, wallTime, outputHashes = None, None, None
+
+    # The resource usage of the command is not split between the steps
+    if (instrumentation is not None):
+        for i, step, st, sig in pending:
+            instrumentation.FinishProcess(step, wallTime, returnCode)
+
+    if (returnCode != 0):
+        if (returnCode is not None):
+            print('Process returned error code %d' % returnCode)
+            logCapture = combined._GetLogCapture()
+            if (logCapture is not None):
+                logCapture.ReportFailure(combined.Name)
+        for i, step, st, sig in pending:
+            results[i] = False
+        return results
+
+    for i, step, store, signature in pending:
+        stepHashes = None
+        if (outputHashes is not None):
+            stepHashes = dict((path, output) for path, output in outputHashes.items()
+                              if any(path == output or path.startswith(os.path.join(output, ''))
+                                     for output in step.OutputFiles))
+        results[i] = step._EndExecute(0, store, signature, stepHashes)
+
+    return results
+
+_DefaultProcessPool = None
+_DefaultProcessPoolLock = threading.Lock()
+
+def _CreateProcessPool():
+    """Create a pool of worker processes for PythonWorkflowSteps.
+
+    """
+    # Workers are not forked from this process where possible, since
+    # forking while other threads hold locks, e.g., that of sys.stdout,
+    # can leave the workers deadlocked
+    context = None
+    if ('forkserver' in multiprocessing.get_all_start_methods()):
+        context = multiprocessing.get_context('forkserver')
+
+    return concurrent.futures.ProcessPoolExecutor(mp_context=context)
+
+def _GetDefaultProcessPool():
+    """Get the pool of worker processes of PythonWorkflowSteps that do not
+    belong to a Workflow.
+
+    """
+    global _DefaultProcessPool
+    with _DefaultProcessPoolLock:
+        if (_DefaultProcessPool is None):
+            _DefaultProcessPool = _CreateProcessPool()
+
+        return _DefaultProcessPool
+
+def _DropDefaultProcessPool(pool):
+    """Replace the default pool of worker processes if a dead worker
+    process broke it.
+
+    """
+    global _DefaultProcessPool
+    with _DefaultProcessPoolLock:
+        if (_DefaultProcessPool is pool):
+            _DefaultProcessPool = None
+    pool.shutdown(wait=False)
+
+def _CanonicalArgument(arg):
+    """Convert an argument of a PythonWorkflowStep to a value that is
+    serialized to the same JSON in every run.
+
+    Lists, None, bools, numbers and strings are kept. The other
+    supported types are tagged, so that, e.g., a tuple and a list do
+    not have the same description. Raises TypeError for other types,
+    whose str() or repr() may elide data or change between runs.
+
+    """
+    if (arg is None or isinstance(arg, (bool, int, float, str))):
+        return arg
+    elif (isinstance(arg, list)):
+        return [_CanonicalArgument(item) for item in arg]
+    elif (isinstance(arg, tuple)):
+        return {'tuple': [_CanonicalArgument(item) for item in arg]}
+    elif (isinstance(arg, (set, frozenset))):
+        return {'set': sorted((_CanonicalArgument(item) for item in arg),
+                              key=lambda item: json.dumps(item, sort_keys=True))}
+    elif (isinstance(arg, dict)):
+        items = [[_CanonicalArgument(k), _CanonicalArgument(v)] for k, v in arg.items()]
+        return {'dict': sorted(items, key=lambda item: json.dumps(item[0], sort_keys=True))}
+    elif (isinstance(arg, bytes)):
+        return {'bytes': arg.hex()}
+    elif (isinstance(arg, os.PathLike)):
+        return {'path': os.fspath(arg)}
+
+    raise TypeError('%s has no stable signature, use None, bools, numbers, strings, bytes, paths, '
+                    'or lists, tuples, dictionaries and sets of them' % type(arg).__name__)
+
+def _CallFunction(function, args, cwd, logFileName=None, maxSize=None):
+    """Call the function of a PythonWorkflowStep in a worker process.
+
+    :param cwd: Working directory of the workflow, which relative paths
+    in the arguments are relative to. Worker processes outlive changes
+    of the working directory of the workflow, so they follow it for
+    each call.
+    :param logFileName: Log file receiving what the function writes to
+    sys.stdout and sys.stderr, or None to leave them alone.
+
+    Returns None if the function succeeded, or the formatted exception
+    it raised.
+
+    """
+    if (os.getcwd() != cwd):
+        os.chdir(cwd)
+
+    def Call():
+        try:
+            function(*args)
+        except Exception as e:
+            traceback.print_exc()
+            return '%s: %s' % (type(e).__name__, e)
+
+        return None
+
+    if (logFileName is None):
+        return Call()
+
+    with logs.StepLog(logFileName, maxSize) as log:
+        stream = logs.TextStream(log)
+        with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+            return Call()
+
+def _SetProcessPriority(pid, nice, affinity, name):
+    """Set the nice level and CPU affinity of the running command of a step.
+
+    """
+    try:
+        if (nice is not None):
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        if (affinity is not None):
+            os.sched_setaffinity(pid, affinity)
+    except AttributeError:
+        sys.stdout.write('Setting the priority of "%s" is not supported on this platform.\n' %
+                         name)
+    except OSError as e:
+        sys.stdout.write('Could not set the priority of "%s": %s\n' % (name, e))
+
+#############################################################################
+async def _ForwardStream(reader, stream):
+    """Copy the data from an asyncio stream to a file object as it arrives.
+
+    """
+    while True:
+        data = await reader.read(64 * 1024)
+        if (not data):
+            break
+
+        stream.flush()
+        buffer = getattr(stream, 'buffer', None)
+        if (buffer is not None):
+            buffer.write(data)
+            buffer.flush()
+        else:
+            stream.write(data.decode('utf-8', 'replace'))
+            stream.flush()
+
+async def _CaptureStream(reader, log):
+    """Copy the data from an asyncio stream to a StepLog as it arrives.
+
+    """
+    while True:
+        data = await reader.read(logs.ReadSize)
+        if (not data):
+            break
+
+        log.Write(data)
+
+#############################################################################
+class FileArgument(collections.namedtuple('FileArgument', ['Kind', 'Path'])):
+    """Argument decorated as a file by infile(), infile_hidden(), outfile()
+    or outfile_hidden(). It is a (kind, path) tuple.
+
+    """
+    __slots__ = ()
+
+    """Kinds of decorated files."""
+    Kinds = ('in', 'in_hidden', 'out', 'out_hidden')
+
 def infile(arg):
     """Decorate an argument as an input.
 
     :parameter arg: Argument to designate as an input file.
 
     """
-    return ('in', arg)
+    return FileArgument('in', arg)
 
 def infile_hidden(arg):
     """Decorate an argument as an input that is not passed as a command-line argument.
@@ -324,7 +3039,7 @@ def infile_hidden(arg):
     :parameter arg: Argument to designate as an input file.
 
     """
-    return ('in_hidden', arg)
+    return FileArgument('in_hidden', arg)
 
 def outfile(arg):
     """Decorate an argument as an output.
@@ -332,7 +3047,7 @@ def outfile(arg):
     :parameter arg: Argument to designate as an input file.
 
     """
-    return ('out', arg)
+    return FileArgument('out', arg)
 
 def outfile_hidden(arg):
     """Decorate an argument as an output that is not passed as a command-line argument.
@@ -340,4 +3055,4 @@ def outfile_hidden(arg):
     :parameter arg: Argument to designate as an input file.
 
     """
-    return ('out_hidden', arg)
+    return FileArgument('out_hidden', arg)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Tests of the execution of stale steps in batched invocations."""
+
+import contextlib
+import io
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import hashing
+from steady import workflow as wf
+
+"""Tool copying each pair of arguments, which records the number of
+arguments of each invocation. It fails if the FAIL file exists."""
+_Tool = '''#!/bin/sh
+echo $# >> calls.log
+if [ -e FAIL ]; then exit 1; fi
+while [ $# -gt 0 ]; do cp "$1" "$2"; shift 2; done
+'''
+
+
+class BatchingTest(unittest.TestCase):
+    def setUp(self):
+        self._Directory = tempfile.mkdtemp(prefix='steady-test-')
+        self._WorkingDirectory = os.getcwd()
+        os.chdir(self._Directory)
+
+        self._ToolFileName = os.path.join(self._Directory, 'tool.sh')
+        with open(self._ToolFileName, 'w') as f:
+            f.write(_Tool)
+        os.chmod(self._ToolFileName, stat.S_IRWXU)
+        for i in range(5):
+            with open('in%d.txt' % i, 'w') as f:
+                f.write('%d\n' % i)
+
+    def tearDown(self):
+        os.chdir(self._WorkingDirectory)
+        shutil.rmtree(self._Directory)
+
+    def _CreateWorkflow(self):
+        steps = []
+        for i in range(5):
+            step = wf.CLIWorkflowStep('copy-%d' % i, [self._ToolFileName, wf.infile('in%d.txt' % i),
+                                                      wf.outfile('out%d.txt' % i)])
+            step.SetBatching(maxSize=2)
+            steps.append(step)
+        return wf.Workflow(steps, cacheDirectory=os.path.join(self._Directory, 'cache'))
+
+    def _Execute(self, workflow):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return workflow.Execute()
+
+    def _Calls(self):
+        if (not os.path.exists('calls.log')):
+            return []
+        with open('calls.log') as f:
+            calls = [int(line) for line in f]
+        os.remove('calls.log')
+        return calls
+
+    def testBatchesAreSplitByMaxSize(self):
+        workflow = self._CreateWorkflow()
+        self.assertTrue(self._Execute(workflow))
+
+        # Four arguments per invocation of two steps
+        self.assertEqual(sorted(self._Calls()), [2, 4, 4])
+        for i in range(5):
+            with open('out%d.txt' % i) as f:
+                self.assertEqual(f.read(), '%d\n' % i)
+
+    def testStepsRecordTheirOwnCacheEntries(self):
+        workflow = self._CreateWorkflow()
+        self.assertTrue(self._Execute(workflow))
+        self._Calls()
+
+        hashCache = workflow._GetCache()
+        hashCache.Refresh()
+        for i in range(5):
+            name = 'copy-%d' % i
+            for path in ['in%d.txt' % i, 'out%d.txt' % i]:
+                entry = hashCache.Get(name, path)
+                self.assertIsNotNone(entry)
+                self.assertEqual(entry['sha256'], hashing.ComputeDigest(path))
+            # Other steps' files are not in the entries of a step
+            self.assertIsNone(hashCache.Get(name, 'out%d.txt' % ((i + 1) % 5)))
+
+        # Nothing is stale anymore
+        self.assertTrue(self._Execute(self._CreateWorkflow()))
+        self.assertEqual(self._Calls(), [])
+
+        # Only the step whose input changed is executed
+        with open('in3.txt', 'w') as f:
+            f.write('changed\n')
+        self.assertTrue(self._Execute(self._CreateWorkflow()))
+        self.assertEqual(self._Calls(), [2])
+        with open('out3.txt') as f:
+            self.assertEqual(f.read(), 'changed\n')
+
+    def testFailedBatchStaysStale(self):
+        open('FAIL', 'w').close()
+        self.assertFalse(self._Execute(self._CreateWorkflow()))
+        self.assertEqual(sorted(self._Calls()), [2, 4, 4])
+
+        os.remove('FAIL')
+        self.assertTrue(self._Execute(self._CreateWorkflow()))
+        self.assertEqual(sorted(self._Calls()), [2, 4, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
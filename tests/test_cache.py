@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Tests of the cache of hashes shared by several processes."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import cache
+
+
+def _Entry(digest):
+    return {'sha256': digest, 'stat': None}
+
+
+class HashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._Directory = tempfile.mkdtemp(prefix='steady-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self._Directory)
+
+    def _LogFileName(self):
+        return os.path.join(self._Directory, cache.LogFileName)
+
+    def testEntriesAreReadBack(self):
+        first = cache.HashCache(self._Directory)
+        first.Set('step', 'a', _Entry('1'))
+        first.Set('step', 'b', _Entry('2'))
+        first.Remove('step', 'b')
+        first.Flush()
+
+        second = cache.HashCache(self._Directory)
+        self.assertEqual(second.Get('step', 'a'), _Entry('1'))
+        self.assertIsNone(second.Get('step', 'b'))
+        self.assertEqual(second.Keys(), [('step', 'a')])
+
+    def testRefreshReadsAppendsOfOtherInstances(self):
+        first = cache.HashCache(self._Directory)
+        second = cache.HashCache(self._Directory)
+
+        first.Set('step', 'a', _Entry('1'))
+        second.Set('step', 'b', _Entry('2'))
+        first.Flush()
+        second.Flush()
+
+        self.assertIsNone(first.Get('step', 'b'))
+        first.Refresh()
+        second.Refresh()
+        for instance in [first, second]:
+            self.assertEqual(instance.Get('step', 'a'), _Entry('1'))
+            self.assertEqual(instance.Get('step', 'b'), _Entry('2'))
+
+        # Later records override earlier ones
+        second.Set('step', 'a', _Entry('3'))
+        second.Flush()
+        first.Refresh()
+        self.assertEqual(first.Get('step', 'a'), _Entry('3'))
+
+    def testIncompleteLinesAreNotConsumed(self):
+        first = cache.HashCache(self._Directory)
+        first.Set('step', 'a', _Entry('1'))
+        first.Flush()
+
+        second = cache.HashCache(self._Directory)
+        line = '{"path": "b", "sha256": "2", "stat": null, "step": "step", "time": 1}\n'
+        with open(self._LogFileName(), 'a') as f:
+            f.write(line[:20])
+        second.Refresh()
+        self.assertIsNone(second.Get('step', 'b'))
+
+        with open(self._LogFileName(), 'a') as f:
+            f.write(line[20:])
+        second.Refresh()
+        self.assertEqual(second.Get('step', 'b'), _Entry('2'))
+
+    def testCollectGarbageKeepsPendingEntriesOfOtherInstances(self):
+        collector = cache.HashCache(self._Directory)
+        collector.Set('old', 'a', _Entry('1'))
+        collector.Set('live', 'b', _Entry('2'))
+        collector.Flush()
+
+        writer = cache.HashCache(self._Directory)
+        self.assertEqual(writer.Get('old', 'a'), _Entry('1'))
+        writer.Set('live', 'c', _Entry('3'))
+
+        removed = collector.CollectGarbage(keep=lambda stepName, path: stepName != 'old')
+        self.assertEqual(removed, 1)
+
+        # The writer sees the log was replaced, drops the collected
+        # entry and keeps its own pending one
+        writer.Refresh()
+        self.assertIsNone(writer.Get('old', 'a'))
+        self.assertEqual(writer.Get('live', 'b'), _Entry('2'))
+        self.assertEqual(writer.Get('live', 'c'), _Entry('3'))
+        writer.Flush()
+
+        reader = cache.HashCache(self._Directory)
+        self.assertEqual(sorted(reader.Keys()), [('live', 'b'), ('live', 'c')])
+
+        # The rewritten log only holds the live entries
+        with open(self._LogFileName()) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def testCollectGarbageEvictsLeastRecentlyUsed(self):
+        first = cache.HashCache(self._Directory)
+        for i in range(5):
+            first.Set('step', str(i), _Entry(str(i)))
+            first._Times[('step', str(i))] = 1000 + i
+        first.Flush()
+
+        self.assertEqual(first.CollectGarbage(maxEntries=2), 3)
+        second = cache.HashCache(self._Directory)
+        self.assertEqual(sorted(second.Keys()), [('step', '3'), ('step', '4')])
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'requires POSIX users')
+    def testPerUserFilesInStickyDirectories(self):
+        os.chmod(self._Directory, 0o1777)
+        first = cache.HashCache(self._Directory)
+        first.Set('step', 'a', _Entry('1'))
+        first.Flush()
+
+        self.assertFalse(os.path.exists(self._LogFileName()))
+        self.assertEqual(cache.HashCache(self._Directory).Get('step', 'a'), _Entry('1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Tests of the dependencies inferred between workflow steps."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import workflow as wf
+
+
+def _CopyStep(name, source, destination):
+    return wf.CLIWorkflowStep(name, ['cp', wf.infile(source), wf.outfile(destination)])
+
+
+class FindDependenciesTest(unittest.TestCase):
+    def testExactPaths(self):
+        steps = [_CopyStep('a', 'in.txt', 'mid.txt'),
+                 _CopyStep('b', 'mid.txt', 'out.txt'),
+                 _CopyStep('c', 'in.txt', 'other.txt')]
+        self.assertEqual(wf._FindDependencies(steps), [set(), {0}, set()])
+
+    def testInputInsideWrittenDirectory(self):
+        steps = [_CopyStep('a', 'in.txt', os.path.join('d', 'sub')),
+                 _CopyStep('b', os.path.join('d', 'sub', 'x'), 'out.txt')]
+        self.assertEqual(wf._FindDependencies(steps), [set(), {0}])
+
+    def testDirectoryReadAfterFileWrittenInside(self):
+        steps = [_CopyStep('a', 'in.txt', os.path.join('d', 'x')),
+                 _CopyStep('b', 'd', 'out')]
+        self.assertEqual(wf._FindDependencies(steps), [set(), {0}])
+
+    def testWriteInsideDirectoryReadBefore(self):
+        steps = [_CopyStep('a', 'd', 'out'),
+                 _CopyStep('b', 'in.txt', os.path.join('d', 'x'))]
+        self.assertEqual(wf._FindDependencies(steps), [set(), {0}])
+
+    def testSimilarPrefixIsUnrelated(self):
+        steps = [_CopyStep('a', 'in.txt', 'd'),
+                 _CopyStep('b', 'd-other', 'out.txt'),
+                 _CopyStep('c', 'dx', 'out2.txt')]
+        self.assertEqual(wf._FindDependencies(steps), [set(), set(), set()])
+
+
+class NestedPathsExecutionTest(unittest.TestCase):
+    def setUp(self):
+        self._Directory = tempfile.mkdtemp(prefix='steady-test-')
+        self._WorkingDirectory = os.getcwd()
+        os.chdir(self._Directory)
+
+    def tearDown(self):
+        os.chdir(self._WorkingDirectory)
+        shutil.rmtree(self._Directory)
+
+    def testReaderWaitsForDirectoryWriter(self):
+        with open('in.txt', 'w') as f:
+            f.write('nested\n')
+
+        writer = wf.CLIWorkflowStep('write', ['sh', '-c', 'sleep 0.2; mkdir -p d; cp in.txt d/x',
+                                              wf.infile_hidden('in.txt'), wf.outfile_hidden('d')])
+        reader = _CopyStep('read', os.path.join('d', 'x'), 'out.txt')
+        workflow = wf.Workflow([writer, reader], cacheDirectory=os.path.join(self._Directory, 'cache'))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(workflow.Execute(jobs=2))
+
+        with open('out.txt') as f:
+            self.assertEqual(f.read(), 'nested\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
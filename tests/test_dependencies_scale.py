@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Tests that inferring the dependencies between steps scales linearly."""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import workflow as wf
+
+
+def _TwoStageSteps(count):
+    convert = wf.CLIWorkflowStepTemplate('Convert-{dataset}',
+                                         ['cp', wf.infile('in/{dataset}.txt'),
+                                          wf.outfile('mid/{dataset}.txt')])
+    register = wf.CLIWorkflowStepTemplate('Register-{dataset}',
+                                          ['cp', wf.infile('mid/{dataset}.txt'),
+                                           wf.outfile('out/{dataset}.txt')])
+    datasets = ['%06d' % i for i in range(count)]
+    return convert.Expand(datasets) + register.Expand(datasets)
+
+
+def _TimeFindDependencies(steps):
+    start = time.time()
+    predecessors = wf._FindDependencies(steps)
+    return time.time() - start, predecessors
+
+
+class FindDependenciesScaleTest(unittest.TestCase):
+    def testTwoStageWorkflow(self):
+        count = 50000
+        steps = _TwoStageSteps(count)
+        # A step reading the whole output directory depends on every
+        # step writing in it
+        steps.append(wf.CLIWorkflowStep('Summary', ['ls', wf.infile('out')]))
+
+        seconds, predecessors = _TimeFindDependencies(steps)
+        self.assertEqual(predecessors[0], set())
+        self.assertEqual(predecessors[count], {0})
+        self.assertEqual(predecessors[2 * count - 1], {count - 1})
+        self.assertEqual(predecessors[-1], set(range(count, 2 * count)))
+
+        # Quadratic behavior took more than a minute here
+        self.assertLess(seconds, 20.0)
+
+    def testLinearScaling(self):
+        smallSeconds, predecessors = _TimeFindDependencies(_TwoStageSteps(5000))
+        largeSeconds, predecessors = _TimeFindDependencies(_TwoStageSteps(40000))
+
+        # Eight times the steps should take about eight times as long,
+        # not sixty-four
+        self.assertLess(largeSeconds, 20 * smallSeconds + 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
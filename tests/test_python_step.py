@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Tests of the steps calling Python functions."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import workflow as wf
+
+
+def _Exit(code):
+    os._exit(code)
+
+
+class ArgumentsTest(unittest.TestCase):
+    def testPlainTuplesArePassedWhole(self):
+        step = wf.PythonWorkflowStep('p', shutil.copyfile,
+                                     [(1, 2), ('abc', 'def'), ('inner', 'x'), ('in', 'y')])
+        self.assertEqual(step.Arguments, [(1, 2), ('abc', 'def'), ('inner', 'x'), ('in', 'y')])
+        self.assertEqual(step.InputFiles, [])
+        self.assertEqual(step.OutputFiles, [])
+
+    def testDecoratedFiles(self):
+        step = wf.PythonWorkflowStep('p', shutil.copyfile,
+                                     [wf.infile('a'), wf.infile_hidden('b'),
+                                      wf.outfile('c'), wf.outfile_hidden('d'), ('out', 'e')])
+        self.assertEqual(step.Arguments, ['a', 'c', ('out', 'e')])
+        self.assertEqual(step.InputFiles, ['a', 'b'])
+        self.assertEqual(step.OutputFiles, ['c', 'd'])
+
+    def testTuplesAreHashedDifferentlyFromLists(self):
+        first = wf.PythonWorkflowStep('p', shutil.copyfile, [(1, 2)])
+        second = wf.PythonWorkflowStep('p', shutil.copyfile, [[1, 2]])
+        self.assertNotEqual(first._ComputeArgumentsSHA256(), second._ComputeArgumentsSHA256())
+
+    def testUnstableArgumentsAreRejected(self):
+        with self.assertRaises(TypeError):
+            wf.PythonWorkflowStep('p', shutil.copyfile, [object()])
+
+    def testCLIStepKeepsSpelledOutTags(self):
+        step = wf.CLIWorkflowStep('c', ['cp', ('in', 'a'), ('out_hidden', 'b'), ('inner', 'x')])
+        self.assertEqual(step.Arguments, ['a', ('inner', 'x')])
+        self.assertEqual(step.InputFiles, ['a'])
+        self.assertEqual(step.OutputFiles, ['b'])
+
+
+class ProcessPoolTest(unittest.TestCase):
+    def setUp(self):
+        self._Directory = tempfile.mkdtemp(prefix='steady-test-')
+        self._WorkingDirectory = os.getcwd()
+        os.chdir(self._Directory)
+        with open('in.txt', 'w') as f:
+            f.write('data\n')
+
+    def tearDown(self):
+        os.chdir(self._WorkingDirectory)
+        shutil.rmtree(self._Directory)
+
+    def _Execute(self, workflow):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return workflow.Execute()
+
+    def testDeadWorkerOnlyFailsItsStep(self):
+        crash = wf.PythonWorkflowStep('crash', _Exit, [3, wf.outfile_hidden('never.txt')])
+        copy = wf.PythonWorkflowStep('copy', shutil.copyfile,
+                                     [wf.infile('in.txt'), wf.outfile('out.txt')])
+        workflow = wf.Workflow([crash, copy], cacheDirectory=os.path.join(self._Directory, 'cache'))
+        try:
+            self.assertFalse(self._Execute(workflow))
+            self.assertTrue(os.path.isfile('out.txt'))
+
+            # Later runs still have a working pool
+            os.remove('out.txt')
+            self.assertFalse(self._Execute(workflow))
+            self.assertTrue(os.path.isfile('out.txt'))
+        finally:
+            workflow._GetProcessPool().shutdown()
+
+    def testDeadWorkerInDefaultPool(self):
+        cacheDirectory = wf.Workflow._CacheDirectory
+        wf.Workflow.SetCacheDirectory(self._Directory)
+        self.addCleanup(wf.Workflow.SetCacheDirectory, cacheDirectory)
+        crash = wf.PythonWorkflowStep('crash', _Exit, [3, wf.outfile_hidden('never.txt')])
+        copy = wf.PythonWorkflowStep('copy', shutil.copyfile,
+                                     [wf.infile('in.txt'), wf.outfile('out.txt')])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(crash.Execute())
+            self.assertTrue(copy.Execute())
+        self.assertTrue(os.path.isfile('out.txt'))
+
+    def testWorkersFollowTheWorkingDirectory(self):
+        cacheDirectory = os.path.join(self._Directory, 'cache')
+        first = wf.Workflow([wf.PythonWorkflowStep('copy', shutil.copyfile,
+                                                   [wf.infile('in.txt'), wf.outfile('c1.txt')])],
+                            cacheDirectory=cacheDirectory)
+        pool = first._GetProcessPool()
+        try:
+            self.assertTrue(self._Execute(first))
+
+            # The workers were started in the first directory
+            os.mkdir('sub')
+            os.chdir('sub')
+            with open('in.txt', 'w') as f:
+                f.write('sub\n')
+            second = wf.Workflow([wf.PythonWorkflowStep('copy', shutil.copyfile,
+                                                        [wf.infile('in.txt'), wf.outfile('c2.txt')])],
+                                 cacheDirectory=cacheDirectory)
+            second.SetProcessPool(pool)
+            self.assertTrue(self._Execute(second))
+        finally:
+            pool.shutdown()
+
+        with open('c2.txt') as f:
+            self.assertEqual(f.read(), 'sub\n')
+        self.assertFalse(os.path.exists(os.path.join(self._Directory, 'c2.txt')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#
+# Library: steady
+#
+# Copyright 2015 Kitware, Inc., 28 Corporate Dr., Clifton Park, NY 12065, USA.
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""Tests of the content-addressable store of step outputs."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from steady import hashing
+from steady import store
+from steady import workflow as wf
+
+
+def _Write(path, text):
+    directory = os.path.dirname(path)
+    if (directory and not os.path.isdir(directory)):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _Read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _FileOutput(path):
+    return {'path': path, 'sha256': hashing.ComputeDigest(path)}
+
+
+def _TreeOutput(path):
+    tree = {}
+    for relativePath, (filePath, statIdentity) in hashing.ScanDirectory(path).items():
+        tree[relativePath] = [hashing.ComputeDigest(filePath), None]
+    return {'path': path, 'sha256': hashing.ComputeDigest(path), 'tree': tree}
+
+
+class ArtifactStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._Directory = tempfile.mkdtemp(prefix='steady-test-')
+        self._WorkingDirectory = os.getcwd()
+        os.chdir(self._Directory)
+
+    def tearDown(self):
+        os.chdir(self._WorkingDirectory)
+        # Stored files may be read-only
+        for root, dirs, files in os.walk(self._Directory):
+            for name in dirs + files:
+                os.chmod(os.path.join(root, name), 0o755)
+        shutil.rmtree(self._Directory)
+
+    def _SaveOutputs(self, artifactStore):
+        _Write('out.txt', 'file\n')
+        _Write(os.path.join('tree', 'a.txt'), 'a\n')
+        _Write(os.path.join('tree', 'sub', 'b.txt'), 'b\n')
+        outputs = [_FileOutput('out.txt'), _TreeOutput('tree')]
+        artifactStore.Save('0123signature', outputs)
+        return outputs
+
+    def testSaveAndRestore(self):
+        artifactStore = store.ArtifactStore(os.path.join(self._Directory, 'store'))
+        outputs = self._SaveOutputs(artifactStore)
+        self.assertIsNone(artifactStore.Lookup('4567other'))
+        self.assertEqual(artifactStore.Lookup('0123signature'), outputs)
+
+        # Restoring replaces what is in the way
+        os.remove('out.txt')
+        _Write(os.path.join('tree', 'stale.txt'), 'stale\n')
+        self.assertTrue(artifactStore.Restore(artifactStore.Lookup('0123signature')))
+
+        self.assertEqual(_Read('out.txt'), 'file\n')
+        self.assertEqual(_Read(os.path.join('tree', 'a.txt')), 'a\n')
+        self.assertEqual(_Read(os.path.join('tree', 'sub', 'b.txt')), 'b\n')
+        self.assertFalse(os.path.exists(os.path.join('tree', 'stale.txt')))
+
+        # Copies are independent of the store
+        self.assertFalse(artifactStore.IsLinked('out.txt'))
+
+    def testHardlinks(self):
+        artifactStore = store.ArtifactStore(os.path.join(self._Directory, 'store'), hardlinks=True)
+        outputs = self._SaveOutputs(artifactStore)
+        os.remove('out.txt')
+        self.assertTrue(artifactStore.Restore(outputs))
+
+        self.assertEqual(_Read('out.txt'), 'file\n')
+        if (os.stat('out.txt').st_nlink > 1):
+            # Reflinks are used instead where supported
+            self.assertTrue(artifactStore.IsLinked('out.txt', outputs[0]['sha256']))
+            self.assertTrue(artifactStore.IsLinked('out.txt'))
+
+        # Hard links of the user are not links to the store
+        _Write('mine.txt', 'file\n')
+        os.link('mine.txt', 'mine-link.txt')
+        os.chmod('mine.txt', 0o444)
+        self.assertFalse(artifactStore.IsLinked('mine.txt'))
+        self.assertFalse(artifactStore.IsLinked('mine.txt', outputs[0]['sha256']))
+
+    def testMissingObjectsRestoreNothing(self):
+        artifactStore = store.ArtifactStore(os.path.join(self._Directory, 'store'))
+        outputs = self._SaveOutputs(artifactStore)
+        os.remove(artifactStore._ObjectFileName(outputs[1]['tree']['a.txt'][0]))
+
+        _Write('out.txt', 'current\n')
+        self.assertFalse(artifactStore.Restore(outputs))
+        self.assertEqual(_Read('out.txt'), 'current\n')
+
+    def testEvictLeastRecentlyUsed(self):
+        artifactStore = store.ArtifactStore(os.path.join(self._Directory, 'store'), maxSize=None)
+        _Write('old.txt', 'o' * 1000)
+        _Write('new.txt', 'n' * 1000)
+        old = _FileOutput('old.txt')
+        new = _FileOutput('new.txt')
+        artifactStore.Save('00old', [old])
+        artifactStore.Save('11new', [new])
+        past = time.time() - 3600
+        os.utime(artifactStore._ObjectFileName(old['sha256']), (past, past))
+
+        # Without a maximum size nothing is evicted
+        self.assertEqual(artifactStore.Evict(), 0)
+
+        artifactStore.MaxSize = 1500
+        self.assertEqual(artifactStore.Evict(), 1000)
+        self.assertFalse(artifactStore.Restore([old]))
+        self.assertTrue(artifactStore.Restore([new]))
+
+
+class WorkflowStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._Directory = tempfile.mkdtemp(prefix='steady-test-')
+        self._WorkingDirectory = os.getcwd()
+        os.chdir(self._Directory)
+        _Write('in.txt', 'in\n')
+
+    def tearDown(self):
+        os.chdir(self._WorkingDirectory)
+        for root, dirs, files in os.walk(self._Directory):
+            for name in dirs + files:
+                os.chmod(os.path.join(root, name), 0o755)
+        shutil.rmtree(self._Directory)
+
+    def _Execute(self, suffix, hardlinks):
+        step = wf.CLIWorkflowStep('append', ['sh', '-c', 'cat in.txt > out.txt; echo %s >> out.txt' % suffix,
+                                             wf.infile_hidden('in.txt'), wf.outfile_hidden('out.txt')])
+        workflow = wf.Workflow([step], cacheDirectory=os.path.join(self._Directory, 'cache'))
+        workflow.SetArtifactStore(store.ArtifactStore(os.path.join(self._Directory, 'store'),
+                                                      hardlinks=hardlinks))
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertTrue(workflow.Execute())
+        return output.getvalue()
+
+    def _CheckRoundTrip(self, hardlinks):
+        self.assertIn('Executing', self._Execute('1', hardlinks))
+        self.assertIn('Executing', self._Execute('2', hardlinks))
+
+        # Going back to earlier arguments restores instead of executing
+        output = self._Execute('1', hardlinks)
+        self.assertIn('Restored outputs', output)
+        self.assertNotIn('Executing', output)
+        self.assertEqual(_Read('out.txt'), 'in\n1\n')
+
+        # Executing again does not write through links to the store
+        self.assertIn('Executing', self._Execute('3', hardlinks))
+        self.assertEqual(_Read('out.txt'), 'in\n3\n')
+        self._Execute('1', hardlinks)
+        self.assertEqual(_Read('out.txt'), 'in\n1\n')
+
+    def testRoundTrip(self):
+        self._CheckRoundTrip(False)
+
+    def testRoundTripWithHardlinks(self):
+        self._CheckRoundTrip(True)
+
+
+if __name__ == '__main__':
+    unittest.main()